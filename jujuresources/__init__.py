@@ -1,6 +1,8 @@
 import os
 import contextlib
 import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 try:
     from urllib.request import urlopen  # Python 3
@@ -14,10 +16,12 @@ import yaml
 from jujuresources.backend import ResourceContainer
 from jujuresources.backend import PyPIResource
 from jujuresources.backend import ALL
+from jujuresources.backend import VERIFIED, INVALID
+from jujuresources.backend import register_extractor
 
 
-__all__ = ['fetch', 'verify', 'install', 'resource_path', 'resource_spec',
-           'ALL', 'config_get', 'juju_log']
+__all__ = ['fetch', 'verify', 'install', 'fetch_and_install', 'resource_path', 'resource_spec',
+           'register_extractor', 'ALL', 'config_get', 'juju_log']
 resources_cache = {}
 
 
@@ -62,39 +66,115 @@ def _load(resources_yaml, output_dir=None):
     return resources_cache[(resources_yaml, output_dir)]
 
 
-def _invalid(resources, which):
+def _verify_resource(args):
+    # runs in a worker process; send back the attributes that verifying
+    # may have filled in (e.g., the filename of a PyPI package) as well
+    resource, deep = args
+    return resource.verify(deep), resource.__dict__
+
+
+def _invalid(resources, which, deep=False, max_workers=1, processes=False):
+    subset = list(resources.subset(which))
+    if max_workers <= 1 or len(subset) <= 1:
+        results = [resources.verify(resource.name, deep) for resource in subset]
+    elif not processes:
+        # hashlib releases the GIL while hashing, so threads are usually enough
+        pool = ThreadPool(min(max_workers, len(subset)))
+        try:
+            results = pool.map(lambda resource: resources.verify(resource.name, deep), subset)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        todo = [resource for resource in subset
+                if deep or resources.state(resource.name) not in (VERIFIED, INVALID)]
+        pool = multiprocessing.Pool(min(max_workers, len(todo) or 1))
+        try:
+            verified = pool.map(_verify_resource, [(resource, deep) for resource in todo])
+        finally:
+            pool.close()
+            pool.join()
+        for resource, (valid, attrs) in zip(todo, verified):
+            resource.__dict__.update(attrs)
+            resources.set_state(resource.name, VERIFIED if valid else INVALID)
+        results = [resources.state(resource.name) == VERIFIED for resource in subset]
     invalid = set()
-    for resource in resources.subset(which):
-        if not resource.verify():
+    for resource, valid in zip(subset, results):
+        if not valid:
             invalid.add(resource.name)
     return invalid
 
 
-def _fetch(resources, which, mirror_url, force=False, reporthook=None):
+def _fetch(resources, which, mirror_url, force=False, reporthook=None, max_workers=1):
     invalid = _invalid(resources, which)
-    for resource in resources.subset(which):
-        if resource.name not in invalid and not force:
-            continue
-        if reporthook:
+    to_fetch = [resource for resource in resources.subset(which)
+                if resource.name in invalid or force]
+    if max_workers <= 1 or len(to_fetch) <= 1:
+        for resource in to_fetch:
+            if reporthook:
+                reporthook(resource.name)
+            resources.fetch(resource.name, mirror_url)
+        return
+    # report up front, in order, so output doesn't depend on thread scheduling
+    if reporthook:
+        for resource in to_fetch:
             reporthook(resource.name)
-        resource.fetch(mirror_url)
+    # PyPI resources are fetched one after another, in a single task, because
+    # each fetch clears its package folder and moves shared dependencies into
+    # theirs, which would race with other PyPI fetches
+    pypi_resources = [resource for resource in to_fetch if isinstance(resource, PyPIResource)]
+    tasks = [[resource] for resource in to_fetch if not isinstance(resource, PyPIResource)]
+    if pypi_resources:
+        tasks.append(pypi_resources)
+    pool = ThreadPool(min(max_workers, len(tasks)))
+    try:
+        pool.map(lambda task: [resources.fetch(resource.name, mirror_url) for resource in task], tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _install(resources, which, mirror_url, destination, skip_top_level, max_workers=1, install_mode=None,
+             cache_dir=None):
+    success = True
+    pypi_resources = []
+    for resource in resources.subset(which):
+        if isinstance(resource, PyPIResource):
+            # group pypi resources to reduce subprocess calls
+            pypi_resources.append(resource)
+        elif not resources.verify(resource.name):
+            success = False
+        else:
+            success = resource.install(destination, skip_top_level, verified=True,
+                                       max_workers=max_workers, install_mode=install_mode,
+                                       cache_dir=cache_dir) and success
+    if pypi_resources:
+        verified = [resource.name for resource in pypi_resources if resources.verify(resource.name)]
+        success = PyPIResource.install_group(pypi_resources, mirror_url, verified) and success
+    return success
 
 
-def _install(resources, which, mirror_url, destination, skip_top_level):
+def _fetch_and_install(resources, which, mirror_url, destination, skip_top_level, keep_archive=False):
     success = True
     pypi_resources = []
     for resource in resources.subset(which):
         if isinstance(resource, PyPIResource):
             # group pypi resources to reduce subprocess calls
             pypi_resources.append(resource)
+        elif resources.verify(resource.name):
+            # already fetched, so no need to download it again
+            success = resource.install(destination, skip_top_level, verified=True) and success
         else:
-            success = resource.install(destination, skip_top_level) and success
+            success = resources.fetch_and_install(resource.name, destination, mirror_url,
+                                                  skip_top_level, keep_archive) and success
     if pypi_resources:
-        success = PyPIResource.install_group(pypi_resources, mirror_url) and success
+        _fetch(resources, [resource.name for resource in pypi_resources], mirror_url)
+        verified = [resource.name for resource in pypi_resources if resources.verify(resource.name)]
+        success = PyPIResource.install_group(pypi_resources, mirror_url, verified) and success
     return success
 
 
-def invalid(which=None, resources_yaml='resources.yaml'):
+def invalid(which=None, resources_yaml='resources.yaml', deep=False, max_workers=1):
     """
     Return a list of the names of the resources which do not
     pass :func:`verify`.
@@ -106,12 +186,16 @@ def invalid(which=None, resources_yaml='resources.yaml'):
     :param str resources_yaml: Location of the yaml file containing the
         resource descriptions (default: ``./resources.yaml``).
         Can be a local file name or a remote URL.
+    :param bool deep: Re-hash every resource, rather than trusting previously
+        recorded results for files which haven't changed.
+    :param int max_workers: Number of resources to verify concurrently
+        (default: 1).
     """
     resources = _load(resources_yaml, None)
-    return _invalid(resources, which)
+    return _invalid(resources, which, deep, max_workers)
 
 
-def verify(which=None, resources_yaml='resources.yaml'):
+def verify(which=None, resources_yaml='resources.yaml', deep=False, max_workers=1):
     """
     Verify if some or all resources previously fetched with :func:`fetch_resources`,
     including validating their cryptographic hash.
@@ -126,14 +210,18 @@ def verify(which=None, resources_yaml='resources.yaml'):
     :param str output_dir: Override ``output_dir`` option from `resources_yaml`
         (this is intended for mirroring via the CLI and it is not recommended
         to be used otherwise)
+    :param bool deep: Re-hash every resource, rather than trusting previously
+        recorded results for files which haven't changed.
+    :param int max_workers: Number of resources to verify concurrently
+        (default: 1).
     :return: True if all of the resources are available and valid, otherwise False.
     """
     resources = _load(resources_yaml, None)
-    return not _invalid(resources, which)
+    return not _invalid(resources, which, deep, max_workers)
 
 
 def fetch(which=None, mirror_url=None, resources_yaml='resources.yaml',
-          force=False, reporthook=None):
+          force=False, reporthook=None, max_workers=1):
     """
     Attempt to fetch all resources for a charm.
 
@@ -149,13 +237,17 @@ def fetch(which=None, mirror_url=None, resources_yaml='resources.yaml',
     :param func reporthook: Callback for reporting download progress.
         Will be called once for each resource, just prior to fetching, and will
         be passed the resource name.
+    :param int max_workers: Number of resources to fetch concurrently
+        (default: 1, i.e., one at a time).  When fetching concurrently,
+        ``reporthook`` is called for every resource, in order, before any
+        downloads are started.
     :return: True or False indicating whether the resources were successfully
         downloaded.
     """
     resources = _load(resources_yaml, None)
     if reporthook is None:
         reporthook = lambda r: juju_log('Fetching %s' % r, level='INFO')
-    _fetch(resources, which, mirror_url, force, reporthook)
+    _fetch(resources, which, mirror_url, force, reporthook, max_workers)
     failed = _invalid(resources, which)
     if failed:
         juju_log('Failed to fetch resource%s: %s' % (
@@ -216,7 +308,7 @@ def resource_defined(resource_name, resources_yaml='resources.yaml'):
 
 
 def install(which=None, mirror_url=None, destination=None, skip_top_level=False,
-            resources_yaml='resources.yaml'):
+            resources_yaml='resources.yaml', max_workers=1, install_mode=None, cache_dir=None):
     """
     Install one or more resources.
 
@@ -241,7 +333,47 @@ def install(which=None, mirror_url=None, destination=None, skip_top_level=False,
     :param str resources_yaml: Location of the yaml file containing the
         resource descriptions (default: ``resources.yaml``).
         Can be a local file name or a remote URL.
+    :param int max_workers: Number of threads to use when extracting the
+        members of archive file resources (default: 1).
+    :param str install_mode: Override the ``install_mode`` of non-archive
+        file resources: ``copy`` (the default) or ``link`` to hard link them,
+        where possible, instead of copying them.  Only use ``link`` if the
+        installed files won't be modified in place.  This also applies to
+        archive members installed from ``cache_dir``.
+    :param str cache_dir: Keep the extracted contents of archive file resources
+        in this directory, and install them from there (as hard links, with
+        ``install_mode='link'``) when the same archive is installed again.
+    :returns: True if all resources were successfully installed.
+    """
+    resources = _load(resources_yaml, None)
+    return _install(resources, which, mirror_url, destination, skip_top_level, max_workers, install_mode,
+                    cache_dir)
+
+
+def fetch_and_install(which=None, mirror_url=None, destination=None, skip_top_level=False,
+                      keep_archive=False, resources_yaml='resources.yaml'):
+    """
+    Install one or more resources, streaming archive resources which haven't
+    been fetched yet straight from the download into ``destination``.
+
+    Unlike :func:`fetch` followed by :func:`install`, the archive is hashed as
+    it is extracted, and isn't written to (and re-read from) the resources
+    directory.  The extracted files are only moved into ``destination`` once
+    the hash has been checked.
+
+    :param list which: A name, or a list of one or more resource names, to
+        install.  If ommitted, all non-optional resources are installed.
+    :param str mirror_url: Fetch resources from the given mirror.
+    :param str destination: Destination to which to extract or copy file resources.
+    :param bool skip_top_level: When extracting archive file resources, skip
+        all members that are at the top level of the archive and instead extract
+        all nested members directly into ``destination``.
+    :param bool keep_archive: Also save the archives to the resources
+        directory, e.g. to serve them as a mirror.
+    :param str resources_yaml: Location of the yaml file containing the
+        resource descriptions (default: ``resources.yaml``).
+        Can be a local file name or a remote URL.
     :returns: True if all resources were successfully installed.
     """
     resources = _load(resources_yaml, None)
-    return _install(resources, which, mirror_url, destination, skip_top_level)
+    return _fetch_and_install(resources, which, mirror_url, destination, skip_top_level, keep_archive)
@@ -1,23 +1,580 @@
+import binascii
 from contextlib import closing
+import copy
+import errno
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 import hashlib
+import json
+import mmap
+import multiprocessing
 import os
 import re
 import shutil
 import subprocess
 import sys
 import tarfile
+import tempfile
+import threading
+import time
 import zipfile
+from multiprocessing.pool import ThreadPool
 
 try:
     # Python 3
     from urllib.parse import urlparse, urljoin, parse_qs
     from hashlib import algorithms_available as hashlib_algs
-    from urllib.request import urlopen
+    from urllib.request import urlopen as urllib_urlopen, Request, getproxies, proxy_bypass
+    from urllib.error import HTTPError
+    import http.client as httplib
+    import queue
 except ImportError:
     # Python 2
     from urlparse import urlparse, urljoin, parse_qs
     from hashlib import algorithms as hashlib_algs
-    from urllib2 import urlopen
+    from urllib2 import urlopen as urllib_urlopen, Request, HTTPError
+    from urllib import getproxies, proxy_bypass
+    import httplib
+    import Queue as queue
+
+from jujuresources import wheels
+
+
+def _makedirs(path):
+    """
+    Create a directory (and its parents), tolerating it having been
+    created concurrently by another fetch.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+CHUNK_SIZE = 64 * 1024  # size of the reads used when streaming downloads
+SEGMENTS = 1  # default number of connections used for each URL resource
+SEGMENT_THRESHOLD = 64 * 1024 * 1024  # only segment downloads at least this big
+MAX_CONNECTIONS_PER_HOST = 8  # limit on concurrent connections to any one host
+MAX_REDIRECTS = 10
+HASH_BUFFER_SIZE = None  # bytes hashed per update; None to pick with benchmark_hash_buffer() on first large file
+DEFAULT_HASH_BUFFER_SIZE = 1024 * 1024  # used for files too small to be worth benchmarking for
+HASH_BENCHMARK_THRESHOLD = 64 * 1024 * 1024  # size of the first file which triggers the benchmark
+HASH_PREFERENCE = ['sha512', 'sha384', 'sha256', 'sha224', 'sha1', 'md5']
+EXTRACT_BUFFER_LIMIT = 16 * 1024 * 1024  # larger tar members are written by the reader itself
+ARCHIVE_MAGIC = [  # (offset, leading bytes, format), checked in order by sniff_archive()
+    (0, b'\x1f\x8b', 'tar.gz'),
+    (0, b'BZh', 'tar.bz2'),
+    (0, b'\xfd7zXZ\x00', 'tar.xz'),
+    (0, b'\x28\xb5\x2f\xfd', 'tar.zst'),
+    (0, b'\x04\x22\x4d\x18', 'tar.lz4'),
+    (0, b'PK\x03\x04', 'zip'),
+    (0, b'PK\x05\x06', 'zip'),  # empty zip
+    (257, b'ustar', 'tar'),
+]
+EXTERNAL_DECOMPRESSORS = True  # use tools like pigz, where installed, to decompress archives
+EXTRACT_CACHE_DIR = None  # if set, keep extracted archives here to install them again quickly
+EXTRACT_CACHE_SIZE = 4 * 1024 * 1024 * 1024  # evict least recently used trees beyond this many bytes
+FICLONE = 0x40049409  # Linux ioctl to share a file's extents with another (reflink)
+INSTALL_MODES = ('copy', 'link')
+HASH_MANIFEST = 'hashes.json'  # per-package-directory record of PyPI file hashes
+MIRROR_MANIFEST = 'manifest.json'  # record of every mirrored resource, at the root of output_dir
+SDIST_EXTENSIONS_RE = r'\.(?:tar\.gz|tar\.bz2|tar\.xz|tgz|tbz|tar|zip|egg|exe)$'  # non-wheel package files
+PYPI_CACHE_DIR = os.path.join(  # on-disk cache of PyPI project pages; None to only cache in memory
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'jujuresources', 'pypi')
+PYPI_CACHE_TTL = 15 * 60  # seconds before a cached project page is revalidated with the mirror
+
+try:
+    _buffer_slice = buffer  # noqa: F821 (Python 2; hashlib won't take a memoryview)
+except NameError:
+    def _buffer_slice(buf, offset, size):
+        return memoryview(buf)[offset:offset + size]
+
+
+class MultiHash(object):
+    """
+    Compute several digests of the same data at once.
+
+    If ``chunk_size`` is given, a digest of each ``chunk_size`` block of the
+    data is also computed, using ``chunk_hash_type``, for building a
+    :class:`ChunkManifest`.
+    """
+    def __init__(self, hash_types, chunk_size=None, chunk_hash_type='sha256'):
+        self._hashers = dict((hash_type, hashlib.new(hash_type)) for hash_type in hash_types)
+        self.chunk_size = chunk_size
+        self.chunk_hash_type = chunk_hash_type
+        self.chunks = []
+        self.size = 0
+        self._chunk = None
+        self._chunk_fill = 0
+
+    def update(self, data):
+        for hasher in self._hashers.values():
+            hasher.update(data)
+        self.size += len(data)
+        if self.chunk_size:
+            self._update_chunks(data)
+
+    def _update_chunks(self, data):
+        offset = 0
+        while offset < len(data):
+            if self._chunk is None:
+                self._chunk = hashlib.new(self.chunk_hash_type)
+                self._chunk_fill = 0
+            take = min(self.chunk_size - self._chunk_fill, len(data) - offset)
+            self._chunk.update(data[offset:offset + take])
+            self._chunk_fill += take
+            offset += take
+            if self._chunk_fill == self.chunk_size:
+                self.chunks.append(self._chunk.hexdigest())
+                self._chunk = None
+
+    def hexdigests(self):
+        return dict((hash_type, hasher.hexdigest()) for hash_type, hasher in self._hashers.items())
+
+    def matches(self, expected):
+        """
+        Check the digests against a mapping of hash types to expected values.
+        """
+        return self.hexdigests() == expected
+
+    def chunk_manifest(self):
+        """
+        Return a :class:`ChunkManifest` for the data seen so far.
+        """
+        chunks = list(self.chunks)
+        if self._chunk is not None:
+            chunks.append(self._chunk.hexdigest())  # final, short chunk
+        return ChunkManifest(self.chunk_hash_type, self.chunk_size, self.size, chunks, self.hexdigests())
+
+
+class ChunkManifest(object):
+    """
+    Per-chunk digests of a file, rolled up into a single root hash.
+
+    A manifest is only ever written for a file whose full digests matched
+    the resource definition, and it records those ``digests`` so that it
+    is ignored if the definition changes.  The declared hashes remain the
+    source of truth; the manifest just lets an unchanged file be checked
+    in parallel, and a damaged one be repaired by re-fetching only the
+    chunks which don't match.
+    """
+    def __init__(self, hash_type, chunk_size, size, chunks, digests):
+        self.hash_type = hash_type
+        self.chunk_size = chunk_size
+        self.size = size
+        self.chunks = chunks
+        self.digests = digests
+
+    @property
+    def root(self):
+        root = hashlib.new(self.hash_type)
+        for chunk in self.chunks:
+            root.update(binascii.unhexlify(chunk))
+        return root.hexdigest()
+
+    def ranges(self):
+        """
+        Return the ``(first, last)`` byte offsets of each chunk.
+        """
+        return [(offset, min(offset + self.chunk_size, self.size) - 1)
+                for offset in range(0, self.size, self.chunk_size)]
+
+    @classmethod
+    def load(cls, filename):
+        try:
+            with open(filename) as fp:
+                data = json.load(fp)
+            manifest = cls(data['hash_type'], data['chunk_size'], data['size'], data['chunks'], data['digests'])
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+        if manifest.root != data.get('root') or len(manifest.chunks) != len(manifest.ranges()):
+            return None
+        return manifest
+
+    def save(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump({
+                'hash_type': self.hash_type,
+                'chunk_size': self.chunk_size,
+                'size': self.size,
+                'chunks': self.chunks,
+                'root': self.root,
+                'digests': self.digests,
+            }, fp)
+
+    def bad_chunks(self, filename, max_workers=None):
+        """
+        Hash the chunks of ``filename`` in parallel and return the indexes
+        of those which don't match the manifest.
+        """
+        if os.path.getsize(filename) != self.size:
+            return list(range(len(self.chunks)))
+
+        def check(index):
+            first, last = self.ranges()[index]
+            hasher = hashlib.new(self.hash_type)
+            buf = bytearray(min(_hash_buffer_size(self.size), self.chunk_size))
+            with open(filename, 'rb') as fp:
+                fp.seek(first)
+                remaining = last - first + 1
+                while remaining:
+                    size = fp.readinto(buf)
+                    if not size:
+                        break
+                    size = min(size, remaining)
+                    hasher.update(_buffer_slice(buf, 0, size))
+                    remaining -= size
+            return hasher.hexdigest() == self.chunks[index]
+
+        indexes = list(range(len(self.chunks)))
+        pool = ThreadPool(max_workers or multiprocessing.cpu_count())
+        try:
+            results = pool.map(check, indexes)
+        finally:
+            pool.close()
+            pool.join()
+        return [index for index, ok in zip(indexes, results) if not ok]
+
+
+def hash_file(filename, hash_type, buffer_size=None):
+    """
+    Return the hex digest of the contents of a file.
+
+    :param str filename: File to hash
+    :param str hash_type: Name of the hash algorithm, e.g. ``sha256``
+    :param int buffer_size: Bytes to hash per update (default: :data:`HASH_BUFFER_SIZE`,
+        or as picked by :func:`benchmark_hash_buffer` if that isn't set)
+    """
+    return hash_file_digests(filename, [hash_type], buffer_size)[hash_type]
+
+
+def hash_file_digests(filename, hash_types, buffer_size=None):
+    """
+    Return a mapping of each of ``hash_types`` to the hex digest of the
+    contents of a file, computed in a single pass over the file.
+
+    Regular files are memory-mapped and fed to the hashes in ``buffer_size``
+    windows without copying.  Anything which can't be mapped is read into a
+    single reusable buffer of that size instead.
+    """
+    hasher = MultiHash(hash_types)
+    _hash_file_into(filename, hasher, buffer_size)
+    return hasher.hexdigests()
+
+
+_hash_benchmark_lock = threading.Lock()
+
+
+def _hash_buffer_size(file_size=None):
+    """
+    Return :data:`HASH_BUFFER_SIZE`, first running :func:`benchmark_hash_buffer`
+    to set it if it isn't set and ``file_size`` is large enough for the buffer
+    size to matter.
+    """
+    global HASH_BUFFER_SIZE
+    if HASH_BUFFER_SIZE:
+        return HASH_BUFFER_SIZE
+    if file_size is None or file_size < HASH_BENCHMARK_THRESHOLD:
+        return DEFAULT_HASH_BUFFER_SIZE
+    with _hash_benchmark_lock:  # only benchmark once, even with concurrent verifies
+        if not HASH_BUFFER_SIZE:
+            try:
+                benchmark_hash_buffer(sample_size=8 * 1024 * 1024, rounds=1)
+            except EnvironmentError:  # e.g., no space for the scratch file
+                HASH_BUFFER_SIZE = DEFAULT_HASH_BUFFER_SIZE
+    return HASH_BUFFER_SIZE
+
+
+def _hash_file_into(filename, hasher, buffer_size=None):
+    with open(filename, 'rb') as fp:
+        buffer_size = buffer_size or _hash_buffer_size(os.fstat(fp.fileno()).st_size)
+        if not _hash_mmap(fp, hasher, buffer_size):
+            _hash_readinto(fp, hasher, buffer_size)
+
+
+def _hash_mmap(fp, hasher, buffer_size):
+    size = os.fstat(fp.fileno()).st_size
+    if not size:
+        return False  # can't map an empty file
+    try:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError, OverflowError):
+        return False
+    try:
+        view = memoryview(mm)
+    except TypeError:
+        mm.close()
+        return False  # Python 2
+    try:
+        for offset in range(0, size, buffer_size):
+            with view[offset:offset + buffer_size] as window:
+                hasher.update(window)
+    finally:
+        view.release()  # must be released before the map can be closed
+        mm.close()
+    return True
+
+
+def _hash_readinto(fp, hasher, buffer_size):
+    buf = bytearray(buffer_size)
+    while True:
+        size = fp.readinto(buf)
+        if not size:
+            break
+        hasher.update(_buffer_slice(buf, 0, size))
+
+
+def benchmark_hash_buffer(hash_type='sha256', sizes=None, sample_size=32 * 1024 * 1024, rounds=3, apply=True):
+    """
+    Time :func:`hash_file` on a scratch file with a range of buffer sizes and
+    return the fastest, setting :data:`HASH_BUFFER_SIZE` to it if ``apply``.
+
+    The scratch file is hashed once before timing, so that it is measured
+    from the page cache, like a recently fetched resource would be.
+    """
+    sizes = sizes or [2 ** n * 1024 for n in range(4, 15, 2)]  # 16KiB - 16MiB
+    fd, scratch = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            block = os.urandom(1024 * 1024)
+            for i in range(0, sample_size, len(block)):
+                fp.write(block[:sample_size - i])
+        hash_file(scratch, hash_type)
+        timings = {}
+        for size in sizes:
+            best = None
+            for i in range(rounds):
+                start = time.time()
+                hash_file(scratch, hash_type, size)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[size] = best
+    finally:
+        os.remove(scratch)
+    fastest = min(sizes, key=lambda size: (timings[size], size))
+    if apply:
+        global HASH_BUFFER_SIZE
+        HASH_BUFFER_SIZE = fastest
+    return fastest
+
+
+class PooledResponse(object):
+    """
+    File-like HTTP response, as returned by :meth:`ConnectionPool.urlopen`,
+    which hands its connection back to the pool when it is closed.
+    """
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self._response.read()
+        return self._response.read(size)
+
+    def __iter__(self):
+        buf = b''
+        for chunk in iter(lambda: self.read(CHUNK_SIZE), b''):
+            buf += chunk
+            lines = buf.split(b'\n')
+            buf = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+        if buf:
+            yield buf
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        reusable = not self._response.will_close and self._response.isclosed()
+        self._response.close()
+        self._pool._release(self._key, conn, reusable)
+
+
+class ConnectionPool(object):
+    """
+    Pool of keep-alive HTTP(S) connections, keyed by scheme, host, and port,
+    which all of the network requests made by the backend go through.
+
+    At most ``max_per_host`` connections are open to any one host at a time.
+    Requests for other schemes (e.g., ``file://``), or which need to go through
+    a proxy, are handed off to the standard library's ``urlopen``.
+    """
+    def __init__(self, max_per_host=None, timeout=None):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._stats = {}
+
+    def urlopen(self, request):
+        """
+        Open a URL or :class:`Request`, following redirects, and return a
+        file-like response.  Raises :class:`HTTPError` for error responses,
+        just like the standard library's ``urlopen``.
+        """
+        if not isinstance(request, Request):
+            request = Request(request)
+        url = request.get_full_url()
+        headers = dict(request.header_items())
+        headers.setdefault('User-agent', 'jujuresources')
+        for redirect in range(MAX_REDIRECTS + 1):
+            parts = urlparse(url)
+            if parts.scheme not in ('http', 'https') or self._proxied(parts):
+                return urllib_urlopen(Request(url, headers=headers))
+            response = self._request(parts, headers)
+            location = response.info().get('Location')
+            if response.code in (301, 302, 303, 307, 308) and location:
+                response.read()  # drain, so the connection can be reused
+                response.close()
+                url = urljoin(url, location)
+                continue
+            if response.code >= 400:
+                response.close()
+                raise HTTPError(url, response.code, response.msg, response.info(), None)
+            return response
+        raise HTTPError(url, response.code, 'Too many redirects', response.info(), None)
+
+    def stats(self):
+        """
+        Return a mapping of ``scheme://host:port`` to a dict containing the
+        number of ``connections`` opened to that host, the number of
+        ``requests`` made, and how many of those ``reused`` a connection.
+        """
+        with self._lock:
+            return dict(('{}://{}:{}'.format(*key), dict(stats)) for key, stats in self._stats.items())
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _proxied(self, parts):
+        return parts.scheme in getproxies() and not proxy_bypass(parts.hostname or '')
+
+    def _request(self, parts, headers):
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        conn, reused = self._acquire(key)
+        try:
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, IOError):
+                if not reused:
+                    raise
+                # the server probably closed the idle connection; try a fresh one
+                conn.close()
+                conn, reused = self._connect(key), False
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+        except Exception:
+            conn.close()
+            self._release(key, conn, False)
+            raise
+        with self._lock:
+            stats = self._stats[key]
+            stats['requests'] += 1
+            if reused:
+                stats['reused'] += 1
+        return PooledResponse(self, key, conn, response, parts.geturl())
+
+    def _acquire(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.max_per_host or MAX_CONNECTIONS_PER_HOST)
+                self._stats[key] = {'connections': 0, 'requests': 0, 'reused': 0}
+            slots = self._slots[key]
+        slots.acquire()
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        try:
+            return self._connect(key), False
+        except Exception:
+            slots.release()
+            raise
+
+    def _connect(self, key):
+        scheme, host, port = key
+        conn_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        if self.timeout is None:
+            conn = conn_class(host, port)
+        else:
+            conn = conn_class(host, port, timeout=self.timeout)
+        with self._lock:
+            self._stats[key]['connections'] += 1
+        return conn
+
+    def _release(self, key, conn, reusable):
+        with self._lock:
+            if reusable:
+                self._idle.setdefault(key, []).append(conn)
+            slots = self._slots[key]
+        if not reusable:
+            conn.close()
+        slots.release()
+
+
+POOL = ConnectionPool()
+
+
+def urlopen(request):
+    """
+    Open a URL or :class:`Request` through the shared :data:`POOL`.
+    """
+    return POOL.urlopen(request)
+
+
+_mirror_manifests = {}
+_mirror_manifests_lock = threading.Lock()
+
+
+def mirror_manifest(mirror_url):
+    """
+    Return the entries of the ``manifest.json`` published by a mirror,
+    keyed by resource name.  The manifest is only requested once per mirror;
+    if the mirror doesn't provide one, this returns an empty dict.
+    """
+    with _mirror_manifests_lock:  # only fetch once, even with concurrent fetches
+        if mirror_url not in _mirror_manifests:
+            manifest_url = urljoin(mirror_url, MIRROR_MANIFEST)
+            try:
+                with closing(urlopen(manifest_url)) as fp:
+                    entries = json.loads(fp.read().decode('utf-8')).get('resources', [])
+                _mirror_manifests[mirror_url] = dict((entry['name'], entry) for entry in entries)
+            except (IOError, ValueError, KeyError, AttributeError):
+                _mirror_manifests[mirror_url] = {}
+        return _mirror_manifests[mirror_url]
 
 
 class ALL(object):
@@ -27,12 +584,106 @@ class ALL(object):
     pass
 
 
+UNKNOWN = 'unknown'
+VERIFIED = 'verified'
+INVALID = 'invalid'
+FETCHING = 'fetching'
+
+
 class ResourceContainer(dict):
+    """
+    Collection of resources, which also tracks the state of each resource
+    (``UNKNOWN``, ``VERIFIED``, ``INVALID``, or ``FETCHING``) for the life
+    of the process, so that each file is only hashed once unless it changes.
+
+    Going through :meth:`verify` and :meth:`fetch`, rather than the resource
+    methods directly, keeps this state up to date.
+    """
     def __init__(self, output_dir):
         super(ResourceContainer, self).__init__()
         self._required = set()
+        self._states = {}
+        self._states_lock = threading.Lock()
         self.output_dir = output_dir
 
+    def state(self, name):
+        """
+        Return the current state of the named resource.  A verified or invalid
+        resource reverts to ``UNKNOWN`` if its file has changed on disk.
+        """
+        with self._states_lock:
+            state, stat = self._states.get(name, (UNKNOWN, None))
+        if state in (VERIFIED, INVALID) and stat != self._stat(self[name]):
+            return UNKNOWN
+        return state
+
+    def set_state(self, name, state):
+        with self._states_lock:
+            self._states[name] = (state, self._stat(self[name]))
+
+    def verify(self, name, deep=False):
+        """
+        Verify the named resource, unless its state is already known.
+
+        :param bool deep: Ignore the known state, and any recorded
+            verification, and hash the file again.
+        """
+        state = self.state(name)
+        if not deep and state in (VERIFIED, INVALID):
+            return state == VERIFIED
+        valid = self[name].verify(deep)
+        self.set_state(name, VERIFIED if valid else INVALID)
+        return valid
+
+    def fetch(self, name, mirror_url=None):
+        """
+        Fetch the named resource.  If the resource was able to confirm its
+        hash while downloading, it is marked as verified.
+        """
+        self.set_state(name, FETCHING)
+        verified = False
+        try:
+            verified = self[name].fetch(mirror_url)
+        finally:
+            self.set_state(name, VERIFIED if verified is True else UNKNOWN)
+
+    def fetch_and_install(self, name, destination, mirror_url=None, skip_top_level=False, keep_archive=False):
+        """
+        Fetch the named resource and extract it into ``destination`` in a
+        single pass.  The resource is only marked as verified if the archive
+        was kept.
+        """
+        self.set_state(name, FETCHING)
+        installed = False
+        try:
+            installed = self[name].fetch_and_install(destination, mirror_url, skip_top_level, keep_archive)
+        finally:
+            self.set_state(name, VERIFIED if installed and keep_archive else UNKNOWN)
+        return installed
+
+    def save_manifest(self, filename=None):
+        """
+        Write a ``manifest.json`` listing the name, path (relative to the
+        ``output_dir``), size, and hashes of every resource present in the
+        ``output_dir``, so that a mirror serving it can be checked with a
+        single request.
+
+        :param str filename: Where to write the manifest (default:
+            :data:`MIRROR_MANIFEST` in the ``output_dir``).
+        """
+        filename = filename or os.path.join(self.output_dir, MIRROR_MANIFEST)
+        entries = [resource.manifest_entry() for name, resource in sorted(self.items())]
+        with open(filename + '.tmp', 'w') as fp:
+            json.dump({'resources': [entry for entry in entries if entry]}, fp, indent=2, sort_keys=True)
+        os.rename(filename + '.tmp', filename)
+
+    def _stat(self, resource):
+        try:
+            st = os.stat(resource.destination)
+        except (OSError, TypeError):
+            return None
+        return (st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime), st.st_ino)
+
     def add_required(self, name, resource):
         self[name] = Resource.get(name, resource, self.output_dir)
         self._required.add(name)
@@ -44,7 +695,7 @@ class ResourceContainer(dict):
         return self.values()
 
     def required(self):
-        return [self[name] for name in self._required]
+        return [self[name] for name in sorted(self._required)]
 
     def subset(self, which):
         if not which:
@@ -82,89 +733,929 @@ class Resource(object):
         self.spec = self.destination
         self.hash = definition.get('hash', '')
         self.hash_type = definition.get('hash_type', '')
+        self.hashes = dict(definition.get('hashes') or {})
+        if self.hashes and not self.hash_type:
+            # use the strongest of the declared hashes as the primary hash
+            ranked = sorted(self.hashes, key=lambda h: (
+                HASH_PREFERENCE.index(h) if h in HASH_PREFERENCE else len(HASH_PREFERENCE), h))
+            self.hash_type = ranked[0]
+            self.hash = self.hashes[self.hash_type]
         self.skip_hash = definition.get('skip_hash', False)
+        self.chunk_size = definition.get('chunk_size')
+        self.install_mode = definition.get('install_mode', 'copy')
         self.output_dir = output_dir
 
-    def fetch(self, mirror_url=None):
-        return
+    def fetch(self, mirror_url=None):
+        return
+
+    def fetch_and_install(self, destination, mirror_url=None, skip_top_level=False, keep_archive=False):
+        """
+        Fetch the resource, if needed, and install it into ``destination``.
+        """
+        self.fetch(mirror_url)
+        return self.install(destination, skip_top_level)
+
+    def expected_digests(self):
+        """
+        Return a mapping of every declared hash type to its expected digest.
+        """
+        digests = dict(self.hashes)
+        if self.hash_type:
+            digests[self.hash_type] = self.hash
+        return digests
+
+    def _new_hash(self):
+        """
+        Return a new :class:`MultiHash` for all of this resource's declared
+        hashes, or ``None`` if the hashes can't (or shouldn't) be checked.
+        """
+        hash_types = list(self.expected_digests())
+        if self.skip_hash or not hash_types or not all(h in hashlib_algs for h in hash_types):
+            return None
+        return MultiHash(hash_types, self.chunk_size, self.hash_type)
+
+    def verify(self, deep=False):
+        """
+        Check that the resource is present and matches all of its hashes,
+        which are computed in a single pass over the file.
+
+        A successful check is recorded in a ``.verified`` file next to the
+        resource, so that later checks of the unchanged file (same path, size,
+        mtime, and inode) don't need to hash it again.
+
+        :param bool deep: Ignore any recorded result and always hash the file.
+        """
+        if not os.path.isfile(self.destination):
+            return False
+        if self.skip_hash:
+            return True  # for testing use only
+        expected = self.expected_digests()
+        if not expected or not all(hash_type in hashlib_algs for hash_type in expected):
+            return False
+        if not deep and self.verified_digests():
+            return True
+        manifest = None if deep else self.chunk_manifest()
+        if manifest:
+            # the file has changed (or was never verified in place), but if
+            # all of its chunks still match, it has the verified content
+            if manifest.bad_chunks(self.destination):
+                self._clear_verification()
+                return False
+            self._save_verification(manifest.digests)
+            return True
+        hasher = self._new_hash()
+        _hash_file_into(self.destination, hasher)
+        if not hasher.matches(expected):
+            self._clear_verification()
+            return False
+        self._save_verification(hasher.hexdigests())
+        self._save_chunk_manifest(hasher)
+        return True
+
+    def chunk_manifest(self):
+        """
+        Return the :class:`ChunkManifest` stored next to the resource, if it
+        is valid for the resource's declared hashes, or ``None``.
+        """
+        manifest = ChunkManifest.load('{}.chunks'.format(self.destination))
+        if not manifest or manifest.digests != self.expected_digests():
+            return None
+        return manifest
+
+    def _save_chunk_manifest(self, hasher):
+        if not hasher.chunk_size:
+            return
+        try:
+            hasher.chunk_manifest().save('{}.chunks'.format(self.destination))
+        except (IOError, OSError):
+            pass
+
+    def verified_digests(self):
+        """
+        Return the digests recorded the last time this resource was verified,
+        if the file hasn't changed since, or ``None``.
+        """
+        record = self._verification_record()
+        stored = self._load_verification()
+        if not record or not stored or any(stored.get(k) != v for k, v in record.items()):
+            return None
+        return stored.get('digests')
+
+    def manifest_entry(self):
+        """
+        Return the details of this resource for the mirror manifest, or
+        ``None`` if it hasn't been fetched.
+        """
+        return self._manifest_entry(self.expected_digests())
+
+    def _manifest_entry(self, expected_digests):
+        if not self.destination or not os.path.isfile(self.destination):
+            return None
+        hashes = self.verified_digests() or expected_digests
+        hashes = dict((h, v) for h, v in hashes.items() if v and not urlparse(v).scheme)
+        return {
+            'name': self.name,
+            'path': os.path.relpath(self.destination, self.output_dir).replace(os.sep, '/'),
+            'size': os.path.getsize(self.destination),
+            'hash_type': self.hash_type,
+            'hash': hashes.get(self.hash_type, ''),
+            'hashes': hashes,
+        }
+
+    def _verification_record(self):
+        """
+        Return the details which identify a verified copy of this resource.
+        """
+        try:
+            st = os.stat(self.destination)
+        except OSError:
+            return None
+        return {
+            'path': os.path.abspath(self.destination),
+            'size': st.st_size,
+            'mtime_ns': getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9)),
+            'inode': st.st_ino,
+            'hash_type': self.hash_type,
+            'hash': self.hash,
+            'hashes': self.expected_digests(),
+        }
+
+    def _load_verification(self):
+        try:
+            with open('{}.verified'.format(self.destination)) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return False
+
+    def _save_verification(self, digests):
+        filename = '{}.verified'.format(self.destination)
+        record = self._verification_record()
+        record['digests'] = digests
+        try:
+            with open(filename + '.tmp', 'w') as fp:
+                json.dump(record, fp)
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError):
+            pass  # e.g., read-only location; we'll just have to hash it next time
+
+    def _clear_verification(self):
+        try:
+            os.remove('{}.verified'.format(self.destination))
+        except OSError:
+            pass
+
+    def install(self, destination, skip_top_level=False, verified=False, max_workers=1, install_mode=None,
+                cache_dir=None):
+        """
+        Extract (or copy) the resource into ``destination``.
+
+        A receipt recording the resource's hash and the members installed is
+        kept in ``destination``, so that installing the same content again
+        does nothing, and installing a new version only writes the members
+        which have changed and removes those which are no longer included.
+
+        :param bool skip_top_level: Skip top-level archive members, and extract
+            their children directly into ``destination``.
+        :param bool verified: The resource has already been verified.
+        :param int max_workers: Number of threads to use to extract archive
+            members (default: 1).
+        :param str install_mode: How to install non-archive resources,
+            overriding the resource's ``install_mode``: ``copy`` to make an
+            independent copy (cloning the file where the filesystem
+            supports it), or ``link`` to hard link to the fetched resource
+            where possible, for consumers which won't modify it in place.
+            This also applies to members installed from the ``cache_dir``.
+        :param str cache_dir: Keep the extracted tree of archive resources in
+            this directory (default: :data:`EXTRACT_CACHE_DIR`), keyed by
+            their hash and ``skip_top_level``, and install from there instead
+            of extracting the archive again.
+        """
+        install_mode = install_mode or self.install_mode
+        cache_dir = cache_dir or EXTRACT_CACHE_DIR
+        if install_mode not in INSTALL_MODES:
+            raise ValueError('Invalid install_mode for %s: %s' % (self.name, install_mode))
+        if not verified and not self.verify():
+            return False
+        if not destination:
+            raise ValueError('Destination is required for install of: %s' % self.name)
+
+        if not os.path.exists(destination):
+            os.makedirs(destination)
+
+        receipt = self._load_receipt(destination)
+        if self._receipt_current(receipt, destination, skip_top_level):
+            return True
+        same_layout = receipt and receipt.get('skip_top_level') == skip_top_level
+        tracker = _MemberTracker(destination, receipt['members'] if same_layout else None)
+
+        extractor = EXTRACTORS.get(sniff_archive(self.destination))
+        cache_key = self._cache_key(skip_top_level) if extractor and cache_dir else None
+        if cache_key:
+            cache = ExtractCache(cache_dir)
+            extracted = cache.install(cache_key, destination, tracker, install_mode == 'link') or \
+                cache.add(cache_key, extractor, self.destination, skip_top_level, max_workers) and \
+                cache.install(cache_key, destination, tracker, install_mode == 'link')
+        else:
+            extracted = extractor and extractor(self.destination, destination, skip_top_level,
+                                                max_workers=max_workers, member_filter=tracker.filter)
+        if not extracted:
+            copy_file(self.destination, os.path.join(destination, os.path.basename(self.destination)),
+                      link=install_mode == 'link')
+            tracker.members = {os.path.basename(self.destination): [os.path.getsize(self.destination)]}
+        self._save_receipt(destination, skip_top_level, tracker.members, receipt)
+        return True
+
+    def _cache_key(self, skip_top_level):
+        if self.skip_hash or not re.match(r'^[0-9a-fA-F]+$', self.hash or '') or \
+                not re.match(r'^\w+$', self.hash_type or ''):
+            return None
+        return '{}-{}-{}'.format(self.hash_type, self.hash.lower(), 'skip' if skip_top_level else 'full')
+
+    def _receipt_file(self, destination):
+        return os.path.join(destination, '.jujuresources.{}.json'.format(self.name))
+
+    def _load_receipt(self, destination):
+        try:
+            with open(self._receipt_file(destination)) as fp:
+                receipt = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if receipt.get('name') != self.name or not isinstance(receipt.get('members'), dict):
+            return None
+        return receipt
+
+    def _receipt_current(self, receipt, destination, skip_top_level):
+        """
+        Check whether ``destination`` already holds this version of the resource.
+        """
+        digests = self.expected_digests()
+        if not receipt or self.skip_hash or not digests:
+            return False
+        if receipt.get('digests') != digests or receipt.get('skip_top_level') != skip_top_level:
+            return False
+        return all(os.path.lexists(os.path.join(destination, path)) for path in receipt['members'])
+
+    def _save_receipt(self, destination, skip_top_level, members, previous=None):
+        """
+        Remove the members of the previous install which are no longer
+        included, and record what was installed.
+        """
+        if previous:
+            _remove_members(destination, set(previous['members']) - set(members))
+        receipt_file = self._receipt_file(destination)
+        if self.skip_hash or not self.expected_digests():
+            if os.path.exists(receipt_file):
+                os.remove(receipt_file)  # can't tell later whether it's current
+            return
+        with open(receipt_file + '.tmp', 'w') as fp:
+            json.dump({
+                'name': self.name,
+                'digests': self.expected_digests(),
+                'skip_top_level': skip_top_level,
+                'members': members,
+            }, fp)
+        os.rename(receipt_file + '.tmp', receipt_file)
+
+
+def sniff_archive(filename):
+    """
+    Identify the format of an archive from its leading bytes.
+
+    :return: One of the formats in :data:`ARCHIVE_MAGIC` (``'tar'`` also
+        covers old-style tar files without the ``ustar`` magic), or ``None``
+        if it isn't a recognized archive.  Note that the compressed formats
+        are assumed to be tar files until they are extracted.
+    """
+    with open(filename, 'rb') as fp:
+        head = fp.read(tarfile.BLOCKSIZE)
+    for offset, magic, archive_format in ARCHIVE_MAGIC:
+        if head[offset:offset + len(magic)] == magic:
+            return archive_format
+    if len(head) == tarfile.BLOCKSIZE and _tar_checksum_ok(head):
+        return 'tar'
+    return None
+
+
+def _tar_checksum_ok(block):
+    """
+    Check the header checksum of a pre-POSIX tar block.
+    """
+    try:
+        expected = int(block[148:156].replace(b'\x00', b' ').strip() or b'x', 8)
+    except ValueError:
+        return False
+    checksum = sum(bytearray(block[:148])) + 8 * 32 + sum(bytearray(block[156:]))
+    return checksum == expected
+
+
+def copy_file(src, dst, link=False):
+    """
+    Copy ``src`` to ``dst`` (replacing it), along with its permissions and
+    times, using the cheapest method available.
+
+    In order, this tries a hard link (only if ``link`` is set, since the
+    files will then be one and the same), a reflink clone, an in-kernel
+    ``copy_file_range`` or ``sendfile`` copy, and finally a buffered copy.
+
+    :return: The method used: ``link``, ``clone``, ``copy_file_range``,
+        ``sendfile``, or ``copy``.
+    """
+    if link:
+        tmp = '{}.{}.tmp'.format(dst, os.getpid())
+        try:
+            os.link(src, tmp)
+            os.rename(tmp, dst)
+            return 'link'
+        except OSError:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+    if os.path.lexists(dst):
+        os.remove(dst)  # don't write through an existing link
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        method = _copy_fileobj(fsrc, fdst)
+    shutil.copystat(src, dst)
+    return method
+
+
+def _copy_fileobj(fsrc, fdst):
+    size = os.fstat(fsrc.fileno()).st_size
+    if fcntl and size:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return 'clone'
+        except (IOError, OSError):
+            pass  # not supported here, or across filesystems
+    for method in ('copy_file_range', 'sendfile'):
+        if not size or not hasattr(os, method):
+            continue
+        try:
+            _copy_in_kernel(method, fsrc.fileno(), fdst.fileno(), size)
+            return method
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.EBADF):
+                raise
+            fdst.seek(0)
+            fdst.truncate()
+    shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+    return 'copy'
+
+
+def _copy_in_kernel(method, infd, outfd, size):
+    offset = 0
+    while offset < size:
+        if method == 'sendfile':
+            copied = os.sendfile(outfd, infd, offset, size - offset)
+        else:
+            copied = os.copy_file_range(infd, outfd, size - offset, offset, offset)
+        if not copied:
+            break  # the file shrank
+        offset += copied
+
+
+def _member_signature(member):
+    """
+    Return the path of a tar or zip member, and the details used to tell
+    whether it has changed between versions of an archive: the CRC for zip
+    members, and, since tar doesn't record a checksum of the contents, the
+    size, mtime, mode, type, and link target for tar members.
+    """
+    if hasattr(member, 'CRC'):
+        return member.filename.rstrip('/'), [member.file_size, member.CRC, list(member.date_time)]
+    member_type = member.type.decode('latin-1') if isinstance(member.type, bytes) else member.type
+    return member.name.rstrip('/'), [member.size, int(member.mtime), member.mode, member_type, member.linkname]
+
+
+class _MemberTracker(object):
+    """
+    Records the signature of every archive member seen, and filters out
+    those which are unchanged since the previous install.
+    """
+    def __init__(self, destination, previous=None):
+        self.destination = destination
+        self.previous = previous or {}
+        self.members = {}
+
+    def filter(self, members):
+        for member in members:
+            path, signature = _member_signature(member)
+            self.members[path] = signature
+            if self.previous.get(path) == signature and \
+                    os.path.lexists(os.path.join(self.destination, path)):
+                continue
+            yield member
+
+
+def _remove_members(destination, paths):
+    """
+    Remove previously installed members, leaving any directories which
+    still have other contents.
+    """
+    for path in sorted(paths, reverse=True):  # children before their parents
+        if os.path.isabs(path) or '..' in path.split('/'):
+            continue
+        target = os.path.join(destination, path)
+        if os.path.isdir(target) and not os.path.islink(target):
+            try:
+                os.rmdir(target)
+            except OSError:
+                pass  # not empty
+        elif os.path.lexists(target):
+            os.remove(target)
+
+
+def _check_members(members, destination):
+    """
+    Yield the tar members, raising :class:`tarfile.TarError` before any
+    member which would be written, or whose link would point, outside of
+    ``destination``, e.g. one named ``../escaped`` or a symlink to ``/``.
+
+    Earlier members must already have been extracted, so that links
+    among them are followed.
+    """
+    root = os.path.realpath(destination)
+
+    def inside(path):
+        path = os.path.realpath(path)
+        return path == root or path.startswith(root + os.sep)
+
+    for member in members:
+        target = os.path.join(destination, member.name)
+        unsafe = os.path.isabs(member.name) or '..' in member.name.split('/') or \
+            not inside(os.path.dirname(target))
+        if member.issym():
+            unsafe = unsafe or not inside(os.path.join(os.path.dirname(target), member.linkname))
+        elif member.islnk():
+            unsafe = unsafe or not inside(os.path.join(destination, member.linkname))
+        if unsafe:
+            raise tarfile.TarError('Refusing to extract {} outside of {}'.format(member.name, destination))
+        yield member
+
+
+def _filter_members(af, skip_top_level):
+    """
+    Yield the members of a tar or zip file to be extracted, stripping the
+    top-level container from their paths if ``skip_top_level`` is set.
+    """
+    members = af.infolist() if hasattr(af, 'infolist') else af
+    for member in members:
+        if not skip_top_level:
+            yield member
+            continue
+        if hasattr(member, 'path'):
+            path = member.path  # tarfiles
+        elif hasattr(member, 'filename'):
+            path = member.filename  # zipfiles
+        if re.match(r'^[^/]+/?$', path):
+            continue  # skip top-level members
+        path = re.sub(r'^[^/]+/', '', path)  # strip top-level container
+        if hasattr(member, 'path'):
+            member.path = path  # tarfiles
+        elif hasattr(member, 'filename'):
+            member.filename = path  # zipfiles
+        yield member
+
+
+def _extract_zip_parallel(filename, destination, members, max_workers):
+    """
+    Extract the given zip members, spread across ``max_workers`` threads,
+    each reading from its own handle on the zip file.
+    """
+    # largest first, striped across the workers, to roughly balance them
+    members = sorted(members, key=lambda m: m.file_size, reverse=True)
+
+    def extract(bucket):
+        with zipfile.ZipFile(filename, 'r') as zf:
+            for member in bucket:
+                try:
+                    zf.extract(member, destination)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    zf.extract(member, destination)  # another worker created the same directory
+
+    pool = ThreadPool(max_workers)
+    try:
+        pool.map(extract, [members[i::max_workers] for i in range(max_workers)])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _extract_tar_parallel(tf, destination, members, max_workers):
+    """
+    Extract the given tar members, with the (sequential) reader handing the
+    payloads of regular files off to ``max_workers`` writer threads.
+
+    Directories are created by the reader and have their attributes set at
+    the end, and links and other special members are extracted once all of
+    the files are written, so that the result matches ``extractall``.
+    """
+    payloads = queue.Queue(max_workers * 2)
+    directories = []
+    deferred = []
+    errors = []
+
+    def write(member, chunks):
+        target = os.path.join(destination, member.name)
+        _makedirs(os.path.dirname(target))
+        with open(target, 'wb') as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+        _set_tar_attrs(tf, member, target)
+
+    def writer():
+        while True:
+            item = payloads.get()
+            if item is None:
+                return
+            try:
+                write(*item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=writer) for i in range(max_workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for member in members:
+            if errors:
+                break
+            unsafe = os.path.isabs(member.name) or '..' in member.name.split('/')
+            if member.isdir() and not unsafe:
+                _makedirs(os.path.join(destination, member.name))
+                directories.append(member)
+            elif not member.isfile() or unsafe:
+                deferred.append(member)  # let tarfile handle links, devices, and odd paths
+            elif member.size > EXTRACT_BUFFER_LIMIT:
+                fp = tf.extractfile(member)
+                write(member, iter(lambda: fp.read(CHUNK_SIZE), b''))
+            else:
+                payloads.put((member, [tf.extractfile(member).read()]))
+    finally:
+        for thread in threads:
+            payloads.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    for member in deferred:
+        tf.extract(member, destination)
+    for member in sorted(directories, key=lambda m: m.name, reverse=True):
+        _set_tar_attrs(tf, member, os.path.join(destination, member.name))
+
+
+class _TeeReader(object):
+    """
+    File-like wrapper around a download which feeds everything read from it
+    to a hash and, optionally, to a copy of the archive.  Until ``recording``
+    is turned off, what has been read is also kept in ``prefix``, so that the
+    download can still be saved whole if it turns out not to be a tar file.
+    """
+    def __init__(self, fp, hasher, archive=None):
+        self.fp = fp
+        self.hasher = hasher
+        self.archive = archive
+        self.recording = True
+        self.prefix = []
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        if self.hasher:
+            self.hasher.update(data)
+        if self.archive:
+            self.archive.write(data)
+        if self.recording:
+            self.prefix.append(data)
+        return data
+
+
+def _promote(staging, destination):
+    """
+    Move the contents of ``staging`` into ``destination``, replacing any
+    existing files, and remove ``staging``.  If ``destination`` doesn't exist
+    yet, the whole tree is moved into place with a single rename.
+    """
+    if not os.path.exists(destination):
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(staging, 0o777 & ~umask)  # mkdtemp makes it private
+        os.rename(staging, destination)
+        return
+    for name in os.listdir(staging):
+        src = os.path.join(staging, name)
+        dst = os.path.join(destination, name)
+        if os.path.isdir(src) and not os.path.islink(src) and \
+                os.path.isdir(dst) and not os.path.islink(dst):
+            _promote(src, dst)
+            continue
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        os.rename(src, dst)
+    os.rmdir(staging)
+
+
+def _set_tar_attrs(tf, member, target):
+    if hasattr(os, 'geteuid') and os.geteuid() == 0:
+        try:
+            tf.chown(member, target, False)
+        except TypeError:
+            tf.chown(member, target)  # Python 2
+    tf.chmod(member, target)
+    tf.utime(member, target)
+
+
+def _which(command):
+    """
+    Return the path to an executable on the ``PATH``, or ``None``.
+    """
+    for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        candidate = os.path.join(path, command)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def _extract_tar_members(tf, destination, skip_top_level, max_workers=1, member_filter=None):
+    members = _filter_members(tf, skip_top_level)
+    if member_filter:
+        members = member_filter(members)
+    if max_workers > 1:
+        _extract_tar_parallel(tf, destination, members, max_workers)
+    else:
+        tf.extractall(destination, members=members)
 
-    def verify(self):
-        if not os.path.isfile(self.destination):
-            return False
-        if self.skip_hash:
-            return True  # for testing use only
-        if self.hash_type not in hashlib_algs:
-            return False
-        with open(self.destination, 'rb') as fp:
-            hash = hashlib.new(self.hash_type)
-            for chunk in iter(lambda: fp.read(16 * 1024), b''):  # read chunks until nothing returned
-                hash.update(chunk)
-            if self.hash != hash.hexdigest():
-                return False
+
+class TarExtractor(object):
+    """
+    Extractor for tar files with the given ``tarfile`` compression, which
+    decompresses with ``command`` (reading the archive on stdin and writing
+    the tar to stdout) if it is installed, e.g. to use multiple cores.
+
+    Tar files created on FAT systems can't be opened by the tarfile library
+    in the usual way (see
+    http://stackoverflow.com/questions/25552162/tarfile-readerror-file-could-not-be-opened-successfully),
+    so if that fails they are read as a stream instead, skipping any invalid
+    blocks, as GNU tar does.
+    """
+    def __init__(self, compression, command=None):
+        self.compression = compression
+        self.command = command
+
+    def __call__(self, filename, destination, skip_top_level=False, max_workers=1, member_filter=None):
+        command_failed = False
+        if self.command and EXTERNAL_DECOMPRESSORS and _which(self.command[0]):
+            args = (filename, destination, skip_top_level, max_workers, member_filter)
+            try:
+                extracted = self._extract_command(*args)
+            except tarfile.ReadError:
+                # read it again, skipping invalid blocks, as the library fallback does
+                extracted = self._extract_command(*args, ignore_zeros=True)
+            if extracted is not False:
+                return bool(extracted)  # None if it isn't a tar file after all
+            command_failed = True  # the library may yet manage
+        try:
+            try:
+                tf = tarfile.open(filename, 'r:' + self.compression)
+            except tarfile.ReadError:
+                tf = tarfile.open(filename, 'r|' + self.compression, ignore_zeros=True)
+                max_workers = 1  # members can only be read in order
+                if tf.firstmember is None:
+                    # every block was skipped as invalid, so it isn't a tar file
+                    tf.close()
+                    return False
+        except tarfile.ReadError:
+            return False  # not a tar file after all (e.g., a file which is just compressed)
+        except tarfile.CompressionError:
+            if command_failed:
+                return False  # the command couldn't decompress it either, so it isn't a tar file
+            raise ValueError('Unable to decompress {}; {} is required'.format(
+                filename, self.command[0] if self.command else self.compression))
+        with tf:
+            _extract_tar_members(tf, destination, skip_top_level, max_workers, member_filter)
         return True
 
-    def install(self, destination, skip_top_level=False):
-        if not self.verify():
-            return False
-        if not destination:
-            raise ValueError('Destination is required for install of: %s' % self.name)
+    def _extract_command(self, filename, destination, skip_top_level, max_workers, member_filter,
+                         ignore_zeros=False):
+        """
+        Extract the tar written by the decompression command.
 
-        def filter_members(af):
-            members = af.infolist() if hasattr(af, 'infolist') else af
-            for member in members:
-                if not skip_top_level:
-                    yield member
-                    continue
-                if hasattr(member, 'path'):
-                    path = member.path  # tarfiles
-                elif hasattr(member, 'filename'):
-                    path = member.filename  # zipfiles
-                if re.match(r'^[^/]+/?$', path):
-                    continue  # skip top-level members
-                path = re.sub(r'^[^/]+/', '', path)  # strip top-level container
-                if hasattr(member, 'path'):
-                    member.path = path  # tarfiles
-                elif hasattr(member, 'filename'):
-                    member.filename = path  # zipfiles
-                yield member
+        :return: ``True`` if it was extracted, ``None`` if the file was
+            decompressed but isn't a tar file, or ``False`` if the command
+            failed.
+        """
+        found = False
+        with open(filename, 'rb') as fin, open(os.devnull, 'wb') as devnull:
+            proc = subprocess.Popen(self.command, stdin=fin, stdout=subprocess.PIPE, stderr=devnull)
+            try:
+                try:
+                    with tarfile.open(fileobj=proc.stdout, mode='r|', ignore_zeros=ignore_zeros) as tf:
+                        found = tf.firstmember is not None
+                        if found:
+                            _extract_tar_members(tf, destination, skip_top_level, max_workers, member_filter)
+                except tarfile.ReadError:
+                    if not ignore_zeros:
+                        raise
+                while proc.stdout.read(CHUNK_SIZE):
+                    pass  # let the decompressor finish
+            except Exception:
+                proc.kill()
+                raise
+            finally:
+                proc.stdout.close()
+                returncode = proc.wait()
+        if returncode != 0:
+            return False
+        return True if found else None
 
-        if not os.path.exists(destination):
-            os.makedirs(destination)
 
-        if tarfile.is_tarfile(self.destination):
-            with tarfile.open(self.destination) as tf:
-                tf.extractall(destination, members=filter_members(tf))
-        elif zipfile.is_zipfile(self.destination):
-            with zipfile.ZipFile(self.destination, 'r') as zf:
-                zf.extractall(destination, members=filter_members(zf))
-        elif self._is_bugged_tarfile():
-            self._handle_bugged_tarfile(destination, skip_top_level)
+def extract_zip(filename, destination, skip_top_level=False, max_workers=1, member_filter=None):
+    """
+    Extractor for zip files.
+    """
+    with zipfile.ZipFile(filename, 'r') as zf:
+        members = _filter_members(zf, skip_top_level)
+        if member_filter:
+            members = member_filter(members)
+        if max_workers > 1:
+            _extract_zip_parallel(filename, destination, list(members), max_workers)
         else:
-            shutil.copy2(self.destination, destination)
-        return True
+            zf.extractall(destination, members=members)
+    return True
+
+
+EXTRACTORS = {
+    'tar': TarExtractor(''),
+    'tar.gz': TarExtractor('gz', ['pigz', '-dc']),
+    'tar.bz2': TarExtractor('bz2', ['lbzip2', '-dc']),
+    'tar.xz': TarExtractor('xz', ['xz', '-dc', '-T0']),
+    'tar.zst': TarExtractor('zst', ['zstd', '-dc', '-T0']),
+    'tar.lz4': TarExtractor('lz4', ['lz4', '-dc']),
+    'zip': extract_zip,
+}
 
-    def _is_bugged_tarfile(self):
+
+def register_extractor(archive_format, extractor, magic=None, offset=0):
+    """
+    Register an extractor for an archive format, replacing any existing one.
+
+    The extractor is called as ``extractor(filename, destination,
+    skip_top_level, max_workers=1, member_filter=None)`` and should return
+    ``True`` if it extracted the file, or ``False`` if the file turned out
+    not to be an archive (in which case it is copied as-is).  If the
+    extractor works with ``tarfile`` or ``zipfile`` members, it should pass
+    them through ``member_filter``, when given, so that they are recorded in
+    the install receipt.
+
+    :param str archive_format: Name of the format, e.g. ``'tar.br'``.
+    :param extractor: Callable to extract the format.
+    :param bytes magic: Leading bytes which identify the format.  If not
+        given, the extractor replaces that of a format which is already known.
+    :param int offset: Position of ``magic`` in the file.
+    """
+    EXTRACTORS[archive_format] = extractor
+    if magic:
+        ARCHIVE_MAGIC.insert(0, (offset, magic, archive_format))
+
+
+class ExtractCache(object):
+    """
+    Directory of extracted archives, keyed by the archive's hash and whether
+    the top level was skipped, which can be installed from again by hard
+    linking (or cloning) their files.
+
+    Each tree is stored next to a ``<key>.json`` record of its members and
+    size, whose mtime is refreshed whenever the tree is used, and the least
+    recently used trees are evicted once the cache grows beyond ``max_size``
+    bytes.
+    """
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = EXTRACT_CACHE_SIZE if max_size is None else max_size
+
+    def add(self, key, extractor, filename, skip_top_level=False, max_workers=1):
         """
-        Check for tar file that tarfile library mistakenly reports as invalid.
-        Happens with tar files created on FAT systems.  See:
-        http://stackoverflow.com/questions/25552162/tarfile-readerror-file-could-not-be-opened-successfully
+        Extract ``filename`` into the cache.
+
+        :return: ``False`` if the extractor didn't recognize the file.
         """
+        _makedirs(self.root)
+        staging = tempfile.mkdtemp(prefix='.{}.'.format(key), dir=self.root)
+        tracker = _MemberTracker(staging)
         try:
-            output = subprocess.check_output(['file', '-z', self.destination]).decode('utf8')
-            return 'tar archive' in output and 'gzip compressed data' in output
-        except subprocess.CalledProcessError:
+            if not extractor(filename, staging, skip_top_level,
+                             max_workers=max_workers, member_filter=tracker.filter):
+                return False
+            size = 0
+            for dirpath, dirnames, filenames in os.walk(staging):
+                size += sum(os.lstat(os.path.join(dirpath, name)).st_size for name in filenames)
+            tree = os.path.join(self.root, key)
+            try:
+                os.rename(staging, tree)
+            except OSError:
+                if self._load_record(key) is not None:
+                    return True  # populated concurrently
+                # left without its record (e.g., by an interrupted add), so
+                # it can't be trusted; replace it
+                self._remove_tree(key)
+                try:
+                    os.rename(staging, tree)
+                except OSError:
+                    return True  # populated concurrently
+            staging = None
+            with open(self._record_file(key) + '.tmp', 'w') as fp:
+                json.dump({'size': size, 'members': tracker.members}, fp)
+            os.rename(self._record_file(key) + '.tmp', self._record_file(key))
+        finally:
+            if staging:
+                shutil.rmtree(staging, ignore_errors=True)
+        self.evict(keep=key)
+        return True
+
+    def install(self, key, destination, tracker=None, link=False):
+        """
+        Install the cached tree for ``key`` into ``destination``, skipping any
+        members which ``tracker`` shows are already installed.
+
+        :return: ``False`` if the tree isn't in the cache.
+        """
+        record = self._load_record(key)
+        if record is None:
             return False
+        tree = os.path.join(self.root, key)
+        os.utime(self._record_file(key), None)  # mark as recently used
+        previous = tracker.previous if tracker else {}
+        directories = []
+        for path in sorted(record['members']):  # parents before their children
+            if os.path.isabs(path) or '..' in path.split('/'):
+                continue
+            src = os.path.join(tree, path)
+            dst = os.path.join(destination, path)
+            if not os.path.lexists(src):
+                continue  # skipped when it was extracted
+            if os.path.isdir(src) and not os.path.islink(src):
+                _makedirs(dst)
+                directories.append((src, dst))
+                continue
+            if previous.get(path) == record['members'][path] and os.path.lexists(dst):
+                continue
+            _makedirs(os.path.dirname(dst))
+            if os.path.islink(src):
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                os.symlink(os.readlink(src), dst)
+            else:
+                copy_file(src, dst, link=link)
+        for src, dst in reversed(directories):
+            shutil.copystat(src, dst)
+        if tracker:
+            tracker.members = record['members']
+        return True
 
-    def _handle_bugged_tarfile(self, destination, skip_top_level):
+    def evict(self, keep=None):
         """
-        Handle tar file that tarfile library mistakenly reports as invalid.
-        Happens with tar files created on FAT systems.  See:
-        http://stackoverflow.com/questions/25552162/tarfile-readerror-file-could-not-be-opened-successfully
+        Remove the least recently used trees until the cache fits in
+        ``max_size``, other than the tree for ``keep``.
         """
-        args = ['tar', '-xzf', self.destination, '-C', destination]
-        if skip_top_level:
-            args.extend(['--strip-components', '1'])
-        subprocess.check_call(args)
+        records = []
+        for filename in os.listdir(self.root):
+            key, ext = os.path.splitext(filename)
+            record = self._load_record(key) if ext == '.json' else None
+            if record is not None:
+                records.append((os.path.getmtime(os.path.join(self.root, filename)), key, record['size']))
+        total = sum(size for mtime, key, size in records)
+        for mtime, key, size in sorted(records):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            os.remove(self._record_file(key))  # first, so the tree is no longer used
+            self._remove_tree(key)
+            total -= size
+
+    def _remove_tree(self, key):
+        # moved aside first, so that a new tree can take its place right away
+        trash = tempfile.mkdtemp(prefix='.{}.'.format(key), dir=self.root)
+        try:
+            os.rename(os.path.join(self.root, key), os.path.join(trash, key))
+        except OSError:
+            pass  # already gone
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def _record_file(self, key):
+        return os.path.join(self.root, '{}.json'.format(key))
+
+    def _load_record(self, key):
+        try:
+            with open(self._record_file(key)) as fp:
+                record = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(record, dict) or 'members' not in record or 'size' not in record:
+            return None
+        if not os.path.isdir(os.path.join(self.root, key)):
+            return None
+        return record
 
 
 class URLResource(Resource):
@@ -176,41 +1667,556 @@ class URLResource(Resource):
             'filename', os.path.basename(urlparse(self.url).path))
         self.destination = definition.get(
             'destination', os.path.join(self.output_dir, name, self.filename))
+        self.segments = definition.get('segments')
+        self.segment_threshold = definition.get('segment_threshold')
 
     def fetch(self, mirror_url=None):
+        url = self._source_url(mirror_url)
+
+        if os.path.dirname(self.destination) and not os.path.exists(os.path.dirname(self.destination)):
+            _makedirs(os.path.dirname(self.destination))
+
+        if not self._resolve_hash(mirror_url):
+            return  # ignore download errors; they will be caught by verify
+
+        # Stream into a partial file, hashing as we go, and only replace
+        # the destination once the download is complete and matches.
+        partial = '{}.part'.format(self.destination)
+        try:
+            hasher = self._repair_chunks(url, partial)
+            if not hasher:
+                probe = self._probe_segmented(url)
+                if probe:
+                    hasher = self._download_segmented(url, partial, *probe)
+                else:
+                    hasher = self._download(url, partial)
+        except IOError as e:
+            sys.stderr.write('Error fetching {}: {}\n'.format(self.url, e))
+            return  # ignore download errors; they will be caught by verify
+        if hasher and not hasher.matches(self.expected_digests()):
+            os.remove(partial)
+            sys.stderr.write('Hash mismatch for {}\n'.format(url))
+            return  # leave any previous copy alone; verify will catch it
+        os.rename(partial, self.destination)
+        if hasher:
+            self._save_verification(hasher.hexdigests())  # no need to hash it all over again
+            self._save_chunk_manifest(hasher)
+            return True
+
+    def fetch_and_install(self, destination, mirror_url=None, skip_top_level=False, keep_archive=False):
+        """
+        Download the resource and extract it into ``destination`` in a single
+        pass, hashing the download as it is extracted.
+
+        The archive is extracted into a staging directory next to
+        ``destination``, which is only moved into place if the hash matches.
+        The archive itself is only written to the ``output_dir`` if
+        ``keep_archive`` is set, or if it can't be extracted as a stream
+        (e.g., zip files), in which case it is installed as usual once the
+        download completes.
+        """
+        if not destination:
+            raise ValueError('Destination is required for install of: %s' % self.name)
+        url = self._source_url(mirror_url)
+        if os.path.dirname(self.destination) and not os.path.exists(os.path.dirname(self.destination)):
+            _makedirs(os.path.dirname(self.destination))
+        if not self._resolve_hash(mirror_url):
+            return False
+        hasher = self._new_hash()
+        if not hasher and not self.skip_hash:
+            return False  # no way to check what we would be installing
+        receipt = self._load_receipt(destination)
+        if not keep_archive and self._receipt_current(receipt, destination, skip_top_level):
+            return True  # already installed, so no need to download it
+
+        parent = os.path.dirname(os.path.abspath(destination))
+        _makedirs(parent)
+        staging = tempfile.mkdtemp(prefix='.{}.'.format(os.path.basename(destination)), dir=parent)
+        partial = '{}.part'.format(self.destination)
+        archive = open(partial, 'wb') if keep_archive else None
+        extracted = False
+        try:
+            with closing(urlopen(url)) as res_in:
+                stream = _TeeReader(res_in, hasher, archive)
+                tracker = _MemberTracker(staging)
+                try:
+                    with tarfile.open(fileobj=stream, mode='r|*') as tf:
+                        stream.recording = False
+                        members = _check_members(_filter_members(tf, skip_top_level), staging)
+                        tf.extractall(staging, members=tracker.filter(members))
+                    extracted = True
+                except tarfile.ReadError:
+                    if extracted or not stream.recording:
+                        raise
+                    if not archive:
+                        # not a tar file; we need the whole file to install it
+                        archive = stream.archive = open(partial, 'wb')
+                        archive.write(b''.join(stream.prefix))
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    pass  # hash whatever trails the end of the archive
+        except (IOError, tarfile.TarError) as e:
+            sys.stderr.write('Error fetching {}: {}\n'.format(url, e))
+            extracted = None
+        finally:
+            if archive:
+                archive.close()
+        if extracted is None or (hasher and not hasher.matches(self.expected_digests())):
+            if extracted is not None:
+                sys.stderr.write('Hash mismatch for {}\n'.format(url))
+            shutil.rmtree(staging)
+            if os.path.exists(partial):
+                os.remove(partial)
+            return False
+        if archive:
+            os.rename(partial, self.destination)
+            if hasher:
+                self._save_verification(hasher.hexdigests())
+                self._save_chunk_manifest(hasher)
+        if not extracted:
+            shutil.rmtree(staging)
+            return self.install(destination, skip_top_level, verified=True)
+        _promote(staging, destination)
+        self._save_receipt(destination, skip_top_level, tracker.members, receipt)
+        return True
+
+    def _source_url(self, mirror_url):
         if mirror_url:
             url = urljoin(mirror_url, os.path.join(self.name, self.filename))
         else:
             url = self.url
         if url.startswith('./'):
             url = url[2:]  # urlretrieve complains about this for some reason
+        return url
+
+    def _resolve_hash(self, mirror_url):
+        """
+        If the hash is given as a URL, replace it with the hash it points to
+        (or the one published in the mirror's manifest), and keep a copy next
+        to the resource.
+
+        :return: ``False`` if the hash could not be fetched.
+        """
+        if not urlparse(self.hash).scheme:
+            return True
+        hash_url_parts = urlparse(self.hash)
+        hash_filename = os.path.basename(hash_url_parts.path)
+        hash_url = urljoin(mirror_url, os.path.join(self.name, hash_filename)) if mirror_url else self.hash
+        hash_dst = os.path.join(os.path.dirname(self.destination), hash_filename)
+        entry = mirror_manifest(mirror_url).get(self.name, {}) if mirror_url else {}
+        try:
+            hash = entry.get('hashes', {}).get(self.hash_type)
+            if not hash:
+                with closing(urlopen(hash_url)) as hash_in:
+                    hash = hash_in.read(8 * 1024).decode('utf8').strip()  # hashes should never be that big
+            self.hash = hash
+            with open(hash_dst, 'w+') as hash_out:
+                hash_out.write(self.hash)
+        except IOError as e:
+            sys.stderr.write('Error fetching hash {}: {}\n'.format(hash_url, e))
+            return False
+        return True
 
+    def manifest_entry(self):
+        digests = self.expected_digests()
         if urlparse(self.hash).scheme:
-            hash_url_parts = urlparse(self.hash)
-            hash_filename = os.path.basename(hash_url_parts.path)
-            hash_url = urljoin(mirror_url, os.path.join(self.name, hash_filename)) if mirror_url else self.hash
-            hash_dst = os.path.join(os.path.dirname(self.destination), hash_filename)
+            # use the copy of the hash saved when the resource was fetched
+            hash_filename = os.path.basename(urlparse(self.hash).path)
+            hash_file = os.path.join(os.path.dirname(self.destination), hash_filename)
             try:
-                with closing(urlopen(hash_url)) as hash_in, open(hash_dst, 'w+') as hash_out:
-                    self.hash = hash_in.read(8 * 1024).decode('utf8').strip()  # hashes should never be that big
-                    hash_out.write(self.hash)
-            except IOError as e:
-                sys.stderr.write('Error fetching hash {}: {}\n'.format(hash_url, e))
-                return  # ignore download errors; they will be caught by verify
-
-        if not os.path.exists(os.path.dirname(self.destination)):
-            os.makedirs(os.path.dirname(self.destination))
-        if os.path.exists(self.destination):
-            os.remove(self.destination)  # urlretrieve won't overwrite
-        try:
-            with closing(urlopen(url)) as res_in, open(self.destination, 'wb') as res_out:
-                res_out.write(res_in.read())
+                with open(hash_file) as fp:
+                    digests[self.hash_type] = fp.read().strip()
+            except IOError:
+                return None
+        return self._manifest_entry(digests)
+
+    def _download(self, url, partial):
+        """
+        Download ``url`` into ``partial``, resuming a previously interrupted
+        download if possible, and return the hash of the complete file (or
+        ``None`` if the hash can't be checked).
+
+        Partial downloads are kept, along with a small state file recording
+        the size and validator (``ETag`` or ``Last-Modified``) of the remote
+        file, so that a later attempt can pick up where this one left off.
+        The state file is removed once the download completes.
+        """
+        state_file = '{}.state'.format(partial)
+        state = self._load_partial_state(state_file, url)
+        offset = os.path.getsize(partial) if state and os.path.isfile(partial) else 0
+        headers = {}
+        if offset and offset == state.get('size'):
+            return self._hash_prefix(partial, offset)  # finished, but never renamed
+        elif offset and offset < (state.get('size') or float('inf')):
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = self._partial_validator(state)
+        else:
+            offset = 0
+        try:
+            res_in = urlopen(Request(url, headers=headers))
+        except HTTPError as e:
+            if e.code != 416 or not offset:
+                raise
+            # our idea of the remote file is stale; start over
+            offset = 0
+            res_in = urlopen(Request(url))
+        with closing(res_in):
+            info = res_in.info()
+            content_range = info.get('Content-Range') or ''
+            if offset and (res_in.getcode() != 206 or not content_range.startswith('bytes {}-'.format(offset))):
+                offset = 0  # server ignored the range, or the file changed
+            if not offset:
+                self._save_partial_state(state_file, url, info)
+            hasher = self._hash_prefix(partial, offset)
+            with open(partial, 'ab' if offset else 'wb') as res_out:
+                for chunk in iter(lambda: res_in.read(CHUNK_SIZE), b''):
+                    if hasher:
+                        hasher.update(chunk)
+                    res_out.write(chunk)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        return hasher
+
+    def _probe_segmented(self, url):
+        """
+        Check whether ``url`` should be downloaded in segments.
+
+        Segmented downloads are opt-in (via the ``segments`` option on the
+        resource, or the module-level :data:`SEGMENTS` default), and are
+        only used if the server supports byte ranges and the file is at
+        least ``segment_threshold`` bytes.
+
+        :return: A tuple of the number of segments, the file size, and the
+            response headers, or ``None`` if the file should be downloaded
+            as a single stream.
+        """
+        segments = self.segments or SEGMENTS
+        if segments <= 1:
+            return None
+        threshold = self.segment_threshold
+        if threshold is None:
+            threshold = SEGMENT_THRESHOLD
+        probe = self._probe_range(url)
+        if not probe or probe[0] < threshold:
+            return None
+        size, info = probe
+        return min(segments, size), size, info
+
+    def _probe_range(self, url):
+        """
+        Check whether the server supports byte ranges for ``url``.
+
+        :return: A tuple of the file size and the response headers,
+            or ``None`` if ranges aren't supported.
+        """
+        try:
+            with closing(urlopen(Request(url, headers={'Range': 'bytes=0-0'}))) as res:
+                info = res.info()
+                match = re.match(r'^bytes 0-0/(\d+)$', info.get('Content-Range') or '')
+                if res.getcode() != 206 or not match:
+                    return None
+        except HTTPError:
+            return None  # e.g., 416 for an empty file; just try a normal download
+        return int(match.group(1)), info
+
+    def _repair_chunks(self, url, partial):
+        """
+        If the existing copy of the resource has a chunk manifest, re-fetch
+        only the chunks which don't match it into a copy of it at ``partial``,
+        and return the hash of the repaired copy.  Returns ``None`` if the resource can't be repaired
+        (or doesn't need to be), in which case it should be downloaded in full.
+        """
+        manifest = self.chunk_manifest()
+        if not manifest or not os.path.isfile(self.destination):
+            return None
+        bad = manifest.bad_chunks(self.destination)
+        if not bad or len(bad) == len(manifest.chunks):
+            return None
+        probe = self._probe_range(url)
+        if not probe or probe[0] != manifest.size:
+            return None
+        validator = self._partial_validator({
+            'etag': probe[1].get('ETag'),
+            'last_modified': probe[1].get('Last-Modified'),
+        })
+        # repair a copy (a clone, where supported), so the existing copy is
+        # left alone unless the repaired file turns out to match
+        copy_file(self.destination, partial)
+        ranges = manifest.ranges()
+        try:
+            for index in bad:
+                self._fetch_range(url, partial, ranges[index][0], ranges[index][1], validator)
         except IOError as e:
-            sys.stderr.write('Error fetching {}: {}\n'.format(self.url, e))
-            return  # ignore download errors; they will be caught by verify
+            os.remove(partial)
+            sys.stderr.write('Error repairing {}, fetching it in full: {}\n'.format(self.url, e))
+            return None
+        return self._hash_prefix(partial, manifest.size)
+
+    def _fetch_range(self, url, partial, first, last, validator=None):
+        """
+        Download bytes ``first`` through ``last`` of ``url`` into the same
+        position in the (preallocated) ``partial`` file.
+        """
+        headers = {'Range': 'bytes={}-{}'.format(first, last)}
+        if validator:
+            headers['If-Range'] = validator
+        with closing(urlopen(Request(url, headers=headers))) as res_in:
+            content_range = res_in.info().get('Content-Range') or ''
+            if res_in.getcode() != 206 or not content_range.startswith('bytes {}-'.format(first)):
+                raise IOError('Server did not honor range request for bytes {}-{}'.format(first, last))
+            with open(partial, 'r+b') as res_out:
+                res_out.seek(first)
+                remaining = last - first + 1
+                while remaining:
+                    chunk = res_in.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError('Range {}-{} ended early'.format(first, last))
+                    res_out.write(chunk)
+                    remaining -= len(chunk)
+
+    def _download_segmented(self, url, partial, segments, size, info):
+        """
+        Download ``url`` into ``partial`` over several concurrent connections,
+        each fetching its own byte range of a preallocated file, and return
+        the hash of the complete file (or ``None`` if it can't be checked).
+
+        Completed segments are recorded in the partial download's state file
+        so that, as long as the remote file is unchanged, a later attempt only
+        fetches the segments that are missing.
+        """
+        state_file = '{}.state'.format(partial)
+        try:
+            with open(state_file) as fp:
+                state = json.load(fp)
+        except (IOError, ValueError):
+            state = {}
+        fresh = {
+            'url': url,
+            'size': size,
+            'etag': info.get('ETag'),
+            'last_modified': info.get('Last-Modified'),
+            'segments': segments,
+            'done': [],
+        }
+        validator = self._partial_validator(fresh)
+        unchanged = all(state.get(k) == fresh[k] for k in ('url', 'size', 'etag', 'last_modified', 'segments'))
+        if not (validator and unchanged and os.path.isfile(partial) and os.path.getsize(partial) == size):
+            state = fresh
+            with open(partial, 'wb') as fp:
+                fp.truncate(size)  # preallocate, so each segment can seek to its offset
+        done = set(state.get('done', []))
+        lock = threading.Lock()
+
+        def save_state():
+            if validator:
+                state['done'] = sorted(done)
+                with open(state_file, 'w') as fp:
+                    json.dump(state, fp)
+
+        def fetch_segment(index):
+            first = index * size // segments
+            last = (index + 1) * size // segments - 1
+            self._fetch_range(url, partial, first, last, validator)
+            with lock:
+                done.add(index)
+                save_state()
+
+        save_state()
+        todo = [index for index in range(segments) if index not in done]
+        pool = ThreadPool(len(todo) or 1)
+        try:
+            pool.map(fetch_segment, todo)
+        finally:
+            pool.close()
+            pool.join()
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        return self._hash_prefix(partial, size)
+
+    def _hash_prefix(self, partial, offset):
+        """
+        Return a new hash object primed with the first ``offset`` bytes of
+        ``partial`` (i.e., the portion already downloaded).
+        """
+        hasher = self._new_hash()
+        if hasher and offset:
+            with open(partial, 'rb') as fp:
+                remaining = offset
+                while remaining:
+                    chunk = fp.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    remaining -= len(chunk)
+        return hasher
+
+    def _load_partial_state(self, state_file, url):
+        try:
+            with open(state_file) as fp:
+                state = json.load(fp)
+        except (IOError, ValueError):
+            return {}
+        if state.get('url') != url or not self._partial_validator(state):
+            return {}
+        if 'done' in state:
+            return {}  # left by a segmented download; can't be resumed as a stream
+        return state
+
+    def _partial_validator(self, state):
+        """
+        Return the validator to send with ``If-Range``.  Weak ETags can't be
+        used for ranges, so fall back to ``Last-Modified`` for those.
+        """
+        etag = state.get('etag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return state.get('last_modified')
+
+    def _save_partial_state(self, state_file, url, info):
+        size = info.get('Content-Length')
+        state = {
+            'url': url,
+            'size': int(size) if size and size.isdigit() else None,
+            'etag': info.get('ETag'),
+            'last_modified': info.get('Last-Modified'),
+        }
+        if not self._partial_validator(state):
+            # without a validator, we can't safely resume
+            if os.path.exists(state_file):
+                os.remove(state_file)
+            return
+        with open(state_file, 'w') as fp:
+            json.dump(state, fp)
+
+
+class PyPIMetadataCache(object):
+    """
+    Cache of the links, and their hashes, on the PyPI project pages of each
+    mirror, so that each page is only requested once however many of its
+    files are fetched, and not at all by later runs within ``ttl`` seconds.
+
+    Entries are kept in memory and, if ``root`` is given, as one JSON file
+    per mirror and project.  Once they are older than ``ttl``, they are
+    revalidated with a conditional request (using the ETag and Last-Modified
+    of the page), and if the mirror can't be reached, the stale entry is used.
+    """
+    def __init__(self, root=None, ttl=None):
+        self.root = root
+        self.ttl = PYPI_CACHE_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def links(self, mirror_url, project, refresh=False):
+        """
+        Return a mapping of each file name linked from the project's page on
+        the mirror to a ``(hash_type, hash)`` pair (which are empty if the link
+        has no hash), or ``None`` if the mirror has no such project.
+
+        :param bool refresh: Revalidate the entry, even if it is fresh.
+        :raises IOError: If the page can't be fetched and isn't cached.
+        """
+        key = (mirror_url, project)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            entry = self._load(mirror_url, project)
+        if entry is None or refresh or time.time() - entry['fetched'] >= self.ttl:
+            try:
+                entry = self._fetch(mirror_url, project, entry)
+            except IOError:
+                if entry is None:
+                    raise
+            else:
+                self._save(mirror_url, project, entry)
+        with self._lock:
+            self._entries[key] = entry
+        if not entry['exists']:
+            return None
+        return dict((filename, tuple(hash)) for filename, hash in entry['links'].items())
+
+    def _fetch(self, mirror_url, project, entry):
+        url = urljoin(mirror_url, project + '/')
+        headers = {}
+        if entry and entry['exists'] and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['exists'] and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            with closing(urlopen(Request(url, headers=headers))) as fp:
+                if getattr(fp, 'code', 200) == 304 and entry:
+                    fp.read()
+                    return dict(entry, fetched=time.time())
+                page = fp.read().decode('utf-8', 'replace')
+                info = fp.info()
+        except HTTPError as e:
+            if e.code == 304 and entry:
+                return dict(entry, fetched=time.time())
+            if e.code == 404:
+                return {'exists': False, 'fetched': time.time(), 'links': {}}
+            raise
+        links = {}
+        for href in re.findall(r'<a\s[^>]*href=(?:"([^"]*)"|\'([^\']*)\')', page):
+            href = href[0] or href[1]
+            filename = os.path.basename(urlparse(href).path)
+            match = re.match(r'^([^=]+)=(\w+)$', urlparse(href).fragment)
+            if filename:
+                links[filename] = list(match.groups()) if match else ['', '']
+        return {
+            'exists': True,
+            'fetched': time.time(),
+            'etag': info.get('ETag'),
+            'last_modified': info.get('Last-Modified'),
+            'links': links,
+        }
+
+    def _entry_file(self, mirror_url, project):
+        mirror = hashlib.sha1(mirror_url.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.root, mirror, '{}.json'.format(project))
+
+    def _load(self, mirror_url, project):
+        if not self.root:
+            return None
+        try:
+            with open(self._entry_file(mirror_url, project)) as fp:
+                entry = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(entry, dict) or not all(k in entry for k in ('exists', 'fetched', 'links')):
+            return None
+        return entry
+
+    def _save(self, mirror_url, project, entry):
+        if not self.root:
+            return
+        entry_file = self._entry_file(mirror_url, project)
+        try:
+            _makedirs(os.path.dirname(entry_file))
+            fd, tmp = tempfile.mkstemp(prefix='.{}.'.format(project), dir=os.path.dirname(entry_file))
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(entry, fp)
+            os.rename(tmp, entry_file)
+        except (IOError, OSError) as e:  # the cache is only an optimization
+            sys.stderr.write('Error caching PyPI metadata for {}: {}\n'.format(project, e))
+
+
+_pypi_metadata_caches = {}
+_pypi_metadata_caches_lock = threading.Lock()
+
+
+def pypi_metadata_cache():
+    """
+    Return the shared :class:`PyPIMetadataCache` for the current
+    :data:`PYPI_CACHE_DIR` and :data:`PYPI_CACHE_TTL`.
+    """
+    key = (PYPI_CACHE_DIR, PYPI_CACHE_TTL)
+    with _pypi_metadata_caches_lock:
+        if key not in _pypi_metadata_caches:
+            _pypi_metadata_caches[key] = PyPIMetadataCache(*key)
+        return _pypi_metadata_caches[key]
 
 
 class PyPIResource(URLResource):
+    _manifest_lock = threading.Lock()
+
     def __init__(self, name, definition, output_dir):
         super(PyPIResource, self).__init__(name, definition, output_dir)
         self.spec = definition.get('pypi', '')
@@ -264,51 +2270,150 @@ class PyPIResource(URLResource):
                     self.hash = hash
                     self.hash_type = hash_type
                     if hash_type:
-                        hash_file = '.'.join([self.destination, self.hash_type])
-                        self._write_file(hash_file, self.hash + '\n')
+                        self._record_hash(self.destination_dir, filename, hash_type, hash)
             else:
                 self.process_dependency(filename, mirror_url)
 
-    def verify(self):
+    def fetch_and_install(self, destination=None, mirror_url=None, skip_top_level=False, keep_archive=False):
+        self.fetch(mirror_url)
+        return self.install()
+
+    def verify(self, deep=False):
         self.get_local_hash()
-        return super(PyPIResource, self).verify()
+        return super(PyPIResource, self).verify(deep)
 
     def get_local_hash(self):
+        """
+        Find the fetched package file and its hash, from the directory's
+        hash manifest or, failing that, from legacy ``<file>.<hash_type>``
+        sidecar files.
+        """
         if self.skip_hash:
             return
         if self.url:
             return
-        if not os.path.isdir(self.destination_dir):
+        manifest = self._present_hashes(self.destination_dir)
+        if manifest:
+            filename = max(manifest, key=self._package_file_key)
+            hashes = manifest[filename]
+            hash_type = self._preferred_hash_type(hashes)
+            self.filename = filename
+            self.destination = os.path.join(self.destination_dir, filename)
+            self.hash_type = hash_type.lower()
+            self.hash = hashes[hash_type]
             return
-        for filename in os.listdir(self.destination_dir):
-            fullname = os.path.join(self.destination_dir, filename)
+        try:
+            filenames = os.listdir(self.destination_dir)
+        except OSError:
+            return
+        present = set(filenames)
+        for filename in filenames:
             for hash_type in hashlib_algs:
-                hash_file = '{}.{}'.format(fullname, hash_type)
-                if os.path.isfile(hash_file):
+                hash_file = '{}.{}'.format(filename, hash_type)
+                if hash_file in present:
+                    fullname = os.path.join(self.destination_dir, filename)
                     self.filename = filename
                     self.destination = fullname
                     self.hash_type = hash_type.lower()
-                    with open(hash_file) as fp:
+                    with open(os.path.join(self.destination_dir, hash_file)) as fp:
                         self.hash = fp.readline().strip()
                     return
 
+    def _package_file_key(self, filename):
+        # dependency folders aren't cleared between fetches, so they can hold
+        # several versions; prefer one matching the spec, then the newest, then
+        # a wheel (such as one built by build_wheels) to an sdist
+        version = self._version_from_filename(filename)
+        matches_spec = True
+        if wheels.pkg_resources is not None:
+            try:
+                parsed = wheels.pkg_resources.parse_version(version)
+            except ValueError:
+                parsed = wheels.pkg_resources.parse_version('0')
+            if not self.url:
+                try:
+                    matches_spec = version in wheels.pkg_resources.Requirement.parse(self.spec)
+                except ValueError:
+                    pass
+        else:
+            parsed = tuple(int(part) for part in re.findall(r'\d+', version))
+        return (matches_spec, parsed, filename.endswith('.whl'), filename)
+
+    @classmethod
+    def _version_from_filename(cls, filename):
+        info = wheels.parse_wheel_filename(filename)
+        if info:
+            return info['version'].replace('_', '-')
+        match = re.search(r'-(v?\d[^-]*)', re.sub(SDIST_EXTENSIONS_RE, '', os.path.basename(filename)))
+        return match.group(1) if match else ''
+
+    @classmethod
+    def _present_hashes(cls, directory):
+        """
+        Return the directory's hash manifest, without the entries for any
+        files which are no longer there.
+        """
+        manifest = cls._load_hash_manifest(directory)
+        if not manifest:
+            return manifest
+        try:
+            present = set(os.listdir(directory))
+        except OSError:
+            return {}
+        return dict((filename, hashes) for filename, hashes in manifest.items() if filename in present)
+
+    @classmethod
+    def _preferred_hash_type(cls, hashes):
+        return sorted(hashes, key=lambda h: (
+            HASH_PREFERENCE.index(h) if h in HASH_PREFERENCE else len(HASH_PREFERENCE), h))[0]
+
+    @classmethod
+    def _load_hash_manifest(cls, directory):
+        try:
+            with open(os.path.join(directory, HASH_MANIFEST)) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+    def _record_hash(self, directory, filename, hash_type, hash):
+        """
+        Record the hash of a fetched package file in the directory's hash
+        manifest, as well as in a sidecar file for older readers.
+        """
+        self._write_file(os.path.join(directory, '.'.join([filename, hash_type])), hash + '\n')
+        self._update_hash_manifest(directory, filename, hash_type, hash)
+
+    @classmethod
+    def _update_hash_manifest(cls, directory, filename, hash_type, hash):
+        manifest_file = os.path.join(directory, HASH_MANIFEST)
+        with cls._manifest_lock:  # dependencies can be recorded by concurrent fetches
+            manifest = cls._present_hashes(directory) or {}  # pruning files which have been removed
+            manifest.setdefault(filename, {})[hash_type] = hash
+            with open(manifest_file + '.tmp', 'w') as fp:
+                json.dump(manifest, fp, indent=2, sort_keys=True)
+            os.rename(manifest_file + '.tmp', manifest_file)
+
+    def manifest_entry(self):
+        # look up the fetched file on a copy, leaving this resource as it was
+        resource = copy.copy(self)
+        resource.get_local_hash()
+        return super(PyPIResource, resource).manifest_entry()
+
     def get_remote_hash(self, filename, mirror_url):
         if self.skip_hash:
             return ('', '')
         package_name = self._package_name_from_filename(filename, mirror_url)
-        url = urljoin(mirror_url, package_name)
-        link_re = (
-            r'href=(?:"(?:[^"]*/)?|\'(?:[^\']*/)?)'
-            '{}#([^=]+)=(\w+)["\']'.format(re.escape(filename)))
-        try:
-            with closing(urlopen(url)) as fp:
-                for line in fp:
-                    match = re.search(link_re, line.decode('utf-8'))
-                    if match:
-                        return match.groups()
+        cache = pypi_metadata_cache()
+        try:
+            links = cache.links(mirror_url, package_name)
+            if links is not None and filename not in links:
+                # the cached page may predate this file
+                links = cache.links(mirror_url, package_name, refresh=True)
         except IOError as e:
-            sys.stderr.write('Error fetching hash {}: {}\n'.format(url, e))
+            sys.stderr.write('Error fetching hash {}: {}\n'.format(urljoin(mirror_url, package_name + '/'), e))
             return ('', '')
+        if links and links.get(filename, ('', ''))[0]:
+            return links[filename]
 
         sys.stderr.write('Hash not found for {}\n'.format(filename))
         return ('', '')
@@ -318,45 +2423,61 @@ class PyPIResource(URLResource):
         # we need to move them to their own package folders to be
         # properly mirrored
         package_name = self._package_name_from_filename(filename, mirror_url)
+        if os.path.isdir(self.output_dir):
+            # reuse the folder of a resource with an unnormalized name, e.g. Jinja2
+            for entry in os.listdir(self.output_dir):
+                if package_name and wheels.canonical_name(entry) == package_name:
+                    package_name = entry
+                    break
         new_dir = os.path.join(self.output_dir, package_name)
         old_dest = os.path.join(self.destination_dir, filename)
         new_dest = os.path.join(new_dir, filename)
         if not os.path.exists(new_dir):
-            os.makedirs(new_dir)
+            _makedirs(new_dir)
         os.rename(old_dest, new_dest)
         hash_type, hash = self.get_remote_hash(filename, mirror_url)
         if hash_type:
-            hash_file = '.'.join([new_dest, hash_type])
-            self._write_file(hash_file, hash + '\n')
+            self._record_hash(new_dir, filename, hash_type, hash)
 
     @classmethod
     def _package_name_from_filename(cls, filename, mirror_url):
-        # package file names may or may not contain various bits,
-        # such as the arch, python version, package version, etc,
-        # so we need to figure out what prefix is actually the
-        # package name
-        index = cls._get_index(mirror_url)
-        parts = filename.split('-')
-        while parts:
-            package_name = '-'.join(parts)
-            if package_name in index:
-                return package_name
-            parts.pop()
+        """
+        Return the normalized (PEP 503) name of the project which a package
+        file belongs to, or an empty string if it can't be determined.
+
+        Wheel file names (PEP 427) are unambiguous.  For sdists and eggs, the
+        name is everything before the first ``-`` which is followed by a
+        version number; only if there is no, or more than one, such ``-`` is
+        the mirror asked which of the candidate projects exists.
+        """
+        info = wheels.parse_wheel_filename(filename)
+        if info:
+            return wheels.canonical_name(info['name'])
+        candidates = cls._project_name_candidates(filename)
+        if len(candidates) == 1:
+            return candidates[0]
+        if not candidates:
+            parts = re.sub(SDIST_EXTENSIONS_RE, '', filename).split('-')
+            candidates = [wheels.canonical_name('-'.join(parts[:i])) for i in range(len(parts), 0, -1)]
+        for candidate in candidates:
+            if cls._project_exists(candidate, mirror_url):
+                return candidate
         return ''
 
     @classmethod
-    def _get_index(cls, url):
-        if not getattr(cls, '_index', None):
-            cls._index = set()
-            try:
-                with closing(urlopen(url)) as fp:
-                    for line in fp:
-                        matches = re.findall(r'<a href=(?:"[^"]*"|\'[^\']*\')>([^</]+)', line.decode('utf-8'))
-                        for project in matches:
-                            cls._index.add(project)
-            except IOError as e:
-                sys.stderr.write('Error fetching index {}: {}\n'.format(url, e))
-        return cls._index
+    def _project_name_candidates(cls, filename):
+        # longest first, e.g. foo-2-bar-1.0.tar.gz could be foo-2-bar or foo
+        parts = re.sub(SDIST_EXTENSIONS_RE, '', filename).split('-')
+        return [wheels.canonical_name('-'.join(parts[:i]))
+                for i in range(len(parts) - 1, 0, -1)
+                if re.match(r'^v?\d', parts[i])]
+
+    @classmethod
+    def _project_exists(cls, project, mirror_url):
+        try:
+            return pypi_metadata_cache().links(mirror_url, project) is not None
+        except IOError:
+            return False
 
     def _write_file(self, filename, text):
         with open(filename, 'w') as fp:
@@ -369,9 +2490,17 @@ class PyPIResource(URLResource):
             if not os.path.isdir(candidate):
                 continue
             res = PyPIResource(entry, {'pypi': entry}, root_dir)
-            res.get_local_hash()
-            if not res.hash_type:
-                continue
+            manifest = res._present_hashes(candidate)
+            if manifest:
+                links = [(filename, cls._preferred_hash_type(hashes))
+                         for filename, hashes in sorted(manifest.items())]
+                links = [(filename, hash_type, manifest[filename][hash_type])
+                         for filename, hash_type in links]
+            else:
+                res.get_local_hash()
+                if not res.hash_type:
+                    continue
+                links = [(res.filename, res.hash_type, res.hash)]
             res._write_file(os.path.join(candidate, 'index.html'), '\n'.join([
                 '<html>',
                 '  <head>',
@@ -380,28 +2509,235 @@ class PyPIResource(URLResource):
                 '  </head>',
                 '  <body>',
                 '    <h1>Links for {}</h1>'.format(res.package_name),
-                '    <a href="{0.filename}#{0.hash_type}={0.hash}" rel="internal">'
-                '{0.filename}</h1>'.format(res),
+            ] + [
+                '    <a href="{0}#{1}={2}" rel="internal">{0}</a><br/>'.format(*link)
+                for link in links
+            ] + [
                 '  </body>',
                 '</html>',
             ]))
 
-    def install(self):
+    @classmethod
+    def _package_dirs(cls, root_dir):
+        """
+        Return the names of the package directories under ``root_dir``.
+
+        URL resources also leave hash files in their directories, so only
+        those with a hash manifest, which is only written for PyPI resources,
+        are included.
+        """
+        try:
+            entries = sorted(os.listdir(root_dir))
+        except OSError:
+            return []
+        return [entry for entry in entries
+                if os.path.isfile(os.path.join(root_dir, entry, HASH_MANIFEST))]
+
+    @classmethod
+    def build_wheels(cls, root_dir, max_workers=1, mirror_url=None):
+        """
+        Build a wheel, with ``pip wheel``, for each fetched package under
+        ``root_dir`` which is only available as an sdist, so that units can
+        install the binary package instead of building it from source.
+
+        Packages with a ``pyproject.toml`` are built in isolation, with
+        their build requirements installed from ``mirror_url`` (or PyPI), so
+        that index has to be reachable.
+
+        The wheels are stored alongside the sdists, with their own hashes,
+        and are preferred to them by :meth:`get_local_hash`.
+
+        :return: The names of the package directories for which no wheel
+            could be built.
+        """
+        resources = []
+        for entry in cls._package_dirs(root_dir):
+            res = PyPIResource(entry, {'pypi': entry}, root_dir)
+            res.get_local_hash()
+            if res.hash_type and not res.filename.endswith('.whl'):
+                resources.append(res)
+        if max_workers <= 1 or len(resources) <= 1:
+            results = [res._build_wheel(mirror_url) for res in resources]
+        else:
+            pool = ThreadPool(min(max_workers, len(resources)))
+            try:
+                results = pool.map(lambda res: res._build_wheel(mirror_url), resources)
+            finally:
+                pool.close()
+                pool.join()
+        return [res.name for res, result in zip(resources, results) if not result]
+
+    def _build_wheel(self, mirror_url=None):
         if not self.verify():
+            sys.stderr.write('Not building wheel for invalid {}\n'.format(self.filename))
+            return False
+        build_dir = tempfile.mkdtemp(prefix='.wheels.', dir=self.destination_dir)
+        try:
+            cmd = ['pip', 'wheel', '--no-deps', '-w', build_dir, self.destination]
+            if mirror_url:
+                cmd.extend(['-i', mirror_url])  # for the build requirements
+            try:
+                subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as e:  # noqa
+                sys.stderr.write('Error building wheel for {}:\n{}\n'.format(self.filename, e.output))
+                return False
+            wheels = [filename for filename in os.listdir(build_dir) if filename.endswith('.whl')]
+            for filename in wheels:
+                wheel = os.path.join(self.destination_dir, filename)
+                os.rename(os.path.join(build_dir, filename), wheel)
+                self._record_hash(self.destination_dir, filename, 'sha256', hash_file(wheel, 'sha256'))
+            return bool(wheels)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    def install(self, verified=False):
+        if not verified and not self.verify():
             return False
-        return subprocess.call(['pip', 'install', self.destination]) == 0
+        return self.install_group([self], verified=[self.name])
 
     @classmethod
-    def install_group(cls, resources, mirror_url=None):
+    def install_group(cls, resources, mirror_url=None, verified=()):
+        fetched = [resource.name in verified or resource.verify() for resource in resources]
+        if all(fetched) and cls._install_wheels(resources):
+            return True
         to_install = []
-        for resource in resources:
-            if resource.verify():
+        for resource, is_fetched in zip(resources, fetched):
+            if is_fetched:
                 # use pre-fetched copy, if available
                 to_install.append(resource.destination)
             else:
                 # otherwise, try installing directly from mirror
                 to_install.append(resource.spec)
-        cmd = ['pip', 'install'] + to_install
+        output_dirs = sorted(set(resource.output_dir for resource in resources))
+        local = cls._local_packages(output_dirs)
+        find_links = []
+        for package_dir in sorted(set(os.path.dirname(filename) for filename in local.values())):
+            find_links.extend(['--find-links', package_dir])
+        if all(fetched) and cls._local_closure(resources, local):
+            # everything needed has been fetched, so don't touch the network
+            if subprocess.call(['pip', 'install', '--no-index'] + find_links + to_install) == 0:
+                return True
+        cmd = ['pip', 'install'] + find_links + to_install
         if mirror_url:
             cmd.extend(['-i', mirror_url])
         return subprocess.call(cmd) == 0
+
+    @classmethod
+    def _local_packages(cls, output_dirs):
+        """
+        Return a mapping of the normalized name of each package fetched into
+        ``output_dirs`` to its file.
+        """
+        local = {}
+        for output_dir in output_dirs:
+            for entry in cls._package_dirs(output_dir):
+                res = PyPIResource(entry, {'pypi': entry}, output_dir)
+                res.get_local_hash()
+                if res.destination and os.path.isfile(res.destination):
+                    local.setdefault(wheels.canonical_name(entry), res.destination)
+        return local
+
+    @classmethod
+    def _local_closure(cls, resources, local):
+        """
+        Whether all of the dependencies of the fetched ``resources``, and
+        theirs, are either fetched (in ``local``) or already installed, in
+        versions which satisfy every requirement on them.
+        """
+        if wheels.pkg_resources is None:
+            return False
+        working_set = wheels.pkg_resources.WorkingSet()
+        seen = set()
+        todo = [resource.destination for resource in resources]
+        while todo:
+            try:
+                reqs = wheels.requirements(todo.pop())
+            except (IOError, OSError, ValueError, zipfile.BadZipfile):
+                reqs = None
+            if reqs is None:
+                return False  # can't tell what it needs
+            for req in reqs:
+                key = wheels.canonical_name(req.project_name)
+                if key in local:
+                    if cls._version_from_filename(local[key]) not in req:
+                        return False  # pip would need to fetch another version
+                    if key not in seen:
+                        todo.append(local[key])
+                    seen.add(key)
+                    continue
+                try:
+                    if working_set.find(req) is not None:
+                        continue
+                except wheels.pkg_resources.VersionConflict:
+                    pass
+                return False
+        return True
+
+    @classmethod
+    def _install_wheels(cls, resources):
+        """
+        Install verified wheel resources without pip, if all of their
+        dependencies are either already installed or also fetched as wheels.
+
+        They are installed into the running interpreter's environment, so
+        this is only done if that is also where the ``pip`` on the ``PATH``
+        installs, and the environment isn't externally managed (see
+        :func:`wheels.externally_managed`).
+
+        :return: ``False`` if pip is needed, in which case nothing was installed.
+        """
+        if not resources or not all(resource.destination.endswith('.whl') for resource in resources):
+            return False
+        pip_python = cls._pip_interpreter()
+        if not pip_python or os.path.abspath(pip_python) != os.path.abspath(sys.executable):
+            return False  # pip installs into another environment
+        extras = {}
+        for resource in resources:
+            match = re.match(r'^[^\[<>=!~;:]+\[([^\]]*)\]', resource.spec)
+            if match:
+                extras[resource.destination] = tuple(e.strip() for e in match.group(1).split(',') if e.strip())
+        output_dirs = sorted(set(resource.output_dir for resource in resources))
+        try:
+            return wheels.install_wheels([resource.destination for resource in resources],
+                                         lambda project: cls._find_wheel(output_dirs, project),
+                                         extras=extras)
+        except (IOError, OSError, ValueError, zipfile.BadZipfile) as e:
+            sys.stderr.write('Error installing wheels, falling back to pip: {}\n'.format(e))
+            return False
+
+    @classmethod
+    def _pip_interpreter(cls):
+        """
+        Return the interpreter which runs the ``pip`` on the ``PATH``, from
+        its ``#!`` line, or ``None`` if that can't be determined.
+        """
+        pip = _which('pip')
+        if not pip:
+            return None
+        try:
+            with open(pip, 'rb') as fp:
+                line = fp.readline(1024)
+        except IOError:
+            return None
+        if not line.startswith(b'#!'):
+            return None
+        args = line[2:].decode(sys.getfilesystemencoding(), 'replace').split()
+        if len(args) == 2 and os.path.basename(args[0]) == 'env':
+            return _which(args[1])
+        return args[0] if len(args) == 1 else None
+
+    @classmethod
+    def _find_wheel(cls, output_dirs, project):
+        # dependencies are fetched into their own package folders (see process_dependency)
+        for output_dir in output_dirs:
+            try:
+                entries = os.listdir(output_dir)
+            except OSError:
+                continue
+            for entry in entries:
+                if wheels.canonical_name(entry) != wheels.canonical_name(project):
+                    continue
+                res = PyPIResource(entry, {'pypi': entry}, output_dir)
+                if res.verify() and res.destination.endswith('.whl'):
+                    return res.destination
+        return None
@@ -1,5 +1,6 @@
 from __future__ import print_function
 import os
+import re
 import ssl
 import sys
 import socket
@@ -10,12 +11,15 @@ try:
     # Python 3
     from http.server import SimpleHTTPRequestHandler
     from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
 except ImportError:
     # Python 2
     from SimpleHTTPServer import SimpleHTTPRequestHandler
     from SocketServer import TCPServer as HTTPServer
+    from SocketServer import ThreadingMixIn
 
 from jujuresources import _fetch
+from jujuresources import _fetch_and_install
 from jujuresources import _install
 from jujuresources import _invalid
 from jujuresources import _load
@@ -47,6 +51,80 @@ def argset(name, *args, **kwargs):
     return _arg
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server which handles each connection in its own thread, so that
+    clients holding keep-alive connections open don't block each other.
+    """
+    daemon_threads = True
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Request handler which also honors single ``Range: bytes=...`` requests,
+    so that interrupted downloads from a mirror can be resumed, and which
+    supports keep-alive connections.
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = 60  # drop idle keep-alive connections
+    _range_length = None
+
+    def send_head(self):
+        self._range_length = None
+        path = self.translate_path(self.path)
+        match = re.match(r'^bytes=(\d*)-(\d*)$', (self.headers.get('Range') or '').strip())
+        if not match or match.groups() == ('', '') or not os.path.isfile(path):
+            return SimpleHTTPRequestHandler.send_head(self)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return SimpleHTTPRequestHandler.send_head(self)
+        fs = os.fstat(f.fileno())
+        last_modified = self.date_time_string(fs.st_mtime)
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range != last_modified:
+            f.close()  # file has changed; send the whole thing
+            return SimpleHTTPRequestHandler.send_head(self)
+        size = fs.st_size
+        first, last = match.groups()
+        if first:
+            first = int(first)
+            last = min(int(last), size - 1) if last else size - 1
+        else:
+            first, last = max(size - int(last), 0), size - 1  # suffix range
+        if first >= size or first > last:
+            f.close()
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(size))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        self.send_response(206)
+        self.send_header('Content-type', self.guess_type(path))
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(first, last, size))
+        self.send_header('Content-Length', str(last - first + 1))
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        f.seek(first)
+        self._range_length = last - first + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        if self._range_length is None:
+            return SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+        remaining = self._range_length
+        while remaining > 0:
+            chunk = source.read(min(64 * 1024, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        SimpleHTTPRequestHandler.end_headers(self)
+
+
 print = print  # for testing
 _exit = sys.exit  # for testing
 
@@ -100,7 +178,21 @@ def resources(argv=sys.argv[1:]):
 @arg('-f', '--force', action='store_true',
      help='Force re-download of valid resources')
 @arg('-v', '--verbose', action='store_true',
-     help='Write download error information to stderr')
+     help='Write download error information and connection statistics to stderr')
+@arg('-j', '--jobs', type=int, default=1,
+     help='Number of resources to fetch concurrently (default: 1)')
+@arg('-S', '--segments', type=int, default=None,
+     help='Number of connections to use for each large URL resource, '
+          'for resources which do not set their own (default: 1)')
+@arg('--segment-threshold', type=int, default=None,
+     help='Minimum size, in bytes, of resources to download in segments '
+          '(default: 64MiB)')
+@arg('--pypi-cache-ttl', type=int, default=None,
+     help='Seconds for which cached PyPI project pages are used without '
+          'checking the mirror for changes (default: 900)')
+@arg('-w', '--wheels', action='store_true',
+     help='Build wheels for fetched PyPI packages which are only available as '
+          'sdists, so they can be installed without building them from source')
 @arg('resource_names', nargs='*',
      help='Names of specific resources to fetch (defaults to all required, '
           'or all if --all is given)')
@@ -114,7 +206,23 @@ def fetch(opts):
     reporthook = None if opts.quiet else lambda name: print('Fetching {}...'.format(name))
     if opts.verbose:
         backend.VERBOSE = True
-    _fetch(resources, opts.resource_names, opts.mirror_url, opts.force, reporthook)
+    if opts.segments:
+        backend.SEGMENTS = opts.segments
+    if opts.segment_threshold is not None:
+        backend.SEGMENT_THRESHOLD = opts.segment_threshold
+    if opts.pypi_cache_ttl is not None:
+        backend.PYPI_CACHE_TTL = opts.pypi_cache_ttl
+    _fetch(resources, opts.resource_names, opts.mirror_url, opts.force, reporthook, opts.jobs)
+    if opts.wheels and os.path.isdir(resources.output_dir):
+        failed = backend.PyPIResource.build_wheels(resources.output_dir, opts.jobs, opts.mirror_url)
+        if failed and not opts.quiet:
+            print("Unable to build wheels for: {}".format(', '.join(failed)))
+    if os.path.isdir(resources.output_dir):
+        resources.save_manifest()
+    if opts.verbose:
+        for host, stats in sorted(backend.POOL.stats().items()):
+            sys.stderr.write('{}: {connections} connections, {requests} requests, {reused} reused\n'.format(
+                host, **stats))
     return verify(opts)
 
 
@@ -126,6 +234,12 @@ def fetch(opts):
      help='Include all optional resources as well as required')
 @arg('-q', '--quiet', action='store_true',
      help='Suppress output and only set the return code')
+@arg('--deep', action='store_true',
+     help='Re-hash every resource, ignoring recorded results for unchanged files')
+@arg('-j', '--jobs', type=int, default=1,
+     help='Number of resources to verify concurrently (default: 1)')
+@arg('--processes', action='store_true',
+     help='Verify concurrently using processes rather than threads')
 @arg('resource_names', nargs='*',
      help='Names of specific resources to verify (defaults to all required, '
           'or all if --all is given)')
@@ -136,7 +250,8 @@ def verify(opts):
     resources = _load(opts.resources, opts.output_dir)
     if opts.all:
         opts.resource_names = ALL
-    invalid = _invalid(resources, opts.resource_names)
+    invalid = _invalid(resources, opts.resource_names, getattr(opts, 'deep', False),
+                       opts.jobs, getattr(opts, 'processes', False))
     if not invalid:
         if not opts.quiet:
             print("All resources successfully downloaded")
@@ -161,6 +276,14 @@ def verify(opts):
      help='Destination for archive or file resources to be installed to')
 @arg('-s', '--skip-top-level', action='store_true',
      help='Skip top-level members of archives, and extract children directly to destination')
+@arg('-j', '--jobs', type=int, default=1,
+     help='Number of threads to use when extracting archives (default: 1)')
+@arg('--install-mode', choices=backend.INSTALL_MODES, default=None,
+     help='Copy non-archive resources, or hard link them where possible '
+          '(default: the install_mode of each resource, or copy)')
+@arg('--cache-dir', default=None,
+     help='Directory in which to cache extracted archives, to install them from '
+          'again (as hard links, with --install-mode=link)')
 @arg('resource_names', nargs='*',
      help='Names of specific resources to verify (defaults to all required, '
           'or all if --all is given)')
@@ -172,7 +295,8 @@ def install(opts):
     if opts.all:
         opts.resource_names = ALL
     success = _install(resources, opts.resource_names, opts.mirror_url,
-                       opts.destination, opts.skip_top_level)
+                       opts.destination, opts.skip_top_level, opts.jobs, opts.install_mode,
+                       opts.cache_dir)
     if success:
         if not opts.quiet:
             print("All resources successfully installed")
@@ -184,6 +308,45 @@ def install(opts):
         return 1
 
 
+@arg('-r', '--resources', default='resources.yaml',
+     help='File or URL containing the YAML resource descriptions (default: ./resources.yaml)')
+@arg('-d', '--output-dir', default=None,
+     help='Directory in which to keep fetched resources (default: ./resources/)')
+@arg('-u', '--mirror-url',
+     help='URL of a mirror from which to fetch resources')
+@arg('-a', '--all', action='store_true',
+     help='Include all optional resources as well as required')
+@arg('-q', '--quiet', action='store_true',
+     help='Suppress output and only set the return code')
+@arg('-D', '--destination',
+     help='Destination for archive or file resources to be installed to')
+@arg('-s', '--skip-top-level', action='store_true',
+     help='Skip top-level members of archives, and extract children directly to destination')
+@arg('-k', '--keep-archive', action='store_true',
+     help='Also save downloaded archives to the output dir')
+@arg('resource_names', nargs='*',
+     help='Names of specific resources to install (defaults to all required, '
+          'or all if --all is given)')
+def fetch_and_install(opts):
+    """
+    Install one or more resources, extracting archives as they are downloaded.
+    """
+    resources = _load(opts.resources, opts.output_dir)
+    if opts.all:
+        opts.resource_names = ALL
+    success = _fetch_and_install(resources, opts.resource_names, opts.mirror_url,
+                                 opts.destination, opts.skip_top_level, opts.keep_archive)
+    if success:
+        if not opts.quiet:
+            print("All resources successfully installed")
+        return 0
+    else:
+        if not opts.quiet:
+            # streamed archives aren't kept, so we can't list which were invalid
+            print("Unable to install some resources")
+        return 1
+
+
 @arg('-r', '--resources', default='resources.yaml',
      help='File or URL containing the YAML resource descriptions (default: ./resources.yaml)')
 @arg('-d', '--output-dir', default=None,
@@ -236,10 +399,11 @@ def serve(opts):
         sys.stderr.write("Resources dir '{}' not found.  Did you fetch?\n".format(opts.output_dir))
         return 1
     backend.PyPIResource.build_pypi_indexes(opts.output_dir)
+    resources.save_manifest()
     os.chdir(opts.output_dir)
 
-    HTTPServer.allow_reuse_address = True
-    httpd = HTTPServer((opts.host, opts.port), SimpleHTTPRequestHandler)
+    ThreadingHTTPServer.allow_reuse_address = True
+    httpd = ThreadingHTTPServer((opts.host, opts.port), RangeRequestHandler)
 
     if opts.ssl_cert:
         httpd.socket = ssl.wrap_socket(httpd.socket, certfile=opts.ssl_cert, server_side=True)
@@ -0,0 +1,487 @@
+"""
+In-process installation of wheels (PEP 427), so that PyPI resources which
+have already been fetched and verified as wheels can be installed without
+the overhead of running pip.
+
+Anything this can't handle (missing dependencies, upgrades of installed
+packages, incompatible wheels, or ``pkg_resources`` not being available) is
+reported by :func:`install_wheels` returning ``False``, before anything has
+been installed, so that the caller can fall back to pip.
+"""
+import base64
+import csv
+import hashlib
+import multiprocessing
+import os
+import py_compile
+import re
+import shutil
+import sys
+import sysconfig
+import tarfile
+import zipfile
+from email.parser import Parser
+from multiprocessing.pool import ThreadPool
+
+try:
+    import pkg_resources
+except ImportError:
+    pkg_resources = None
+
+try:
+    from packaging.tags import sys_tags
+except ImportError:
+    sys_tags = None
+
+try:
+    from importlib.util import cache_from_source  # Python 3
+except ImportError:
+    cache_from_source = None
+
+
+INSTALLER = 'jujuresources'
+WHEEL_RE = re.compile(
+    r'^(?P<name>[^-]+)-(?P<version>[^-]+)(?:-(?P<build>\d[^-]*))?'
+    r'-(?P<pyver>[^-]+)-(?P<abi>[^-]+)-(?P<plat>[^-]+)\.whl$')
+SCRIPT_TEMPLATE = '''#!{executable}
+# -*- coding: utf-8 -*-
+import re
+import sys
+
+from {module} import {name}
+
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\\.pyw|\\.exe)?$', '', sys.argv[0])
+    sys.exit({call}())
+'''
+
+_supported_tags = None
+
+
+def canonical_name(name):
+    """
+    Normalize a project name as per PEP 503.
+    """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def parse_wheel_filename(filename):
+    """
+    Split a wheel file name into its name, version, build, and tags, or
+    return ``None`` if it isn't a wheel.
+    """
+    match = WHEEL_RE.match(os.path.basename(filename))
+    return match.groupdict() if match else None
+
+
+def compatible(filename):
+    """
+    Whether the wheel can be installed for the running interpreter.
+    """
+    global _supported_tags
+    info = parse_wheel_filename(filename)
+    if not info:
+        return False
+    tags = set('-'.join([pyver, abi, plat])
+               for pyver in info['pyver'].split('.')
+               for abi in info['abi'].split('.')
+               for plat in info['plat'].split('.'))
+    if sys_tags is not None:
+        if _supported_tags is None:
+            _supported_tags = set(str(tag) for tag in sys_tags())
+        return bool(tags & _supported_tags)
+    # without packaging, only pure Python wheels can be recognized
+    major, minor = sys.version_info[:2]
+    return bool(tags & set('{}-none-any'.format(pyver) for pyver in (
+        'py{}'.format(major), 'py{}{}'.format(major, minor))))
+
+
+def requirements(filename, extras=()):
+    """
+    Return the requirements, as ``pkg_resources.Requirement``, of a wheel or
+    sdist which apply to this interpreter and the given extras, or ``None``
+    if they can't be determined.
+    """
+    if filename.endswith('.whl'):
+        with zipfile.ZipFile(filename) as zf:
+            metadata = zf.read(_dist_info(zf) + '/METADATA').decode('utf-8')
+        requires_txt = None
+    else:
+        metadata, requires_txt = _sdist_metadata(filename)
+        if metadata is None:
+            return None
+    metadata = Parser().parsestr(metadata)
+    requires_dist = metadata.get_all('Requires-Dist') or []
+    if not filename.endswith('.whl') and not requires_dist and requires_txt is None and \
+            not _static_requirements(metadata):
+        return None  # only setup.py knows
+    reqs = []
+    for line in requires_dist:
+        req = pkg_resources.Requirement.parse(line)
+        if not req.marker or any(req.marker.evaluate({'extra': extra}) for extra in ('',) + tuple(extras)):
+            reqs.append(req)
+    if requires_dist or not requires_txt:
+        return reqs
+    # older sdists only list their requirements in the egg-info
+    for section, lines in pkg_resources.split_sections(requires_txt):
+        extra, _, marker = (section or '').partition(':')
+        if extra and extra not in extras:
+            continue
+        if marker and not pkg_resources.evaluate_marker(marker):
+            continue
+        reqs.extend(pkg_resources.Requirement.parse(line) for line in lines)
+    return reqs
+
+
+def _static_requirements(metadata):
+    # from metadata 2.2, PKG-INFO fields are only left to setup.py if marked dynamic
+    try:
+        version = tuple(int(part) for part in (metadata.get('Metadata-Version') or '').split('.'))
+    except ValueError:
+        return False
+    dynamic = [field.strip().lower() for field in metadata.get_all('Dynamic') or []]
+    return version >= (2, 2) and 'requires-dist' not in dynamic
+
+
+def _sdist_metadata(filename):
+    """
+    Return the contents of the PKG-INFO and egg-info ``requires.txt`` of an
+    sdist, or ``None`` for either which it doesn't have.  If the sdist has
+    an egg-info without a ``requires.txt``, which setuptools only writes when
+    there are requirements, the latter is empty.
+    """
+    pkg_info_re = re.compile(r'^[^/]+/PKG-INFO$')
+    requires_re = re.compile(r'^[^/]+/(?:[^/]+/)?[^/]+\.egg-info/requires\.txt$')
+    egg_info_re = re.compile(r'^[^/]+/(?:[^/]+/)?[^/]+\.egg-info/PKG-INFO$')
+    patterns = (('pkg_info', pkg_info_re), ('requires', requires_re), ('egg_info', egg_info_re))
+    found = {}
+    try:
+        if zipfile.is_zipfile(filename):
+            with zipfile.ZipFile(filename) as zf:
+                for name in zf.namelist():
+                    for key, regex in patterns:
+                        if key not in found and regex.match(name):
+                            found[key] = zf.read(name)
+        else:
+            with tarfile.open(filename) as tf:
+                for member in tf:
+                    for key, regex in patterns:
+                        if key not in found and member.isfile() and regex.match(member.name):
+                            found[key] = tf.extractfile(member).read()
+    except (IOError, OSError, tarfile.TarError, zipfile.BadZipfile):
+        return None, None
+    if 'egg_info' in found:
+        found.setdefault('requires', b'')
+    return tuple(found[key].decode('utf-8') if key in found else None for key in ('pkg_info', 'requires'))
+
+
+def resolve(filenames, find_wheel=None, working_set=None, extras=None):
+    """
+    Work out which wheels need to be installed for ``filenames`` and all of
+    their dependencies, in dependency order.
+
+    :param list filenames: Wheels to install.
+    :param func find_wheel: Called with the name of a project which is
+        required but neither in ``filenames`` nor installed, and should
+        return the file name of a local wheel for it, or ``None``.
+    :param working_set: ``pkg_resources.WorkingSet`` of the installed
+        distributions (default: those on ``sys.path``).
+    :param dict extras: Extras requested for each of ``filenames``.
+    :return: The list of wheels to install, or ``None`` if that can't be
+        done without pip.
+    """
+    if pkg_resources is None:
+        return None
+    working_set = working_set if working_set is not None else pkg_resources.WorkingSet()
+    extras = extras or {}
+    planned = {}  # project -> [filename, version, extras handled]
+    order = []
+    todo = []
+
+    def plan(filename, requested):
+        info = parse_wheel_filename(filename)
+        if not info or not compatible(filename):
+            return False
+        key = canonical_name(info['name'])
+        version = info['version'].replace('_', '-')
+        installed = working_set.find(pkg_resources.Requirement.parse(key))
+        if installed is not None:
+            if installed.parsed_version != pkg_resources.parse_version(version) or requested:
+                # leave upgrades, downgrades, and the extras of installed packages to pip
+                return False
+            planned[key] = [None, version, set()]
+        else:
+            planned[key] = [filename, version, set()]
+            order.append(key)
+            todo.append((key, tuple(requested)))
+        return True
+
+    for filename in filenames:
+        if not plan(filename, extras.get(filename, ())):
+            return None
+    while todo:
+        key, requested = todo.pop()
+        filename, version, handled = planned[key]
+        handled.update(requested)
+        for req in requirements(filename, requested):
+            dep_key = canonical_name(req.project_name)
+            if dep_key in planned:
+                dep_filename, dep_version, dep_handled = planned[dep_key]
+                if dep_version not in req:
+                    return None
+                missing = set(req.extras) - dep_handled
+                if missing and not dep_filename:
+                    return None  # the installed version may lack the extra's dependencies
+                if missing:
+                    todo.append((dep_key, tuple(missing)))
+                continue
+            try:
+                if not req.extras and working_set.find(req) is not None:
+                    continue
+            except pkg_resources.VersionConflict:
+                return None
+            dep_filename = find_wheel(req.project_name) if find_wheel else None
+            if not dep_filename:
+                return None
+            info = parse_wheel_filename(dep_filename)
+            if not info or info['version'].replace('_', '-') not in req:
+                return None
+            if not plan(dep_filename, req.extras):
+                return None
+    # dependencies first, so a partially failed install leaves them usable
+    return [planned[key][0] for key in reversed(order)]
+
+
+def install_wheels(filenames, find_wheel=None, paths=None, max_workers=None, extras=None):
+    """
+    Install ``filenames`` and their dependencies, if they can all be
+    installed from local wheels.
+
+    Each wheel is unpacked into the ``paths`` (default: the ``sysconfig``
+    paths of the running interpreter, unless it is :func:`externally
+    managed <externally_managed>`), with ``INSTALLER`` and ``RECORD`` files
+    and scripts for its entry points, and then all of the unpacked modules
+    are byte-compiled across ``max_workers`` processes (default: one per
+    CPU).
+
+    Every wheel is checked before any is unpacked, and if unpacking fails
+    part way, the files written so far are removed again.
+
+    :return: ``False`` if the wheels couldn't be installed without pip, in
+        which case nothing has been installed.
+    :raises ValueError: If a wheel has files which can't be installed, in
+        which case nothing has been installed either.
+    """
+    if pkg_resources is None:
+        return False
+    if paths is None:
+        if externally_managed():
+            return False  # leave it to pip to refuse, or be told otherwise
+        paths = sysconfig.get_paths()
+        working_set = pkg_resources.WorkingSet()
+    else:
+        working_set = pkg_resources.WorkingSet(sorted(set([paths['purelib'], paths['platlib']])))
+    to_install = resolve(filenames, find_wheel, working_set, extras)
+    if to_install is None:
+        return False
+    for filename in to_install:
+        with zipfile.ZipFile(filename) as zf:
+            _layout(zf, filename, paths)
+    written = []
+    compiled = {}
+    try:
+        unpacked = [_unpack(filename, paths, written) for filename in to_install]
+        sources = [source for wheel in unpacked for source in wheel.sources]
+        compiled = compile_files(sources, max_workers)
+        for wheel in unpacked:
+            wheel.write_record(compiled)
+    except Exception:
+        _remove_written(written + list(compiled.values()))
+        raise
+    return True
+
+
+def externally_managed():
+    """
+    Whether the running interpreter's environment is marked, as per PEP 668,
+    as managed by the system's package manager, so that pip won't install
+    into it.  Virtual environments never are.
+    """
+    if hasattr(sys, 'real_prefix') or getattr(sys, 'base_prefix', sys.prefix) != sys.prefix:
+        return False
+    paths = sysconfig.get_paths()
+    return any(os.path.isfile(os.path.join(paths[key], 'EXTERNALLY-MANAGED')) for key in ('stdlib', 'purelib'))
+
+
+def compile_files(sources, max_workers=None):
+    """
+    Byte-compile each of ``sources`` in parallel.
+
+    :return: A mapping of each source to its compiled file, for those which
+        compiled successfully.
+    """
+    if not sources:
+        return {}
+    max_workers = min(max_workers or multiprocessing.cpu_count(), len(sources))
+    if max_workers <= 1:
+        results = [_compile(source) for source in sources]
+    else:
+        try:
+            pool = multiprocessing.Pool(max_workers)
+        except (OSError, ImportError):  # e.g., no working sem_open
+            pool = ThreadPool(max_workers)
+        try:
+            results = pool.map(_compile, sources)
+        finally:
+            pool.close()
+            pool.join()
+    return dict((source, cfile) for source, cfile in zip(sources, results) if cfile)
+
+
+def _compile(source):
+    # runs in a worker process
+    cfile = cache_from_source(source) if cache_from_source else source + 'c'
+    try:
+        py_compile.compile(source, cfile, doraise=True)
+    except (py_compile.PyCompileError, IOError, OSError):
+        return None
+    return cfile
+
+
+def _dist_info(zf):
+    for name in zf.namelist():
+        parts = name.split('/')
+        if len(parts) == 2 and parts[0].endswith('.dist-info') and parts[1] == 'WHEEL':
+            return parts[0]
+    raise ValueError('No .dist-info/WHEEL in wheel: {}'.format(zf.filename))
+
+
+def _record_hash(data):
+    digest = hashlib.sha256(data).digest()
+    return 'sha256=' + base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+class _Unpacked(object):
+    """
+    A wheel whose files have been installed, pending its ``RECORD``.
+    """
+    def __init__(self, root, dist_info, written=None):
+        self.root = root
+        self.dist_info = dist_info
+        self.rows = []
+        self.sources = []
+        self.written = [] if written is None else written  # to roll back a failed install
+
+    def _makedirs(self, directory):
+        if os.path.isdir(directory):
+            return
+        created = directory
+        while not os.path.isdir(os.path.dirname(created)):
+            created = os.path.dirname(created)
+        os.makedirs(directory)
+        self.written.append(created)
+
+    def add(self, path, hash='', size=''):
+        self.rows.append((self._relpath(path), hash, size))
+
+    def write_file(self, path, data, executable=False):
+        self._makedirs(os.path.dirname(path))
+        self.written.append(path)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        if executable:
+            os.chmod(path, os.stat(path).st_mode | 0o111)
+        self.add(path, _record_hash(data), len(data))
+
+    def write_record(self, compiled):
+        for source in self.sources:
+            if source in compiled:
+                with open(compiled[source], 'rb') as fp:
+                    data = fp.read()
+                self.add(compiled[source], _record_hash(data), len(data))
+        record = os.path.join(self.root, self.dist_info, 'RECORD')
+        self.written.append(record)
+        if sys.version_info[0] < 3:
+            fp = open(record, 'wb')
+        else:
+            fp = open(record, 'w', newline='')
+        with fp:
+            writer = csv.writer(fp)
+            for row in self.rows:
+                writer.writerow(row)
+            writer.writerow((self._relpath(record), '', ''))
+
+    def _relpath(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+
+def _layout(zf, filename, paths):
+    """
+    Return the root (``purelib`` or ``platlib``) and ``.dist-info``
+    directory of an open wheel, the member, target path, and ``.data``
+    scheme of each file to install, and the entry points to write scripts
+    for, raising :class:`ValueError` if any of it can't be installed.
+    """
+    dist_info = _dist_info(zf)
+    wheel = Parser().parsestr(zf.read(dist_info + '/WHEEL').decode('utf-8'))
+    purelib = (wheel.get('Root-Is-Purelib') or '').strip().lower() == 'true'
+    root = paths['purelib'] if purelib else paths['platlib']
+    data_dir = dist_info[:-len('.dist-info')] + '.data/'
+    files = []
+    for member in zf.infolist():
+        name = member.filename
+        if name.startswith('/') or '..' in name.split('/'):
+            raise ValueError('Unsafe path in wheel {}: {}'.format(filename, name))
+        if name.endswith('/'):
+            continue
+        if name in (dist_info + '/RECORD', dist_info + '/RECORD.jws', dist_info + '/RECORD.p7s'):
+            continue
+        scheme = None
+        if name.startswith(data_dir):
+            parts = name[len(data_dir):].split('/', 1)
+            if len(parts) != 2 or parts[0] not in paths:
+                raise ValueError('Unknown data path in wheel {}: {}'.format(filename, name))
+            scheme = parts[0]
+            target = os.path.join(paths[scheme], *parts[1].split('/'))
+        else:
+            target = os.path.join(root, *name.split('/'))
+        files.append((member, target, scheme))
+    scripts = []
+    entry_points = dist_info + '/entry_points.txt'
+    if entry_points in zf.namelist():
+        groups = pkg_resources.EntryPoint.parse_map(zf.read(entry_points).decode('utf-8'))
+        for group in ('console_scripts', 'gui_scripts'):
+            scripts.extend(groups.get(group, {}).values())
+    return root, dist_info, files, scripts
+
+
+def _unpack(filename, paths, written=None):
+    with zipfile.ZipFile(filename) as zf:
+        root, dist_info, files, scripts = _layout(zf, filename, paths)
+        unpacked = _Unpacked(root, dist_info, written)
+        for member, target, scheme in files:
+            data = zf.read(member)
+            if scheme == 'scripts' and data.startswith(b'#!python'):
+                data = b'#!' + sys.executable.encode(sys.getfilesystemencoding()) + data[len('#!python'):]
+            executable = scheme == 'scripts' or bool((member.external_attr >> 16) & 0o111)
+            unpacked.write_file(target, data, executable)
+            if target.endswith('.py') and scheme in (None, 'purelib', 'platlib'):
+                unpacked.sources.append(target)
+        for entry_point in scripts:
+            script = SCRIPT_TEMPLATE.format(
+                executable=sys.executable,
+                module=entry_point.module_name,
+                name=entry_point.attrs[0],
+                call='.'.join(entry_point.attrs))
+            unpacked.write_file(os.path.join(paths['scripts'], entry_point.name),
+                                script.encode('utf-8'), executable=True)
+        unpacked.write_file(os.path.join(root, dist_info, 'INSTALLER'), (INSTALLER + '\n').encode('ascii'))
+    return unpacked
+
+
+def _remove_written(paths):
+    for path in reversed(paths):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.lexists(path):
+            os.remove(path)
@@ -28,6 +28,7 @@ SETUP = {
             'fetch = jujuresources.cli:fetch',
             'verify = jujuresources.cli:verify',
             'serve = jujuresources.cli:serve',
+            'fetch_and_install = jujuresources.cli:fetch_and_install',
             'resource_path = jujuresources.cli:resource_path',
         ],
     },
@@ -1,6 +1,9 @@
 import mock
 import os
+import shutil
+import time
 import unittest
+from tempfile import mkdtemp
 
 import jujuresources
 
@@ -83,6 +86,27 @@ class TestAPI(unittest.TestCase):
         self.assertItemsEqual(jujuresources._invalid(self.resources, None), ['invalid', 'py-invalid'])
         self.assertItemsEqual(jujuresources._invalid(self.resources, []), ['invalid', 'py-invalid'])
 
+    def test_invalid_parallel(self):
+        self.assertItemsEqual(jujuresources._invalid(self.resources, jujuresources.ALL, max_workers=4),
+                              ['invalid', 'py-invalid', 'opt-invalid'])
+        self.resources['valid'].verify.assert_called_once_with(False)
+
+    def test_invalid_processes(self):
+        tmpdir = mkdtemp()
+        try:
+            shutil.copy(os.path.join(self.test_data, 'res-defaults.yaml'), tmpdir)
+            resources = jujuresources.backend.ResourceContainer(tmpdir)
+            for name, hash in [('valid', '4f08575d804517cea2265a7d43022771'), ('invalid', 'deadbeef')]:
+                resources.add_required(name, {
+                    'file': 'res-defaults.yaml',
+                    'hash': hash,
+                    'hash_type': 'md5',
+                })
+            self.assertEqual(jujuresources._invalid(resources, None, max_workers=2, processes=True),
+                             set(['invalid']))
+        finally:
+            shutil.rmtree(tmpdir)
+
     @mock.patch('jujuresources._invalid')
     def test_fetch(self, minvalid):
         minvalid.return_value = set(['invalid'])
@@ -113,6 +137,38 @@ class TestAPI(unittest.TestCase):
         ], any_order=True)
         self.assertNotIn(mock.call('valid'), reporthook.call_args_list)
 
+    @mock.patch('jujuresources._invalid')
+    def test_fetch_parallel(self, minvalid):
+        reporthook = mock.Mock()
+        minvalid.return_value = set(['invalid', 'py-invalid', 'opt-invalid'])
+        jujuresources._fetch(self.resources, jujuresources.ALL, 'mirror',
+                             reporthook=reporthook, max_workers=4)
+        self.resources['invalid'].fetch.assert_called_once_with('mirror')
+        self.resources['py-invalid'].fetch.assert_called_once_with('mirror')
+        self.resources['opt-invalid'].fetch.assert_called_once_with('mirror')
+        assert not self.resources['valid'].fetch.called
+        assert not self.resources['py-valid'].fetch.called
+        expected = [mock.call(r.name) for r in self.resources.subset(jujuresources.ALL)
+                    if 'invalid' in r.name]
+        self.assertEqual(reporthook.call_args_list, expected)
+
+    @mock.patch('jujuresources._invalid')
+    def test_fetch_parallel_pypi_serial(self, minvalid):
+        minvalid.return_value = set(['invalid', 'py-valid', 'py-invalid'])
+        active = []
+        overlapped = []
+
+        def fetch(mirror_url):
+            active.append(1)
+            overlapped.append(len(active) > 1)
+            time.sleep(0.05)
+            active.pop()
+        self.resources['py-valid'].fetch.side_effect = fetch
+        self.resources['py-invalid'].fetch.side_effect = fetch
+        jujuresources._fetch(self.resources, None, 'mirror', max_workers=4)
+        self.resources['invalid'].fetch.assert_called_once_with('mirror')
+        self.assertEqual(overlapped, [False, False])
+
     @mock.patch.object(jujuresources, '_load')
     def test_resource_path(self, mload):
         mload.return_value = self.resources
@@ -123,12 +179,13 @@ class TestAPI(unittest.TestCase):
         minstall_group.return_value = False
         success = jujuresources._install(self.resources, None, 'mirror', 'dest', True)
         assert not success
-        self.resources['valid'].install.assert_called_with('dest', True)
+        self.resources['valid'].install.assert_called_with(
+            'dest', True, verified=True, max_workers=1, install_mode=None, cache_dir=None)
         assert not self.resources['py-valid'].install.called
-        self.resources['invalid'].install.assert_called_with('dest', True)
+        assert not self.resources['invalid'].install.called
         assert not self.resources['py-invalid'].install.called
         assert not self.resources['opt-invalid'].install.called
-        minstall_group.assert_called_with(mock.ANY, 'mirror')
+        minstall_group.assert_called_with(mock.ANY, 'mirror', ['py-valid'])
         self.assertItemsEqual(
             minstall_group.call_args_list[0][0][0],
             [self.resources['py-valid'], self.resources['py-invalid']])
@@ -137,6 +194,65 @@ class TestAPI(unittest.TestCase):
         minstall_group.return_value = True
         assert jujuresources._install(self.resources, ['valid', 'py-valid'], 'mirror', 'dest', True)
 
+    @mock.patch('jujuresources._fetch')
+    @mock.patch('jujuresources.backend.PyPIResource.install_group')
+    def test_fetch_and_install(self, minstall_group, mfetch):
+        minstall_group.return_value = True
+        for resource in self.resources.all():
+            resource.fetch_and_install = mock.Mock(return_value=True)
+        assert jujuresources._fetch_and_install(self.resources, None, 'mirror', 'dest', True, True)
+        self.resources['valid'].install.assert_called_once_with('dest', True, verified=True)
+        assert not self.resources['valid'].fetch_and_install.called
+        self.resources['invalid'].fetch_and_install.assert_called_once_with('dest', 'mirror', True, True)
+        assert not self.resources['py-invalid'].fetch_and_install.called
+        mfetch.assert_called_once_with(self.resources, ['py-invalid', 'py-valid'], 'mirror')
+        minstall_group.assert_called_once_with(mock.ANY, 'mirror', ['py-valid'])
+        self.assertEqual(self.resources.state('invalid'), jujuresources.backend.VERIFIED)
+
+    def test_verify_state(self):
+        resources = self.resources
+        self.assertEqual(resources.state('valid'), jujuresources.backend.UNKNOWN)
+        assert resources.verify('valid')
+        assert not resources.verify('invalid')
+        assert resources.verify('valid')
+        assert not resources.verify('invalid')
+        self.assertEqual(resources['valid'].verify.call_count, 1)
+        self.assertEqual(resources['invalid'].verify.call_count, 1)
+        self.assertEqual(resources.state('valid'), jujuresources.backend.VERIFIED)
+        self.assertEqual(resources.state('invalid'), jujuresources.backend.INVALID)
+        assert resources.verify('valid', deep=True)
+        self.assertEqual(resources['valid'].verify.call_count, 2)
+
+    def test_state_follows_file(self):
+        tmpdir = mkdtemp()
+        try:
+            shutil.copy(os.path.join(self.test_data, 'res-defaults.yaml'), tmpdir)
+            resources = jujuresources.backend.ResourceContainer(tmpdir)
+            resources.add_required('res', {
+                'file': 'res-defaults.yaml',
+                'hash': '4f08575d804517cea2265a7d43022771',
+                'hash_type': 'md5',
+            })
+            assert resources.verify('res')
+            with mock.patch.object(jujuresources.backend, 'hash_file_digests') as mhash:
+                assert resources.verify('res')
+                self.assertEqual(jujuresources._invalid(resources, None), set())
+                assert not mhash.called
+            with open(resources['res'].destination, 'a') as fp:
+                fp.write('changed')
+            self.assertEqual(resources.state('res'), jujuresources.backend.UNKNOWN)
+            assert not resources.verify('res')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_fetch_state(self):
+        self.resources['invalid'].fetch.return_value = True
+        self.resources['opt-invalid'].fetch.return_value = None
+        self.resources.fetch('invalid', 'mirror')
+        self.resources.fetch('opt-invalid', 'mirror')
+        self.assertEqual(self.resources.state('invalid'), jujuresources.backend.VERIFIED)
+        self.assertEqual(self.resources.state('opt-invalid'), jujuresources.backend.UNKNOWN)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,27 @@
 #!/usr/bin/env python
 
+import errno
+import gzip
+import hashlib
+import io
+import json
 import mock
 import os
+import re
 import unittest
 import shutil
 import subprocess
-from tempfile import mkdtemp
+import sys
+import tarfile
+import threading
+from tempfile import mkdtemp, mkstemp
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # Python 3
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # Python 2
+    from SocketServer import ThreadingMixIn
 
 from jujuresources import backend
 
@@ -14,6 +30,178 @@ if not hasattr(unittest.TestCase, 'assertItemsEqual'):
     unittest.TestCase.assertItemsEqual = unittest.TestCase.assertCountEqual
 
 
+class FakeResponse(io.BytesIO):
+    """
+    Stand-in for the file-like object returned by ``urlopen``.
+    """
+    def __init__(self, data, code=200, headers=None):
+        io.BytesIO.__init__(self, data)
+        self.code = code
+        self.headers = headers or {}
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+
+def requested_urls(murlopen):
+    return [c[0][0].get_full_url() if hasattr(c[0][0], 'get_full_url') else c[0][0]
+            for c in murlopen.call_args_list]
+
+
+def remove_verified(path):
+    """
+    Clean up the verification records left next to the test data.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            if filename.endswith('.verified'):
+                os.remove(os.path.join(dirpath, filename))
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/data')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        code, body = (200, b'hello\nworld\n') if self.path == '/data' else (404, b'missing')
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.url = 'http://127.0.0.1:{}/'.format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.start()
+        self.pool = backend.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def test_reuse(self):
+        for i in range(3):
+            resp = self.pool.urlopen(self.url + 'data')
+            self.assertEqual(resp.getcode(), 200)
+            self.assertEqual(resp.read(), b'hello\nworld\n')
+            resp.close()
+        stats = self.pool.stats()[self.url.rstrip('/')]
+        self.assertEqual(stats, {'connections': 1, 'requests': 3, 'reused': 2})
+
+    def test_unread_response_not_reused(self):
+        self.pool.urlopen(self.url + 'data').close()
+        self.pool.urlopen(self.url + 'data').close()
+        self.assertEqual(list(self.pool.stats().values())[0]['connections'], 2)
+
+    def test_redirect(self):
+        resp = self.pool.urlopen(backend.Request(self.url + 'redirect'))
+        self.assertEqual(resp.geturl(), self.url + 'data')
+        self.assertEqual(list(resp), [b'hello\n', b'world\n'])
+        resp.close()
+        self.assertEqual(list(self.pool.stats().values())[0]['reused'], 1)
+
+    def test_error(self):
+        with self.assertRaises(backend.HTTPError) as cm:
+            self.pool.urlopen(self.url + 'missing')
+        self.assertEqual(cm.exception.code, 404)
+
+    def test_per_host_limit(self):
+        pool = backend.ConnectionPool(max_per_host=1)
+        first = pool.urlopen(self.url + 'data')
+        opened = threading.Event()
+
+        def second():
+            pool.urlopen(self.url + 'data').close()
+            opened.set()
+        thread = threading.Thread(target=second)
+        thread.start()
+        assert not opened.wait(0.2)
+        first.read()
+        first.close()
+        thread.join()
+        assert opened.is_set()
+        pool.close()
+
+    @mock.patch.object(backend, 'urllib_urlopen')
+    def test_other_schemes(self, murlopen):
+        self.assertIs(self.pool.urlopen('file:///tmp/foo'), murlopen.return_value)
+        self.assertEqual(murlopen.call_args[0][0].get_full_url(), 'file:///tmp/foo')
+
+
+class TestHashFile(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = mkstemp()
+        self.data = os.urandom(100 * 1024 + 7)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(self.data)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_mmap(self):
+        self.assertEqual(backend.hash_file(self.filename, 'sha256', 4096),
+                         hashlib.sha256(self.data).hexdigest())
+
+    @mock.patch.object(backend.mmap, 'mmap')
+    def test_readinto(self, mmmap):
+        mmmap.side_effect = EnvironmentError('cannot map')
+        self.assertEqual(backend.hash_file(self.filename, 'md5', 4096),
+                         hashlib.md5(self.data).hexdigest())
+        assert mmmap.called
+
+    def test_empty(self):
+        with open(self.filename, 'wb'):
+            pass
+        self.assertEqual(backend.hash_file(self.filename, 'md5'), hashlib.md5().hexdigest())
+
+    @mock.patch.object(backend, 'HASH_BUFFER_SIZE', 1)
+    def test_benchmark_hash_buffer(self):
+        size = backend.benchmark_hash_buffer('md5', [1024, 4096], sample_size=64 * 1024, rounds=1)
+        self.assertIn(size, [1024, 4096])
+        self.assertEqual(backend.HASH_BUFFER_SIZE, size)
+        backend.benchmark_hash_buffer('md5', [512], sample_size=1024, rounds=1, apply=False)
+        self.assertEqual(backend.HASH_BUFFER_SIZE, size)
+
+    @mock.patch.object(backend, 'HASH_BENCHMARK_THRESHOLD', 1024)
+    @mock.patch.object(backend, 'HASH_BUFFER_SIZE', None)
+    @mock.patch.object(backend, 'benchmark_hash_buffer')
+    def test_hash_buffer_benchmarked(self, mbenchmark):
+        def benchmark(**kwargs):
+            backend.HASH_BUFFER_SIZE = 4096
+        mbenchmark.side_effect = benchmark
+        with open(self.filename, 'wb') as fp:
+            fp.write(b'x' * 100)
+        backend.hash_file(self.filename, 'md5')
+        assert not mbenchmark.called  # too small to be worth it
+        self.assertIsNone(backend.HASH_BUFFER_SIZE)
+        with open(self.filename, 'wb') as fp:
+            fp.write(b'x' * 2048)
+        self.assertEqual(backend.hash_file(self.filename, 'md5'), hashlib.md5(b'x' * 2048).hexdigest())
+        backend.hash_file(self.filename, 'md5')
+        mbenchmark.assert_called_once_with(sample_size=8 * 1024 * 1024, rounds=1)
+        self.assertEqual(backend.HASH_BUFFER_SIZE, 4096)
+
+
 class TestResourceContainer(unittest.TestCase):
     @mock.patch.object(backend.Resource, 'get')
     def test_add_required(self, mget):
@@ -64,6 +252,9 @@ class TestResourceContainer(unittest.TestCase):
 class TestResource(unittest.TestCase):
     test_data = os.path.join(os.path.dirname(__file__), 'data')
 
+    def tearDown(self):
+        remove_verified(self.test_data)
+
     def test_get(self):
         self.assertIsInstance(
             backend.Resource.get('name', {'url': 'foo'}, 'od'),
@@ -133,6 +324,70 @@ class TestResource(unittest.TestCase):
         }, self.test_data)
         assert not res.verify()
 
+    def test_verify_cached(self):
+        tmpdir = mkdtemp()
+        try:
+            shutil.copy(os.path.join(self.test_data, 'res-defaults.yaml'), tmpdir)
+            res = backend.Resource('name', {
+                'file': 'res-defaults.yaml',
+                'hash': '4f08575d804517cea2265a7d43022771',
+                'hash_type': 'md5',
+            }, tmpdir)
+            assert res.verify()
+            assert os.path.exists(res.destination + '.verified')
+            with mock.patch.object(backend.hashlib, 'new') as mnew:
+                assert res.verify()
+                assert not mnew.called
+                res.verify(deep=True)
+                assert mnew.called
+            with open(res.destination, 'a') as fp:
+                fp.write('changed')
+            assert not res.verify()
+            assert not os.path.exists(res.destination + '.verified')
+            res.hash = 'deadbeef'
+            record = dict(res._verification_record(), digests={'md5': 'deadbeef'})
+            with mock.patch.object(res, '_load_verification', return_value=record):
+                assert res.verify()  # trusts the matching record
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_init_hashes(self):
+        res = backend.Resource('name', {
+            'file': 'fn',
+            'hashes': {'md5': 'h1', 'sha256': 'h2', 'sha1': 'h3'},
+        }, 'od')
+        self.assertEqual(res.hash_type, 'sha256')
+        self.assertEqual(res.hash, 'h2')
+        self.assertEqual(res.expected_digests(), {'md5': 'h1', 'sha256': 'h2', 'sha1': 'h3'})
+        res = backend.Resource('name', {
+            'file': 'fn',
+            'hash': 'h0',
+            'hash_type': 'md5',
+            'hashes': {'sha256': 'h2'},
+        }, 'od')
+        self.assertEqual(res.hash_type, 'md5')
+        self.assertEqual(res.expected_digests(), {'md5': 'h0', 'sha256': 'h2'})
+
+    def test_verify_multiple_hashes(self):
+        tmpdir = mkdtemp()
+        try:
+            shutil.copy(os.path.join(self.test_data, 'res-defaults.yaml'), tmpdir)
+            with open(os.path.join(tmpdir, 'res-defaults.yaml'), 'rb') as fp:
+                sha256 = hashlib.sha256(fp.read()).hexdigest()
+            res = backend.Resource('name', {
+                'file': 'res-defaults.yaml',
+                'hashes': {'md5': '4f08575d804517cea2265a7d43022771', 'sha256': sha256},
+            }, tmpdir)
+            with mock.patch.object(backend, 'open', side_effect=open, create=True) as mopen:
+                assert res.verify()
+                reads = [c for c in mopen.call_args_list if c[0] == (res.destination, 'rb')]
+                self.assertEqual(len(reads), 1)
+            self.assertEqual(res.verified_digests(), {'md5': '4f08575d804517cea2265a7d43022771', 'sha256': sha256})
+            res.hash = 'deadbeef'
+            assert not res.verify()
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_install_invalid(self):
         res = backend.Resource('name', {
             'file': 'res-defaults.yaml',
@@ -155,7 +410,7 @@ class TestResource(unittest.TestCase):
         tmpdir = mkdtemp()
         try:
             assert res.install(tmpdir)
-            self.assertItemsEqual(os.listdir(tmpdir), ['toplevel'])
+            self.assertItemsEqual(os.listdir(tmpdir), ['toplevel', '.jujuresources.name.json'])
             self.assertItemsEqual(os.listdir(os.path.join(tmpdir, 'toplevel')), ['foo', 'bar'])
         finally:
             shutil.rmtree(tmpdir)
@@ -170,18 +425,153 @@ class TestResource(unittest.TestCase):
         os.rmdir(tmpdir)
         try:
             assert res.install(tmpdir, skip_top_level=True)
-            self.assertItemsEqual(os.listdir(tmpdir), ['foo', 'bar'])
+            self.assertItemsEqual(os.listdir(tmpdir), ['foo', 'bar', '.jujuresources.name.json'])
             self.assertItemsEqual(os.listdir(os.path.join(tmpdir, 'bar')), ['qux'])
         finally:
             shutil.rmtree(tmpdir)
 
-    @mock.patch('tarfile.is_tarfile', mock.Mock(return_value=False))
+    def _fat_tarfile_open(self, name, mode='r', *args, **kwargs):
+        if mode.startswith('r:'):
+            raise tarfile.ReadError('file could not be opened successfully')
+        return self._tarfile_open(name, mode, *args, **kwargs)
+
     def test_install_tgz_workaround(self):
-        self.test_install_tgz()
+        self._tarfile_open = tarfile.open
+        with mock.patch('tarfile.open', side_effect=self._fat_tarfile_open), \
+                mock.patch.object(backend, 'EXTERNAL_DECOMPRESSORS', False), \
+                mock.patch.object(subprocess, 'check_call') as mcheck_call:
+            self.test_install_tgz()
+            self.test_install_tgz_skip_top_level()
+            assert not mcheck_call.called
+
+    def test_sniff_archive(self):
+        data = self.test_data
+        self.assertEqual(backend.sniff_archive(os.path.join(data, 'test.tgz')), 'tar.gz')
+        self.assertEqual(backend.sniff_archive(os.path.join(data, 'test.zip')), 'zip')
+        self.assertEqual(backend.sniff_archive(os.path.join(data, 'res-defaults.yaml')), None)
+        tmpdir = mkdtemp()
+        try:
+            with tarfile.open(os.path.join(data, 'test.tgz')) as tf:
+                members = tf.getmembers()
+                for fmt, name in [(tarfile.USTAR_FORMAT, 'tar'), (tarfile.GNU_FORMAT, 'tar'),
+                                  (tarfile.PAX_FORMAT, 'tar')]:
+                    filename = os.path.join(tmpdir, 'test-{}.tar'.format(fmt))
+                    with tarfile.open(filename, 'w', format=fmt) as out:
+                        for member in members:
+                            out.addfile(member, tf.extractfile(member) if member.isfile() else None)
+                    self.assertEqual(backend.sniff_archive(filename), name)
+            block = bytearray(tarfile.BLOCKSIZE)
+            block[:4] = b'name'
+            block[148:156] = b'        '
+            block[148:155] = '{:06o}\x00'.format(sum(block)).encode('ascii')
+            filename = os.path.join(tmpdir, 'v7.tar')
+            with open(filename, 'wb') as fp:
+                fp.write(bytes(block))
+            self.assertEqual(backend.sniff_archive(filename), 'tar')  # pre-POSIX, no magic
+            for compression, magic in [('bz2', b'BZh'), ('xz', b'\xfd7zXZ\x00'),
+                                       ('zst', b'\x28\xb5\x2f\xfd'), ('lz4', b'\x04\x22\x4d\x18')]:
+                filename = os.path.join(tmpdir, 'test.' + compression)
+                with open(filename, 'wb') as fp:
+                    fp.write(magic + b'rest')
+                self.assertEqual(backend.sniff_archive(filename), 'tar.' + compression)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _compressed_tars(self, tmpdir):
+        """
+        Repack test.tgz with each compression for which a tool is installed.
+        """
+        tarname = os.path.join(tmpdir, 'test.tar')
+        with gzip.open(os.path.join(self.test_data, 'test.tgz')) as fin, open(tarname, 'wb') as fout:
+            fout.write(fin.read())
+        tars = {'tar': tarname}
+        for archive_format, command in [('tar.gz', ['gzip', '-kq']), ('tar.xz', ['xz', '-kq']),
+                                        ('tar.zst', ['zstd', '-q']), ('tar.lz4', ['lz4', '-q'])]:
+            if backend._which(command[0]):
+                filename = '{}.{}'.format(tarname, archive_format.split('.')[1])
+                if command[0] == 'lz4':
+                    subprocess.check_call(command + [tarname, filename])
+                else:
+                    subprocess.check_call(command + [tarname])
+                tars[archive_format] = filename
+        return tars
+
+    def test_install_extractors(self):
+        tmpdir = mkdtemp()
+        try:
+            expected = os.path.join(tmpdir, 'expected')
+            backend.Resource('name', {'file': 'test.tgz', 'skip_hash': True}, self.test_data).install(expected)
+            for archive_format, filename in self._compressed_tars(tmpdir).items():
+                self.assertEqual(backend.sniff_archive(filename), archive_format)
+                res = backend.Resource('name', {'file': filename, 'skip_hash': True}, tmpdir)
+                for external in (True, False):
+                    if archive_format in ('tar.zst', 'tar.lz4') and not external and sys.version_info < (3, 14):
+                        with mock.patch.object(backend, 'EXTERNAL_DECOMPRESSORS', external):
+                            self.assertRaises(ValueError, res.install, os.path.join(tmpdir, 'out'))
+                        continue
+                    dest = os.path.join(tmpdir, '{}-{}'.format(archive_format, external))
+                    with mock.patch.object(backend, 'EXTERNAL_DECOMPRESSORS', external), \
+                            mock.patch.object(subprocess, 'Popen', wraps=subprocess.Popen) as mpopen:
+                        assert res.install(dest, max_workers=2)
+                    command = backend.EXTRACTORS[archive_format].command
+                    self.assertEqual(mpopen.called, bool(external and command and backend._which(command[0])))
+                    self.assertEqual(self._extracted(dest), self._extracted(expected))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_extractor_command_fallback(self):
+        tmpdir = mkdtemp()
+        try:
+            extractor = backend.TarExtractor('gz', ['false'])
+            assert extractor(os.path.join(self.test_data, 'test.tgz'), tmpdir)
+            self.assertItemsEqual(os.listdir(os.path.join(tmpdir, 'toplevel')), ['foo', 'bar'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @mock.patch.object(backend, 'EXTRACTORS', dict(backend.EXTRACTORS))
+    @mock.patch.object(backend, 'ARCHIVE_MAGIC', list(backend.ARCHIVE_MAGIC))
+    def test_register_extractor(self):
+        tmpdir = mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'file.custom')
+            with open(filename, 'wb') as fp:
+                fp.write(b'CUSTOMdata')
+            extractor = mock.Mock(return_value=True)
+            backend.register_extractor('custom', extractor, b'CUSTOM')
+            self.assertEqual(backend.sniff_archive(filename), 'custom')
+            res = backend.Resource('name', {'file': filename, 'skip_hash': True}, tmpdir)
+            assert res.install(os.path.join(tmpdir, 'dest'), skip_top_level=True)
+            extractor.assert_called_once_with(filename, os.path.join(tmpdir, 'dest'), True,
+                                              max_workers=1, member_filter=mock.ANY)
+            self.assertEqual(os.listdir(os.path.join(tmpdir, 'dest')), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_install_compressed_file(self):
+        tmpdir = mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'file.gz')
+            with gzip.open(filename, 'wb') as fp:
+                fp.write(b'not a tar file\n' * 100)  # more than a tar block
+            res = backend.Resource('name', {'file': filename, 'skip_hash': True}, tmpdir)
+            assert res.install(os.path.join(tmpdir, 'dest'))
+            self.assertEqual(os.listdir(os.path.join(tmpdir, 'dest')), ['file.gz'])
 
-    @mock.patch('tarfile.is_tarfile', mock.Mock(return_value=False))
-    def test_install_tgz_skip_top_level_workaround(self):
-        self.test_install_tgz_skip_top_level()
+            # formats which tarfile may only read with the external tool
+            with open(os.path.join(tmpdir, 'file'), 'wb') as fp:
+                fp.write(b'not a tar file\n' * 100)
+            for command, ext in [('zstd', 'zst'), ('lz4', 'lz4')]:
+                if not backend._which(command):
+                    continue
+                filename = os.path.join(tmpdir, 'file.' + ext)
+                subprocess.check_call([command, '-q', os.path.join(tmpdir, 'file'), filename])
+                self.assertEqual(backend.sniff_archive(filename), 'tar.' + ext)
+                res = backend.Resource('name', {'file': filename, 'skip_hash': True}, tmpdir)
+                dest = os.path.join(tmpdir, 'dest-' + ext)
+                assert res.install(dest)
+                self.assertEqual(os.listdir(dest), ['file.' + ext])
+        finally:
+            shutil.rmtree(tmpdir)
 
     def test_install_zip(self):
         res = backend.Resource('name', {
@@ -192,7 +582,7 @@ class TestResource(unittest.TestCase):
         tmpdir = mkdtemp()
         try:
             assert res.install(tmpdir)
-            self.assertItemsEqual(os.listdir(tmpdir), ['toplevel'])
+            self.assertItemsEqual(os.listdir(tmpdir), ['toplevel', '.jujuresources.name.json'])
             self.assertItemsEqual(os.listdir(os.path.join(tmpdir, 'toplevel')), ['foo', 'bar'])
         finally:
             shutil.rmtree(tmpdir)
@@ -206,7 +596,7 @@ class TestResource(unittest.TestCase):
         tmpdir = mkdtemp()
         try:
             assert res.install(tmpdir, skip_top_level=True)
-            self.assertItemsEqual(os.listdir(tmpdir), ['foo', 'bar'])
+            self.assertItemsEqual(os.listdir(tmpdir), ['foo', 'bar', '.jujuresources.name.json'])
             self.assertItemsEqual(os.listdir(os.path.join(tmpdir, 'bar')), ['qux'])
         finally:
             shutil.rmtree(tmpdir)
@@ -220,10 +610,246 @@ class TestResource(unittest.TestCase):
         tmpdir = mkdtemp()
         try:
             assert res.install(tmpdir)
-            self.assertEqual(os.listdir(tmpdir), ['res-defaults.yaml'])
+            self.assertItemsEqual(os.listdir(tmpdir), ['res-defaults.yaml', '.jujuresources.name.json'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_install_link(self):
+        tmpdir = mkdtemp()
+        try:
+            src = os.path.join(tmpdir, 'src.jar')
+            with open(src, 'wb') as fp:
+                fp.write(b'jar')
+            res = backend.Resource('name', {'file': src, 'install_mode': 'link', 'skip_hash': True}, tmpdir)
+            assert res.install(os.path.join(tmpdir, 'linked'))
+            self.assertTrue(os.path.samefile(src, os.path.join(tmpdir, 'linked', 'src.jar')))
+            assert res.install(os.path.join(tmpdir, 'copied'), install_mode='copy')
+            self.assertFalse(os.path.samefile(src, os.path.join(tmpdir, 'copied', 'src.jar')))
+            with open(os.path.join(tmpdir, 'copied', 'src.jar'), 'rb') as fp:
+                self.assertEqual(fp.read(), b'jar')
+            self.assertRaises(ValueError, res.install, tmpdir, install_mode='symlink')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_copy_file(self):
+        tmpdir = mkdtemp()
+        try:
+            src = os.path.join(tmpdir, 'src')
+            dst = os.path.join(tmpdir, 'dst')
+            with open(src, 'wb') as fp:
+                fp.write(b'x' * 100000)
+            os.chmod(src, 0o640)
+            self.assertIn(backend.copy_file(src, dst), ('clone', 'copy_file_range', 'sendfile', 'copy'))
+            with open(dst, 'rb') as fp:
+                self.assertEqual(fp.read(), b'x' * 100000)
+            self.assertEqual(os.stat(dst).st_mode & 0o777, 0o640)
+            self.assertFalse(os.path.samefile(src, dst))
+
+            # each method falls back to the next if it isn't supported
+            unsupported = OSError(errno.EXDEV, 'Invalid cross-device link')
+            with mock.patch.object(backend, 'fcntl', None), \
+                    mock.patch.object(os, 'copy_file_range', side_effect=unsupported, create=True), \
+                    mock.patch.object(os, 'sendfile', side_effect=unsupported, create=True):
+                self.assertEqual(backend.copy_file(src, dst), 'copy')
+            with open(dst, 'rb') as fp:
+                self.assertEqual(fp.read(), b'x' * 100000)
+
+            with mock.patch.object(os, 'link', side_effect=unsupported):
+                self.assertNotEqual(backend.copy_file(src, dst, link=True), 'link')
+            self.assertEqual(backend.copy_file(src, dst, link=True), 'link')
+            self.assertTrue(os.path.samefile(src, dst))
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['dst', 'src'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_install_current(self):
+        res = backend.Resource('name', {
+            'file': 'test.tgz',
+            'hash': '347153cce7f15a6d3e47d34fbccb6afa',
+            'hash_type': 'md5',
+        }, self.test_data)
+        tmpdir = mkdtemp()
+        try:
+            assert res.install(tmpdir)
+            with mock.patch.object(tarfile, 'open') as mopen:
+                assert res.install(tmpdir)
+                assert res.install(tmpdir, verified=True)
+                assert not mopen.called
+            os.remove(os.path.join(tmpdir, 'toplevel', 'foo'))
+            assert res.install(tmpdir)  # restores missing members
+            assert os.path.exists(os.path.join(tmpdir, 'toplevel', 'foo'))
+            with mock.patch('shutil.copy2') as mcopy:
+                assert res.install(tmpdir, skip_top_level=True)
+                assert not mcopy.called
+            # the old layout is removed when the layout changes
+            self.assertItemsEqual(os.listdir(tmpdir), ['foo', 'bar', '.jujuresources.name.json'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_install_incremental(self):
+        tmpdir = mkdtemp()
+        try:
+            srcdir = os.path.join(tmpdir, 'src')
+            destdir = os.path.join(tmpdir, 'dest')
+            archive = os.path.join(tmpdir, 'archive.tar')
+
+            def build(contents):
+                shutil.rmtree(srcdir, ignore_errors=True)
+                for name, data in contents.items():
+                    path = os.path.join(srcdir, 'top', name)
+                    if not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    with open(path, 'w') as fp:
+                        fp.write(data)
+                    os.utime(path, (1000000000, 1000000000))
+                with tarfile.open(archive, 'w') as tf:
+                    tf.add(os.path.join(srcdir, 'top'), 'top')
+                with open(archive, 'rb') as fp:
+                    return backend.Resource('name', {
+                        'file': archive,
+                        'hash': hashlib.md5(fp.read()).hexdigest(),
+                        'hash_type': 'md5',
+                    }, tmpdir)
+
+            res = build({'same': 'same', 'changed': 'old', 'sub/removed': 'removed'})
+            assert res.install(destdir, skip_top_level=True)
+            res = build({'same': 'same', 'changed': 'newer', 'added': 'added'})
+            extracted = []
+            original = tarfile.TarFile.extractall
+
+            def extractall(tf, path, members=None, *args, **kwargs):
+                members = list(members)
+                extracted.extend(m.name for m in members)
+                return original(tf, path, members, *args, **kwargs)
+            with mock.patch.object(tarfile.TarFile, 'extractall', extractall):
+                assert res.install(destdir, skip_top_level=True)
+            self.assertItemsEqual(extracted, ['changed', 'added'])
+            self.assertItemsEqual(os.listdir(destdir), ['same', 'changed', 'added', '.jujuresources.name.json'])
+            with open(os.path.join(destdir, 'changed')) as fp:
+                self.assertEqual(fp.read(), 'newer')
         finally:
             shutil.rmtree(tmpdir)
 
+    def _cached_resource(self, tmpdir, name, contents):
+        srcdir = os.path.join(tmpdir, 'src-' + name)
+        for member, data in contents.items():
+            path = os.path.join(srcdir, 'top', member)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fp:
+                fp.write(data)
+        archive = os.path.join(tmpdir, name + '.tgz')
+        with tarfile.open(archive, 'w:gz') as tf:
+            tf.add(os.path.join(srcdir, 'top'), 'top')
+        with open(archive, 'rb') as fp:
+            return backend.Resource(name, {
+                'file': archive,
+                'hash': hashlib.sha256(fp.read()).hexdigest(),
+                'hash_type': 'sha256',
+            }, tmpdir)
+
+    def test_install_cache(self):
+        tmpdir = mkdtemp()
+        try:
+            cache_dir = os.path.join(tmpdir, 'cache')
+            res = self._cached_resource(tmpdir, 'name', {'foo': 'foo', 'sub/bar': 'bar'})
+            assert res.install(os.path.join(tmpdir, 'first'), True, cache_dir=cache_dir)
+            key = 'sha256-{}-skip'.format(res.hash)
+            self.assertItemsEqual(os.listdir(cache_dir), [key, key + '.json'])
+            with mock.patch.dict(backend.EXTRACTORS, {'tar.gz': mock.Mock(return_value=True)}) as extractors:
+                assert res.install(os.path.join(tmpdir, 'second'), True, cache_dir=cache_dir, install_mode='link')
+                assert not extractors['tar.gz'].called
+            for dest in ('first', 'second'):
+                self.assertEqual(self._extracted(os.path.join(tmpdir, dest)), {
+                    'foo': b'foo',
+                    'sub': None,
+                    'sub/bar': b'bar',
+                    '.jujuresources.name.json': mock.ANY,
+                })
+            self.assertTrue(os.path.samefile(os.path.join(cache_dir, key, 'sub', 'bar'),
+                                             os.path.join(tmpdir, 'second', 'sub', 'bar')))
+            self.assertFalse(os.path.samefile(os.path.join(cache_dir, key, 'sub', 'bar'),
+                                              os.path.join(tmpdir, 'first', 'sub', 'bar')))
+            assert res.install(os.path.join(tmpdir, 'full'), cache_dir=cache_dir)
+            self.assertIn('sha256-{}-full'.format(res.hash), os.listdir(cache_dir))
+            self.assertEqual(self._extracted(os.path.join(tmpdir, 'full', 'top')),
+                             {'foo': b'foo', 'sub': None, 'sub/bar': b'bar'})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_extract_cache_orphaned_tree(self):
+        tmpdir = mkdtemp()
+        try:
+            cache = backend.ExtractCache(os.path.join(tmpdir, 'cache'))
+            res = self._cached_resource(tmpdir, 'name', {'foo': 'foo'})
+            key = res._cache_key(False)
+            # an interrupted add left the tree, but not its record
+            os.makedirs(os.path.join(cache.root, key, 'top'))
+            with open(os.path.join(cache.root, key, 'top', 'partial'), 'w') as fp:
+                fp.write('partial')
+            assert not cache.install(key, os.path.join(tmpdir, 'dest'))
+            assert cache.add(key, backend.EXTRACTORS['tar.gz'], res.destination)
+            self.assertItemsEqual(os.listdir(cache.root), [key, key + '.json'])
+            assert cache.install(key, os.path.join(tmpdir, 'dest'))
+            self.assertEqual(self._extracted(os.path.join(tmpdir, 'dest')), {'top': None, 'top/foo': b'foo'})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_extract_cache_evict(self):
+        tmpdir = mkdtemp()
+        try:
+            cache = backend.ExtractCache(os.path.join(tmpdir, 'cache'), max_size=250)
+            keys = []
+            for i, name in enumerate(('a', 'b', 'c')):
+                res = self._cached_resource(tmpdir, name, {'data': name * 100})
+                keys.append(res._cache_key(False))
+                assert cache.add(keys[-1], backend.EXTRACTORS['tar.gz'], res.destination)
+                os.utime(cache._record_file(keys[-1]), (1000 + i, 1000 + i))
+                if name == 'b':
+                    assert cache.install(keys[0], os.path.join(tmpdir, 'dest'))  # a is now more recent
+            self.assertItemsEqual(os.listdir(cache.root), [keys[0], keys[0] + '.json', keys[2], keys[2] + '.json'])
+            assert not cache.install(keys[1], os.path.join(tmpdir, 'dest'))
+            res = backend.Resource('name', {'file': res.destination, 'skip_hash': True}, tmpdir)
+            self.assertIsNone(res._cache_key(False))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _extracted(self, path):
+        tree = {}
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                fullname = os.path.join(dirpath, name)
+                relname = os.path.relpath(fullname, path)
+                if os.path.isdir(fullname):
+                    tree[relname] = None
+                else:
+                    with open(fullname, 'rb') as fp:
+                        tree[relname] = fp.read()
+        return tree
+
+    def test_install_parallel(self):
+        for filename, hash in [('test.tgz', '347153cce7f15a6d3e47d34fbccb6afa'),
+                               ('test.zip', '5c7b6a3c4bf38ac9d2f0ab0088fff1a9')]:
+            res = backend.Resource('name', {
+                'file': filename,
+                'hash': hash,
+                'hash_type': 'md5',
+            }, self.test_data)
+            for skip_top_level in (False, True):
+                serial, parallel = mkdtemp(), mkdtemp()
+                try:
+                    assert res.install(serial, skip_top_level)
+                    assert res.install(parallel, skip_top_level, max_workers=4)
+                    self.assertTrue(self._extracted(parallel))
+                    self.assertEqual(self._extracted(parallel), self._extracted(serial))
+                finally:
+                    shutil.rmtree(serial)
+                    shutil.rmtree(parallel)
+
+    @mock.patch.object(backend, 'EXTRACT_BUFFER_LIMIT', 0)
+    def test_install_parallel_large_members(self):
+        self.test_install_parallel()
+
 
 class TestURLResource(unittest.TestCase):
     def test_init(self):
@@ -262,70 +888,485 @@ class TestURLResource(unittest.TestCase):
         }, 'od')
         self.assertEqual(res.destination, 'dst')
 
-    @mock.patch.object(os, 'remove')
-    @mock.patch.object(os, 'makedirs')
-    @mock.patch.object(os.path, 'exists')
-    @mock.patch.object(backend, 'open', create=True)
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
     @mock.patch.object(backend, 'urlopen')
-    def test_fetch(self, murlopen, mopen, mexists, mmakedirs, mremove):
+    def test_fetch(self, murlopen):
+        murlopen.side_effect = lambda req: FakeResponse(b'content')
         res = backend.URLResource('name', {
             'url': 'http://example.com/path/fn',
             'hash': 'hash',
             'hash_type': 'hash_type',
-        }, 'od')
-        mexists.return_value = True
+        }, self.tmpdir)
         res.fetch()
-        assert not mmakedirs.called
-        mremove.assert_called_with('od/name/fn')
-        murlopen.assert_called_with('http://example.com/path/fn')
-        mopen.assert_called_with('od/name/fn', 'wb')
+        self.assertEqual(requested_urls(murlopen), ['http://example.com/path/fn'])
+        with open(os.path.join(self.tmpdir, 'name', 'fn'), 'rb') as fp:
+            self.assertEqual(fp.read(), b'content')
 
-        mexists.return_value = False
+        murlopen.reset_mock()
+        murlopen.side_effect = lambda req: FakeResponse(b'new content')
         res.fetch('http://mirror.com/cache/')
-        mmakedirs.assert_called_with('od/name')
-        murlopen.assert_called_with('http://mirror.com/cache/name/fn')
-        mopen.assert_called_with('od/name/fn', 'wb')
+        self.assertEqual(requested_urls(murlopen), ['http://mirror.com/cache/name/fn'])
+        with open(os.path.join(self.tmpdir, 'name', 'fn'), 'rb') as fp:
+            self.assertEqual(fp.read(), b'new content')
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'name')), ['fn'])
+
+    @mock.patch.object(backend, 'CHUNK_SIZE', 2)
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_streaming_hash(self, murlopen):
+        murlopen.return_value = FakeResponse(b'content')
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': '9a0364b9e99bb480dd25e1f0284c8555',
+            'hash_type': 'md5',
+        }, self.tmpdir)
+        res.fetch()
+        with mock.patch.object(backend.hashlib, 'new') as mnew:
+            assert res.verify()  # already verified while downloading
+            assert not mnew.called
+        assert res.verify(deep=True)
+
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_hash_mismatch(self, murlopen):
+        dest = os.path.join(self.tmpdir, 'name', 'fn')
+        os.makedirs(os.path.dirname(dest))
+        with open(dest, 'wb') as fp:
+            fp.write(b'old')
+        murlopen.return_value = FakeResponse(b'corrupt')
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': '9a0364b9e99bb480dd25e1f0284c8555',
+            'hash_type': 'md5',
+        }, self.tmpdir)
+        with mock.patch.object(backend.sys, 'stderr'):
+            res.fetch()
+        with open(dest, 'rb') as fp:
+            self.assertEqual(fp.read(), b'old')
+        self.assertEqual(os.listdir(os.path.dirname(dest)), ['fn'])
+
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_resume(self, murlopen):
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': '9a0364b9e99bb480dd25e1f0284c8555',
+            'hash_type': 'md5',
+        }, self.tmpdir)
+        headers = {'Content-Length': '7', 'ETag': '"v1"'}
+
+        class Interrupted(FakeResponse):
+            def read(self, size=-1):
+                if self.tell():
+                    raise IOError('connection reset')
+                return FakeResponse.read(self, 3)
+        murlopen.return_value = Interrupted(b'content', headers=headers)
+        with mock.patch.object(backend.sys, 'stderr'):
+            res.fetch()
+        assert not os.path.exists(res.destination)
+        with open(res.destination + '.part', 'rb') as fp:
+            self.assertEqual(fp.read(), b'con')
+        assert os.path.exists(res.destination + '.part.state')
+
+        murlopen.return_value = FakeResponse(b'tent', 206, {'Content-Range': 'bytes 3-6/7'})
+        res.fetch()
+        request = murlopen.call_args[0][0]
+        self.assertEqual(request.get_header('Range'), 'bytes=3-')
+        self.assertEqual(request.get_header('If-range'), '"v1"')
+        assert res.verify()
+        self.assertItemsEqual(os.listdir(os.path.dirname(res.destination)), ['fn', 'fn.verified'])
+
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_resume_changed(self, murlopen):
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': '9a0364b9e99bb480dd25e1f0284c8555',
+            'hash_type': 'md5',
+        }, self.tmpdir)
+        os.makedirs(os.path.dirname(res.destination))
+        with open(res.destination + '.part', 'wb') as fp:
+            fp.write(b'old')
+        with open(res.destination + '.part.state', 'w') as fp:
+            fp.write('{"url": "http://example.com/path/fn", "size": 9, "etag": "\\"v0\\""}')
+        # validator no longer matches, so the server sends the whole file
+        murlopen.return_value = FakeResponse(b'content', headers={'ETag': '"v1"'})
+        res.fetch()
+        self.assertEqual(murlopen.call_args[0][0].get_header('Range'), 'bytes=3-')
+        assert res.verify()
+
+    def _range_server(self, data, etag='"v1"', fail=()):
+        """
+        Return a fake ``urlopen`` which serves byte ranges of ``data``.
+        """
+        def _urlopen(req):
+            match = re.match(r'bytes=(\d+)-(\d*)', req.get_header('Range') or '')
+            if not match:
+                return FakeResponse(data, headers={'ETag': etag})
+            first = int(match.group(1))
+            last = int(match.group(2)) if match.group(2) else len(data) - 1
+            if first in fail:
+                raise IOError('connection reset')
+            return FakeResponse(data[first:last + 1], 206, {
+                'ETag': etag,
+                'Content-Range': 'bytes {}-{}/{}'.format(first, last, len(data)),
+            })
+        return _urlopen
+
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_segmented(self, murlopen):
+        data = b'0123456789' * 10
+        murlopen.side_effect = self._range_server(data)
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': hashlib.md5(data).hexdigest(),
+            'hash_type': 'md5',
+            'segments': 4,
+            'segment_threshold': 50,
+        }, self.tmpdir)
+        res.fetch()
+        assert res.verify()
+        ranges = sorted(c[0][0].get_header('Range') for c in murlopen.call_args_list)
+        self.assertEqual(ranges, ['bytes=0-0', 'bytes=0-24', 'bytes=25-49', 'bytes=50-74', 'bytes=75-99'])
+        self.assertItemsEqual(os.listdir(os.path.dirname(res.destination)), ['fn', 'fn.verified'])
 
-    @mock.patch.object(os, 'remove')
-    @mock.patch.object(os, 'makedirs')
-    @mock.patch.object(os.path, 'exists')
     @mock.patch.object(backend, 'urlopen')
-    def test_fetch_hash_url(self, murlopen, mexists, mmakedirs, mremove):
+    def test_fetch_segmented_below_threshold(self, murlopen):
+        data = b'0123456789'
+        murlopen.side_effect = self._range_server(data)
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': hashlib.md5(data).hexdigest(),
+            'hash_type': 'md5',
+            'segments': 4,
+        }, self.tmpdir)
+        res.fetch()
+        assert res.verify()
+        ranges = [c[0][0].get_header('Range') for c in murlopen.call_args_list]
+        self.assertEqual(ranges, ['bytes=0-0', None])
+
+    @mock.patch.object(backend, 'SEGMENTS', 2)
+    @mock.patch.object(backend, 'SEGMENT_THRESHOLD', 0)
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_segmented_resume(self, murlopen):
+        data = b'0123456789' * 10
+        murlopen.side_effect = self._range_server(data, fail=(50,))
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': hashlib.md5(data).hexdigest(),
+            'hash_type': 'md5',
+        }, self.tmpdir)
+        with mock.patch.object(backend.sys, 'stderr'):
+            res.fetch()
+        assert not res.verify()
+        murlopen.reset_mock()
+        murlopen.side_effect = self._range_server(data)
+        res.fetch()
+        assert res.verify()
+        ranges = [c[0][0].get_header('Range') for c in murlopen.call_args_list]
+        self.assertEqual(ranges, ['bytes=0-0', 'bytes=50-99'])
+
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_chunk_manifest(self, murlopen):
+        data = b'0123456789' * 10
+        murlopen.side_effect = self._range_server(data)
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': hashlib.md5(data).hexdigest(),
+            'hash_type': 'md5',
+            'chunk_size': 30,
+        }, self.tmpdir)
+        res.fetch()
+        manifest = res.chunk_manifest()
+        self.assertEqual(manifest.chunks, [hashlib.md5(data[i:i + 30]).hexdigest() for i in range(0, 100, 30)])
+        self.assertEqual(manifest.ranges(), [(0, 29), (30, 59), (60, 89), (90, 99)])
+
+        # touched, but not changed: verified by chunks rather than in full
+        os.utime(res.destination, (0, 0))
+        with mock.patch.object(backend, 'hash_file_digests') as mhash:
+            with mock.patch.object(backend, '_hash_file_into') as mhash_into:
+                assert res.verify()
+                assert not mhash.called and not mhash_into.called
+
+        # damage a single chunk, and only that chunk should be re-fetched
+        with open(res.destination, 'r+b') as fp:
+            fp.seek(35)
+            fp.write(b'XX')
+        assert not res.verify()
+        murlopen.reset_mock()
+        res.fetch()
+        assert res.verify(deep=True)
+        ranges = [c[0][0].get_header('Range') for c in murlopen.call_args_list]
+        self.assertEqual(ranges, ['bytes=0-0', 'bytes=30-59'])
+
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_chunk_repair_failure(self, murlopen):
+        data = b'0123456789' * 10
+        murlopen.side_effect = self._range_server(data)
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': hashlib.md5(data).hexdigest(),
+            'hash_type': 'md5',
+            'chunk_size': 30,
+        }, self.tmpdir)
+        res.fetch()
+        with open(res.destination, 'r+b') as fp:
+            fp.seek(35)
+            fp.write(b'XX')
+        with open(res.destination, 'rb') as fp:
+            damaged = fp.read()
+
+        # the repaired copy doesn't match, so the existing copy is left alone
+        murlopen.side_effect = self._range_server(b'9876543210' * 10)
+        with mock.patch.object(backend.sys, 'stderr'):
+            res.fetch()
+        with open(res.destination, 'rb') as fp:
+            self.assertEqual(fp.read(), damaged)
+        self.assertNotIn('fn.part', os.listdir(os.path.dirname(res.destination)))
+
+        # the repair fails, so it is left alone and then fetched in full
+        murlopen.side_effect = self._range_server(data, fail=(30,))
+        with mock.patch.object(backend.sys, 'stderr'):
+            res.fetch()
+        assert res.verify(deep=True)
+        self.assertNotIn('fn.part', os.listdir(os.path.dirname(res.destination)))
+
+    def test_chunk_manifest_ignored_for_new_hash(self):
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': hashlib.md5(b'data').hexdigest(),
+            'hash_type': 'md5',
+        }, self.tmpdir)
+        os.makedirs(os.path.dirname(res.destination))
+        with open(res.destination, 'wb') as fp:
+            fp.write(b'data')
+        hasher = backend.MultiHash(['md5'], 2, 'md5')
+        hasher.update(b'data')
+        hasher.chunk_manifest().save(res.destination + '.chunks')
+        self.assertIsNotNone(res.chunk_manifest())
+        res.hash = 'deadbeef'
+        self.assertIsNone(res.chunk_manifest())
+        assert not res.verify()
+
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_hash_url(self, murlopen):
+        def _urlopen(req):
+            url = req.get_full_url() if hasattr(req, 'get_full_url') else req
+            return FakeResponse(b'myhash' if url.endswith('.hash') else b'content')
+        murlopen.side_effect = _urlopen
         res = backend.URLResource('name', {
             'url': 'http://example.com/path/fn',
             'hash': 'http://example.com/path/fn.hash',
             'hash_type': 'hash_type',
-        }, 'od')
-        mexists.return_value = True
-        murlopen.return_value.read.return_value = b'myhash'
-        mopen = mock.mock_open()
-        with mock.patch.object(backend, 'open', mopen, create=True):
-            res.fetch()
-        assert not mmakedirs.called
-        mremove.assert_called_with('od/name/fn')
-        murlopen.assert_any_call('http://example.com/path/fn')
-        mopen.assert_any_call('od/name/fn', 'wb')
-        murlopen.assert_any_call('http://example.com/path/fn.hash')
-        mopen.assert_any_call('od/name/fn.hash', 'w+')
+        }, self.tmpdir)
+        res.fetch()
+        self.assertEqual(requested_urls(murlopen), ['http://example.com/path/fn.hash',
+                                                    'http://example.com/path/fn'])
         self.assertEqual(res.hash, 'myhash')
+        with open(os.path.join(self.tmpdir, 'name', 'fn.hash')) as fp:
+            self.assertEqual(fp.read(), 'myhash')
 
         res = backend.URLResource('name', {
             'url': 'http://example.com/path/fn',
             'hash': 'http://example.com/path/fn.hash',
             'hash_type': 'hash_type',
-        }, 'od')
+        }, self.tmpdir)
         murlopen.reset_mock()
-        with mock.patch.object(backend, 'open', mopen, create=True):
+        backend._mirror_manifests.clear()
+        res.fetch('http://mirror.com/cache/')
+        self.assertEqual(requested_urls(murlopen), ['http://mirror.com/cache/manifest.json',
+                                                    'http://mirror.com/cache/name/fn.hash',
+                                                    'http://mirror.com/cache/name/fn'])
+
+    @mock.patch.object(backend, '_mirror_manifests', {})
+    @mock.patch.object(backend, 'urlopen')
+    def test_fetch_hash_url_mirror_manifest(self, murlopen):
+        manifest = {'resources': [{
+            'name': 'name', 'path': 'name/fn', 'size': 7,
+            'hash_type': 'md5', 'hash': '9a0364b9e99bb480dd25e1f0284c8555',
+            'hashes': {'md5': '9a0364b9e99bb480dd25e1f0284c8555'},
+        }]}
+
+        def _urlopen(req):
+            url = req.get_full_url() if hasattr(req, 'get_full_url') else req
+            if url.endswith('manifest.json'):
+                return FakeResponse(json.dumps(manifest).encode('utf-8'))
+            return FakeResponse(b'content')
+        murlopen.side_effect = _urlopen
+        for name in ('name', 'other'):
+            res = backend.URLResource(name, {
+                'url': 'http://example.com/path/fn',
+                'hash': 'http://example.com/path/fn.hash',
+                'hash_type': 'md5',
+            }, self.tmpdir)
             res.fetch('http://mirror.com/cache/')
-        murlopen.assert_any_call('http://mirror.com/cache/name/fn')
-        mopen.assert_any_call('od/name/fn', 'wb')
-        murlopen.assert_any_call('http://mirror.com/cache/name/fn.hash')
-        mopen.assert_any_call('od/name/fn.hash', 'w+')
+        # the manifest is only requested once, and the hash file only for the
+        # resource which isn't in it
+        self.assertEqual(requested_urls(murlopen), ['http://mirror.com/cache/manifest.json',
+                                                    'http://mirror.com/cache/name/fn',
+                                                    'http://mirror.com/cache/other/fn.hash',
+                                                    'http://mirror.com/cache/other/fn'])
+        with open(os.path.join(self.tmpdir, 'name', 'fn.hash')) as fp:
+            self.assertEqual(fp.read(), '9a0364b9e99bb480dd25e1f0284c8555')
+
+    def test_save_manifest(self):
+        resources = backend.ResourceContainer(self.tmpdir)
+        resources.add_required('present', {
+            'url': 'http://example.com/path/fn',
+            'hash': '9a0364b9e99bb480dd25e1f0284c8555',
+            'hash_type': 'md5',
+        })
+        resources.add_required('missing', {
+            'url': 'http://example.com/path/missing',
+            'hash': 'deadbeef',
+            'hash_type': 'md5',
+        })
+        os.makedirs(os.path.join(self.tmpdir, 'present'))
+        with open(resources['present'].destination, 'wb') as fp:
+            fp.write(b'content')
+        resources.save_manifest()
+        with open(os.path.join(self.tmpdir, 'manifest.json')) as fp:
+            manifest = json.load(fp)
+        self.assertEqual(manifest, {'resources': [{
+            'name': 'present',
+            'path': 'present/fn',
+            'size': 7,
+            'hash_type': 'md5',
+            'hash': '9a0364b9e99bb480dd25e1f0284c8555',
+            'hashes': {'md5': '9a0364b9e99bb480dd25e1f0284c8555'},
+        }]})
+
+    def test_manifest_entry_read_only(self):
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/fn',
+            'hash': 'http://example.com/path/fn.hash',
+            'hash_type': 'md5',
+        }, self.tmpdir)
+        os.makedirs(os.path.dirname(res.destination))
+        with open(res.destination, 'wb') as fp:
+            fp.write(b'content')
+        with open(res.destination + '.hash', 'w') as fp:
+            fp.write('9a0364b9e99bb480dd25e1f0284c8555\n')
+        self.assertEqual(res.manifest_entry()['hash'], '9a0364b9e99bb480dd25e1f0284c8555')
+        self.assertEqual(res.hash, 'http://example.com/path/fn.hash')
+
+        res = backend.PyPIResource('pkg', {'pypi': 'pkg'}, self.tmpdir)
+        os.makedirs(res.destination_dir)
+        with open(os.path.join(res.destination_dir, 'pkg-1.0.tar.gz'), 'wb') as fp:
+            fp.write(b'content')
+        res._update_hash_manifest(res.destination_dir, 'pkg-1.0.tar.gz', 'md5', '9a0364b9e99bb480dd25e1f0284c8555')
+        self.assertEqual(res.manifest_entry()['path'], 'pkg/pkg-1.0.tar.gz')
+        self.assertEqual((res.destination, res.hash), ('', ''))
+
+    def _fetch_and_install(self, filename, hash, **kwargs):
+        with open(os.path.join(os.path.dirname(__file__), 'data', filename), 'rb') as fp:
+            data = fp.read()
+        res = backend.URLResource('name', {
+            'url': 'http://example.com/path/' + filename,
+            'hash': hash,
+            'hash_type': 'md5',
+        }, self.tmpdir)
+        dest = os.path.join(self.tmpdir, 'dest')
+        with mock.patch.object(backend, 'urlopen') as murlopen:
+            murlopen.return_value = FakeResponse(data)
+            result = res.fetch_and_install(dest, **kwargs)
+        return res, dest, result
+
+    def test_fetch_and_install(self):
+        res, dest, result = self._fetch_and_install('test.tgz', '347153cce7f15a6d3e47d34fbccb6afa')
+        assert result
+        self.assertItemsEqual(os.listdir(os.path.join(dest, 'toplevel')), ['foo', 'bar'])
+        assert not os.path.exists(res.destination)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['dest', 'name'])  # no staging left
+
+    def test_fetch_and_install_keep_archive(self):
+        res, dest, result = self._fetch_and_install('test.tgz', '347153cce7f15a6d3e47d34fbccb6afa',
+                                                    skip_top_level=True, keep_archive=True)
+        assert result
+        self.assertItemsEqual(os.listdir(dest), ['foo', 'bar', '.jujuresources.name.json'])
+        assert not os.path.exists(res.destination + '.part')
+        assert res.verified_digests()
+
+    def test_fetch_and_install_mismatch(self):
+        res, dest, result = self._fetch_and_install('test.tgz', 'deadbeef', keep_archive=True)
+        assert not result
+        assert not os.path.exists(dest)
+        assert not os.path.exists(res.destination)
+        self.assertEqual(os.listdir(self.tmpdir), ['name'])
+
+    def test_fetch_and_install_unsafe(self):
+        def add(tf, name, data=b'', linkname=None, link_type=tarfile.SYMTYPE):
+            info = tarfile.TarInfo(name)
+            if linkname:
+                info.type, info.linkname = link_type, linkname
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+        cases = [
+            [('../../escaped.txt', b'escaped')],
+            [('/tmp/escaped.txt', b'escaped')],
+            [('link', b'', '../..'), ('link/escaped.txt', b'escaped')],
+            [('dir/up', b'', '..'), ('dir/up/up', b'', 'up/..'), ('dir/up/up/escaped.txt', b'escaped')],
+            [('passwd', b'', '/etc/passwd', tarfile.LNKTYPE)],
+        ]
+        for members in cases:
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode='w:gz') as tf:
+                add(tf, 'safe.txt', b'safe')
+                for member in members:
+                    add(tf, *member)
+            data = buf.getvalue()
+            res = backend.URLResource('name', {
+                'url': 'http://example.com/path/evil.tgz',
+                'hash': hashlib.md5(data).hexdigest(),
+                'hash_type': 'md5',
+            }, self.tmpdir)
+            dest = os.path.join(self.tmpdir, 'a', 'b', 'dest')
+            with mock.patch.object(backend, 'urlopen') as murlopen, \
+                    mock.patch.object(sys, 'stderr'):
+                murlopen.return_value = FakeResponse(data)
+                assert not res.fetch_and_install(dest)
+            assert not os.path.exists(dest)
+            self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'a', 'b')), [])  # no staging left
+            for dirpath, dirnames, filenames in os.walk(self.tmpdir):
+                self.assertNotIn('escaped.txt', filenames)
+            assert not os.path.exists('/tmp/escaped.txt')
+
+    def test_fetch_and_install_existing(self):
+        os.makedirs(os.path.join(self.tmpdir, 'dest', 'toplevel'))
+        with open(os.path.join(self.tmpdir, 'dest', 'toplevel', 'other'), 'w') as fp:
+            fp.write('other')
+        res, dest, result = self._fetch_and_install('test.tgz', '347153cce7f15a6d3e47d34fbccb6afa')
+        assert result
+        self.assertItemsEqual(os.listdir(os.path.join(dest, 'toplevel')), ['foo', 'bar', 'other'])
+
+    def test_fetch_and_install_current(self):
+        res, dest, result = self._fetch_and_install('test.tgz', '347153cce7f15a6d3e47d34fbccb6afa')
+        with mock.patch.object(backend, 'urlopen') as murlopen:
+            assert res.fetch_and_install(dest)
+            assert not murlopen.called
+
+    def test_fetch_and_install_zip(self):
+        res, dest, result = self._fetch_and_install('test.zip', '5c7b6a3c4bf38ac9d2f0ab0088fff1a9')
+        assert result
+        self.assertItemsEqual(os.listdir(os.path.join(dest, 'toplevel')), ['foo', 'bar'])
+        assert os.path.exists(res.destination)  # needed whole to extract it
 
 
 class TestPyPIResource(unittest.TestCase):
     test_data = os.path.join(os.path.dirname(__file__), 'data')
 
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+        patcher = mock.patch.object(backend, 'PYPI_CACHE_DIR', self.cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        remove_verified(self.test_data)
+        shutil.rmtree(self.cache_dir)
+
     def test_init(self):
         res = backend.PyPIResource('name', {'pypi': 'jujuresources>=0.2'}, 'od')
         self.assertEqual(res.spec, 'jujuresources>=0.2')
@@ -358,6 +1399,7 @@ class TestPyPIResource(unittest.TestCase):
         res = backend.PyPIResource('name', {'pypi': 'jujuresources>=0.2'}, 'od')
         res.get_remote_hash = mock.Mock()
         res._write_file = mock.Mock()
+        res._update_hash_manifest = mock.Mock()
         res.process_dependency = mock.Mock()
         mlistdir.return_value = ['pyaml-3.0.tgz', 'jujuresources-0.2.tgz']
         res.get_remote_hash.return_value = ('hash_type', 'hash')
@@ -372,6 +1414,8 @@ class TestPyPIResource(unittest.TestCase):
             'jujuresources-0.2.tgz', 'https://pypi.python.org/simple/')
         res._write_file.assert_called_once_with(
             'od/jujuresources/jujuresources-0.2.tgz.hash_type', 'hash\n')
+        res._update_hash_manifest.assert_called_once_with(
+            'od/jujuresources', 'jujuresources-0.2.tgz', 'hash_type', 'hash')
         self.assertEqual(res.filename, 'jujuresources-0.2.tgz')
         self.assertEqual(res.destination, 'od/jujuresources/jujuresources-0.2.tgz')
         self.assertEqual(res.hash, 'hash')
@@ -389,6 +1433,7 @@ class TestPyPIResource(unittest.TestCase):
         res = backend.PyPIResource('name', {'pypi': 'jujuresources>=0.2'}, 'od')
         res.get_remote_hash = mock.Mock()
         res._write_file = mock.Mock()
+        res._update_hash_manifest = mock.Mock()
         res.process_dependency = mock.Mock()
         mlistdir.return_value = ['pyaml-3.0.tgz', 'jujuresources-0.2.tgz']
         res.get_remote_hash.return_value = ('hash_type', 'hash')
@@ -404,6 +1449,8 @@ class TestPyPIResource(unittest.TestCase):
             'jujuresources-0.2.tgz', 'mirror/')
         res._write_file.assert_called_once_with(
             'od/jujuresources/jujuresources-0.2.tgz.hash_type', 'hash\n')
+        res._update_hash_manifest.assert_called_once_with(
+            'od/jujuresources', 'jujuresources-0.2.tgz', 'hash_type', 'hash')
         self.assertEqual(res.filename, 'jujuresources-0.2.tgz')
         self.assertEqual(res.destination, 'od/jujuresources/jujuresources-0.2.tgz')
         self.assertEqual(res.hash, 'hash')
@@ -473,52 +1520,141 @@ class TestPyPIResource(unittest.TestCase):
         self.assertEqual(res.hash, '')
         self.assertEqual(res.hash_type, '')
 
+    def test_get_local_hash_manifest(self):
+        tmpdir = mkdtemp()
+        try:
+            res = backend.PyPIResource('name', {'pypi': 'jujuresources>=0.2'}, tmpdir)
+            os.makedirs(res.destination_dir)
+            for filename in ('jujuresources-0.2.tar.gz', 'jujuresources-0.10.tar.gz', 'jujuresources-0.1.tar.gz'):
+                with open(os.path.join(res.destination_dir, filename), 'w'):
+                    pass
+            res._update_hash_manifest(res.destination_dir, 'jujuresources-0.2.tar.gz', 'md5', 'deadbeef')
+            res._update_hash_manifest(res.destination_dir, 'jujuresources-0.2.tar.gz', 'sha256', 'cafef00d')
+            res._update_hash_manifest(res.destination_dir, 'jujuresources-0.1.tar.gz', 'md5', 'old')
+            res._update_hash_manifest(res.destination_dir, 'jujuresources-0.10.tar.gz', 'md5', 'newer')
+            res._update_hash_manifest(res.destination_dir, 'jujuresources-0.3.tar.gz', 'md5', 'gone')
+            with mock.patch.object(os.path, 'isfile') as misfile:
+                res.get_local_hash()
+                assert not misfile.called
+            # the newest version which is still there
+            self.assertEqual(res.filename, 'jujuresources-0.10.tar.gz')
+            self.assertEqual(res.hash, 'newer')
+
+            res = backend.PyPIResource('name', {'pypi': 'jujuresources<0.3'}, tmpdir)
+            res.get_local_hash()
+            self.assertEqual(res.filename, 'jujuresources-0.2.tar.gz')
+            self.assertEqual(res.destination, os.path.join(res.destination_dir, 'jujuresources-0.2.tar.gz'))
+            self.assertEqual(res.hash_type, 'sha256')
+            self.assertEqual(res.hash, 'cafef00d')
+
+            # stale entries are pruned when the manifest is rewritten
+            os.remove(os.path.join(res.destination_dir, 'jujuresources-0.1.tar.gz'))
+            res._update_hash_manifest(res.destination_dir, 'jujuresources-0.2.tar.gz', 'md5', 'deadbeef')
+            self.assertItemsEqual(res._load_hash_manifest(res.destination_dir),
+                                  ['jujuresources-0.2.tar.gz', 'jujuresources-0.10.tar.gz'])
+        finally:
+            shutil.rmtree(tmpdir)
+
     @mock.patch.object(backend, 'urlopen')
     def test_get_remote_hash(self, murlopen):
         res = backend.PyPIResource('name', {'pypi': 'jujuresources>=0.1'}, 'od')
-        murlopen.return_value.__iter__.return_value = [
-            b'<html>',
+        murlopen.return_value = FakeResponse(
+            b'<html>\n'
             b'<a href="../../packages/source/j/jujuresources/'
             b'jujuresources-0.1.tar.gz#md5=4fdc461dcde13b1e919c17bac6e01464">'
             b'jujuresources-0.1.tar.gz'
-            b'</a>',
+            b'</a>\n'
             b'<a href="../../packages/source/j/jujuresources/'
             b'jujuresources-0.2.tar.gz#md5=deadbeef">'
             b'jujuresources-0.2.tar.gz'
-            b'</a>',
-            b'</html>']
-        hash_type, hash = res.get_remote_hash('jujuresources-0.2.tar.gz', 'mirror')
+            b'</a>\n'
+            b'</html>')
+        hash_type, hash = res.get_remote_hash('jujuresources-0.2.tar.gz', 'http://mirror/')
         self.assertEqual(hash, 'deadbeef')
         self.assertEqual(hash_type, 'md5')
+        self.assertEqual(requested_urls(murlopen), ['http://mirror/jujuresources/'])
+        # the project page is only fetched once for all of its files
+        hash_type, hash = res.get_remote_hash('jujuresources-0.1.tar.gz', 'http://mirror/')
+        self.assertEqual(hash, '4fdc461dcde13b1e919c17bac6e01464')
+        self.assertEqual(murlopen.call_count, 1)
 
     @mock.patch.object(backend, 'urlopen')
     def test_get_remote_hash_no_match(self, murlopen):
         res = backend.PyPIResource('name', {'pypi': 'jujuresources>=0.2'}, 'od')
-        murlopen.return_value.read.return_value = (
-            '<html>'
-            '<a href="../../packages/source/j/jujuresources/'
-            'jujuresources-0.1.tar.gz#md5=4fdc461dcde13b1e919c17bac6e01464">'
-            'jujuresources-0.1.tar.gz'
-            '</a>'
-            '</html>')
-        hash_type, hash = res.get_remote_hash('jujuresources-0.2.tar.gz', 'mirror')
+        murlopen.side_effect = lambda request: FakeResponse(
+            b'<html>'
+            b'<a href="../../packages/source/j/jujuresources/'
+            b'jujuresources-0.1.tar.gz#md5=4fdc461dcde13b1e919c17bac6e01464">'
+            b'jujuresources-0.1.tar.gz'
+            b'</a>'
+            b'</html>')
+        with mock.patch.object(sys, 'stderr'):
+            hash_type, hash = res.get_remote_hash('jujuresources-0.2.tar.gz', 'http://mirror/')
         self.assertEqual(hash, '')
         self.assertEqual(hash_type, '')
+        self.assertEqual(murlopen.call_count, 2)  # revalidated, in case the file is new
+
+    @mock.patch.object(backend, 'urlopen')
+    def test_pypi_metadata_cache(self, murlopen):
+        page = b'<a href="/files/foo-1.0.tar.gz#sha256=abc">foo-1.0.tar.gz</a><a href=\'foo-0.9.zip\'>'
+        murlopen.return_value = FakeResponse(page, headers={'ETag': '"v1"', 'Last-Modified': 'Mon'})
+        cache = backend.PyPIMetadataCache(self.cache_dir, ttl=60)
+        links = {'foo-1.0.tar.gz': ('sha256', 'abc'), 'foo-0.9.zip': ('', '')}
+        self.assertEqual(cache.links('http://mirror/', 'foo'), links)
+
+        # a new process uses the entry on disk while it's fresh
+        murlopen.reset_mock()
+        cache = backend.PyPIMetadataCache(self.cache_dir, ttl=60)
+        self.assertEqual(cache.links('http://mirror/', 'foo'), links)
+        assert not murlopen.called
+
+        # and then revalidates it
+        cache = backend.PyPIMetadataCache(self.cache_dir, ttl=0)
+        murlopen.return_value = FakeResponse(b'', code=304)
+        self.assertEqual(cache.links('http://mirror/', 'foo'), links)
+        request = murlopen.call_args[0][0]
+        self.assertEqual(request.get_header('If-none-match'), '"v1"')
+        self.assertEqual(request.get_header('If-modified-since'), 'Mon')
+
+        # falling back to the stale entry if the mirror can't be reached
+        murlopen.side_effect = IOError('unreachable')
+        self.assertEqual(cache.links('http://mirror/', 'foo'), links)
+        self.assertRaises(IOError, cache.links, 'http://other/', 'foo')
 
-    @mock.patch.object(backend.PyPIResource, '_get_index')
-    def test_package_name_from_filename(self, mget_index):
-        mget_index.return_value = set(['foo', 'bar', 'qux-zod', 'foo-bar'])
+        murlopen.side_effect = backend.HTTPError('url', 404, 'Not Found', {}, None)
+        self.assertIsNone(cache.links('http://mirror/', 'bar'))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)  # one directory per mirror
+
+    @mock.patch.object(backend.PyPIResource, '_project_exists')
+    def test_package_name_from_filename(self, mproject_exists):
+        mproject_exists.return_value = False
         cases = {
-            'qux-1.0.zip': '',
+            'qux-1.0.zip': 'qux',
             'foo-1.0.tar.gz': 'foo',
             'bar-1.0-x86_64.tar.gz': 'bar',
             'qux-zod-1.0dev-py2.4.egg': 'qux-zod',
             'foo-bar-1.0.tar.gz': 'foo-bar',
+            'Foo_Bar-1.0-py2.py3-none-any.whl': 'foo-bar',
+            'zope.interface-4.1.2.tar.gz': 'zope-interface',
+            'foo-2-bar-1.0.tar.gz': '',
+            'noversion.tar.gz': '',
         }
         for input, expected in cases.items():
             actual = backend.PyPIResource._package_name_from_filename(input, 'mirror')
             self.assertEqual(expected, actual)
-        mget_index.assert_called_with('mirror')
+        mproject_exists.side_effect = lambda project, mirror_url: project == 'foo'
+        self.assertEqual(backend.PyPIResource._package_name_from_filename('foo-2-bar-1.0.tar.gz', 'mirror'), 'foo')
+        mproject_exists.assert_has_calls([mock.call('foo-2-bar', 'mirror'), mock.call('foo', 'mirror')])
+
+    @mock.patch.object(backend, 'urlopen')
+    def test_project_exists(self, murlopen):
+        murlopen.return_value = FakeResponse(b'<html></html>')
+        assert backend.PyPIResource._project_exists('foo', 'http://mirror/simple/')
+        self.assertEqual(requested_urls(murlopen), ['http://mirror/simple/foo/'])
+        murlopen.side_effect = backend.HTTPError('url', 404, 'Not Found', {}, None)
+        assert not backend.PyPIResource._project_exists('bar', 'http://mirror/simple/')
+        murlopen.side_effect = IOError('unreachable')
+        assert not backend.PyPIResource._project_exists('baz', 'http://mirror/simple/')
 
     @mock.patch.object(os, 'rename')
     @mock.patch.object(os, 'makedirs')
@@ -529,6 +1665,7 @@ class TestPyPIResource(unittest.TestCase):
         res._package_name_from_filename = mock.Mock(return_value='new-package')
         res.get_remote_hash = mock.Mock(return_value=('hash_type', 'hash'))
         res._write_file = mock.Mock()
+        res._update_hash_manifest = mock.Mock()
         res.process_dependency('new-package-1.0-python2.7.egg', 'mirror')
         mexists.assert_called_with('od/new-package')
         mmakedirs.assert_called_with('od/new-package')
@@ -539,24 +1676,8 @@ class TestPyPIResource(unittest.TestCase):
         res._write_file.assert_called_with(
             'od/new-package/new-package-1.0-python2.7.egg.hash_type',
             'hash\n')
-
-    @mock.patch.object(backend, 'urlopen')
-    def test_get_index(self, murlopen):
-        murlopen.return_value.__iter__.return_value = (
-            b'<html>',
-            b'<a href="foo">Foo</a>',
-            b'<a href="bar">bar</a>',
-            b'<a href="baz-0">baz-0</a>',
-            b'</html>',
-        )
-        backend.PyPIResource._index = None
-        result = backend.PyPIResource._get_index('url')
-        self.assertItemsEqual(result, ['Foo', 'bar', 'baz-0'])
-        self.assertIs(backend.PyPIResource._index, result)
-
-    def test_get_index_cached(self):
-        backend.PyPIResource._index = 'foo'
-        self.assertEqual(backend.PyPIResource._get_index('url'), 'foo')
+        res._update_hash_manifest.assert_called_with(
+            'od/new-package', 'new-package-1.0-python2.7.egg', 'hash_type', 'hash')
 
     @mock.patch.object(backend.PyPIResource, '_write_file')
     def test_build_pypi_indexes(self, mwrite_file):
@@ -567,6 +1688,78 @@ class TestPyPIResource(unittest.TestCase):
         self.assertIn('href="jujuresources-0.2.tar.gz#md5=4f08575d804517cea2265a7d43022771"',
                       mwrite_file.call_args_list[0][0][1])
 
+    def test_build_pypi_indexes_all_files(self):
+        tmpdir = mkdtemp()
+        try:
+            os.mkdir(os.path.join(tmpdir, 'lxml'))
+            for filename in ('lxml-3.4.tar.gz', 'lxml-3.4-cp27-none-linux_x86_64.whl'):
+                with open(os.path.join(tmpdir, 'lxml', filename), 'w'):
+                    pass
+            backend.PyPIResource._update_hash_manifest(
+                os.path.join(tmpdir, 'lxml'), 'lxml-3.4.tar.gz', 'md5', 'aaa')
+            backend.PyPIResource._update_hash_manifest(
+                os.path.join(tmpdir, 'lxml'), 'lxml-3.4-cp27-none-linux_x86_64.whl', 'sha256', 'bbb')
+            backend.PyPIResource.build_pypi_indexes(tmpdir)
+            with open(os.path.join(tmpdir, 'lxml', 'index.html')) as fp:
+                index = fp.read()
+            self.assertIn('<a href="lxml-3.4.tar.gz#md5=aaa" rel="internal">lxml-3.4.tar.gz</a>', index)
+            self.assertIn('<a href="lxml-3.4-cp27-none-linux_x86_64.whl#sha256=bbb" rel="internal">', index)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @mock.patch.object(subprocess, 'check_output')
+    def test_build_wheels(self, mcheck_output):
+        tmpdir = mkdtemp()
+        try:
+            for name in ('foo', 'bar', 'baz'):
+                os.mkdir(os.path.join(tmpdir, name))
+                sdist = os.path.join(tmpdir, name, '{}-1.0.tar.gz'.format(name))
+                with open(sdist, 'w') as fp:
+                    fp.write(name)
+                backend.PyPIResource._update_hash_manifest(
+                    os.path.dirname(sdist), os.path.basename(sdist), 'sha256', backend.hash_file(sdist, 'sha256'))
+            with open(os.path.join(tmpdir, 'baz', 'baz-1.0-py2.py3-none-any.whl'), 'w') as fp:
+                fp.write('wheel')
+            backend.PyPIResource._update_hash_manifest(
+                os.path.join(tmpdir, 'baz'), 'baz-1.0-py2.py3-none-any.whl', 'sha256', 'ccc')
+            # a URL resource, which isn't a package
+            os.mkdir(os.path.join(tmpdir, 'tarball'))
+            with open(os.path.join(tmpdir, 'tarball', 'tarball-1.0.tar.gz'), 'w') as fp:
+                fp.write('tarball')
+            with open(os.path.join(tmpdir, 'tarball', 'tarball-1.0.tar.gz.sha256'), 'w') as fp:
+                fp.write(hashlib.sha256(b'tarball').hexdigest())
+
+            def pip_wheel(cmd, **kwargs):
+                if os.path.join(tmpdir, 'bar', 'bar-1.0.tar.gz') in cmd:
+                    raise subprocess.CalledProcessError(1, cmd, 'build failed')
+                with open(os.path.join(cmd[cmd.index('-w') + 1], 'foo-1.0-cp27-none-linux_x86_64.whl'), 'w') as fp:
+                    fp.write('wheel')
+                return ''
+            mcheck_output.side_effect = pip_wheel
+            with mock.patch.object(sys, 'stderr'):
+                self.assertEqual(backend.PyPIResource.build_wheels(tmpdir, max_workers=2, mirror_url='mirror'),
+                                 ['bar'])
+            self.assertEqual(mcheck_output.call_count, 2)
+            # not --no-index, so that isolated builds can install their build requirements
+            mcheck_output.assert_any_call(
+                ['pip', 'wheel', '--no-deps', '-w', mock.ANY,
+                 os.path.join(tmpdir, 'foo', 'foo-1.0.tar.gz'), '-i', 'mirror'], stderr=subprocess.STDOUT)
+            self.assertItemsEqual(os.listdir(os.path.join(tmpdir, 'foo')), [
+                'foo-1.0.tar.gz',
+                'foo-1.0.tar.gz.verified',
+                'foo-1.0-cp27-none-linux_x86_64.whl',
+                'foo-1.0-cp27-none-linux_x86_64.whl.sha256',
+                'hashes.json',
+            ])
+            res = backend.PyPIResource('foo', {'pypi': 'foo'}, tmpdir)
+            assert res.verify()
+            self.assertEqual(res.filename, 'foo-1.0-cp27-none-linux_x86_64.whl')
+            self.assertEqual(res.hash, hashlib.sha256(b'wheel').hexdigest())
+            self.assertItemsEqual(os.listdir(os.path.join(tmpdir, 'bar')),
+                                  ['bar-1.0.tar.gz', 'bar-1.0.tar.gz.verified', 'hashes.json'])
+        finally:
+            shutil.rmtree(tmpdir)
+
     @mock.patch.object(subprocess, 'call')
     def test_install(self, mcall):
         mcall.return_value = 0
@@ -595,6 +1788,147 @@ class TestPyPIResource(unittest.TestCase):
         backend.PyPIResource.install_group(resources, mirror_url='mirror')
         mcall.assert_called_with(['pip', 'install', 'foo>=0.1', 'od/bar', '-i', 'mirror'])
 
+    def _sdist(self, output_dir, name, requires=None, version='1.0', egg_info=True):
+        package_dir = os.path.join(output_dir, name)
+        if not os.path.isdir(package_dir):
+            os.mkdir(package_dir)
+        filename = os.path.join(package_dir, '{}-{}.tar.gz'.format(name, version))
+        pkg_info = 'Metadata-Version: 1.1\nName: {}\n'.format(name)
+        with tarfile.open(filename, 'w:gz') as tf:
+            for member, data in [('PKG-INFO', pkg_info),
+                                 ('{}.egg-info/PKG-INFO'.format(name), pkg_info if egg_info else None),
+                                 ('{}.egg-info/requires.txt'.format(name), requires)]:
+                if data is None:
+                    continue
+                info = tarfile.TarInfo('{}-{}/{}'.format(name, version, member))
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data.encode('utf-8')))
+        backend.PyPIResource._update_hash_manifest(
+            package_dir, os.path.basename(filename), 'sha256', backend.hash_file(filename, 'sha256'))
+        return filename
+
+    @mock.patch.object(subprocess, 'call')
+    def test_install_group_offline(self, mcall):
+        tmpdir = mkdtemp()
+        try:
+            foo = self._sdist(tmpdir, 'foo', 'bar>=1.0\n\n[test]\nmissing-test-dep\n')
+            bar = self._sdist(tmpdir, 'bar')
+            os.mkdir(os.path.join(tmpdir, 'tarball'))  # a URL resource, not a package
+            with open(os.path.join(tmpdir, 'tarball', 'tarball-1.0.tar.gz.sha256'), 'w') as fp:
+                fp.write('deadbeef')
+            res = backend.PyPIResource('foo', {'pypi': 'foo'}, tmpdir)
+            mcall.return_value = 0
+            assert backend.PyPIResource.install_group([res], 'mirror')
+            mcall.assert_called_once_with([
+                'pip', 'install', '--no-index',
+                '--find-links', os.path.dirname(bar),
+                '--find-links', os.path.dirname(foo),
+                foo])
+
+            mcall.reset_mock()
+            mcall.side_effect = [1, 0]
+            assert backend.PyPIResource.install_group([res], 'mirror')
+            self.assertEqual(mcall.call_count, 2)
+            mcall.assert_called_with([
+                'pip', 'install',
+                '--find-links', os.path.dirname(bar),
+                '--find-links', os.path.dirname(foo),
+                foo, '-i', 'mirror'])
+
+            shutil.rmtree(os.path.dirname(bar))
+            mcall.reset_mock()
+            mcall.side_effect = None
+            assert backend.PyPIResource.install_group([res], 'mirror')
+            mcall.assert_called_once_with(['pip', 'install', '--find-links', os.path.dirname(foo), foo, '-i', 'mirror'])
+
+            # the fetched bar is too old, or its requirements are unknown
+            for version, egg_info in (('0.9', True), ('1.1', False)):
+                shutil.rmtree(os.path.join(tmpdir, 'bar'), ignore_errors=True)
+                bar = self._sdist(tmpdir, 'bar', version=version, egg_info=egg_info)
+                mcall.reset_mock()
+                assert backend.PyPIResource.install_group([res], 'mirror')
+                mcall.assert_called_once_with([
+                    'pip', 'install',
+                    '--find-links', os.path.dirname(bar),
+                    '--find-links', os.path.dirname(foo),
+                    foo, '-i', 'mirror'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @mock.patch.object(backend.PyPIResource, '_pip_interpreter', mock.Mock(return_value=sys.executable))
+    @mock.patch.object(backend.wheels, 'install_wheels')
+    @mock.patch.object(subprocess, 'call')
+    def test_install_group_wheels(self, mcall, minstall_wheels):
+        tmpdir = mkdtemp()
+        try:
+            resources = [
+                backend.PyPIResource('foo', {'pypi': 'foo[extra]>=0.1'}, tmpdir),
+                backend.PyPIResource('bar', {'pypi': 'bar>=0.1'}, tmpdir),
+            ]
+            for resource, filename in zip(resources, ['foo-1.0-py2.py3-none-any.whl', 'bar-1.0.tar.gz']):
+                resource.destination = os.path.join(tmpdir, filename)
+                resource.verify = mock.Mock(return_value=True)
+            mcall.return_value = 0
+            minstall_wheels.return_value = True
+            assert backend.PyPIResource.install_group(resources)
+            assert not minstall_wheels.called  # bar isn't a wheel
+            mcall.assert_called_once_with(['pip', 'install'] + [r.destination for r in resources])
+
+            mcall.reset_mock()
+            assert backend.PyPIResource.install_group(resources[:1])
+            assert not mcall.called
+            minstall_wheels.assert_called_once_with(
+                [resources[0].destination], mock.ANY, extras={resources[0].destination: ('extra',)})
+
+            minstall_wheels.return_value = False
+            assert backend.PyPIResource.install_group(resources[:1])
+            mcall.assert_called_once_with(['pip', 'install', resources[0].destination])
+
+            os.mkdir(os.path.join(tmpdir, 'Dep_Name'))
+            dep = os.path.join(tmpdir, 'Dep_Name', 'Dep_Name-2.0-py2.py3-none-any.whl')
+            with open(dep, 'w') as fp:
+                fp.write('dep')
+            backend.PyPIResource._update_hash_manifest(
+                os.path.dirname(dep), os.path.basename(dep), 'sha256', backend.hash_file(dep, 'sha256'))
+            find_wheel = minstall_wheels.call_args[0][1]
+            self.assertEqual(find_wheel('dep-name'), dep)
+            self.assertIsNone(find_wheel('other'))
+
+            # pip belongs to another interpreter, so it would install elsewhere
+            mcall.reset_mock()
+            minstall_wheels.reset_mock()
+            minstall_wheels.return_value = True
+            with mock.patch.object(backend.PyPIResource, '_pip_interpreter', return_value='/other/bin/python'):
+                assert backend.PyPIResource.install_group(resources[:1])
+            assert not minstall_wheels.called
+            mcall.assert_called_once_with(['pip', 'install', '--find-links', os.path.dirname(dep),
+                                           resources[0].destination])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_pip_interpreter(self):
+        tmpdir = mkdtemp()
+        try:
+            pip = os.path.join(tmpdir, 'pip')
+            python = os.path.join(tmpdir, 'python')
+            for filename in (pip, python):
+                with open(filename, 'w'):
+                    pass
+                os.chmod(filename, 0o755)
+            with mock.patch.dict(os.environ, {'PATH': tmpdir}):
+                for shebang, expected in [('#!/venv/bin/python\n', '/venv/bin/python'),
+                                          ('#!/usr/bin/env python\n', python),
+                                          ('#!/bin/sh\n"exec" "/venv/bin/python" "$0"\n', '/bin/sh'),
+                                          ('#!/usr/bin/python -E -s\n', None),
+                                          ('import pip\n', None)]:
+                    with open(pip, 'w') as fp:
+                        fp.write(shebang)
+                    self.assertEqual(backend.PyPIResource._pip_interpreter(), expected)
+            with mock.patch.dict(os.environ, {'PATH': os.path.join(tmpdir, 'missing')}):
+                self.assertIsNone(backend.PyPIResource._pip_interpreter())
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     unittest.main()
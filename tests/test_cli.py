@@ -1,5 +1,15 @@
 import mock
+import os
+import shutil
+import threading
 import unittest
+from tempfile import mkdtemp
+
+try:
+    from urllib.request import urlopen, Request  # Python 3
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, Request, HTTPError  # Python 2
 
 import jujuresources.cli
 from jujuresources import ALL
@@ -42,6 +52,7 @@ class TestCLI(unittest.TestCase):
             mep('fetch', jujuresources.cli.fetch),
             mep('verify', jujuresources.cli.verify),
             mep('install', jujuresources.cli.install),
+            mep('fetch_and_install', jujuresources.cli.fetch_and_install),
             mep('resource_path', jujuresources.cli.resource_path),
             mep('resource_spec', jujuresources.cli.resource_spec),
             mep('serve', jujuresources.cli.serve),
@@ -69,7 +80,7 @@ class TestCLI(unittest.TestCase):
         mverify.return_value = -1
         jujuresources.cli.resources(['fetch'])
         mload.assert_called_once_with('resources.yaml', None)
-        mfetch.assert_called_once_with(self.resources, [], None, False, mock.ANY)
+        mfetch.assert_called_once_with(self.resources, [], None, False, mock.ANY, 1)
         self.assertIsNotNone(mfetch.call_args_list[0][0][4])
         mexit.assert_called_once_with(-1)
 
@@ -81,11 +92,47 @@ class TestCLI(unittest.TestCase):
         mload.return_value = self.resources
         mverify.return_value = 1
         jujuresources.cli.resources(['fetch', '-r', 'r.y', '-d', 'od', '-u', 'url',
-                                     '-a', '-q', '-f'])
+                                     '-a', '-q', '-f', '-j', '4'])
         mload.assert_called_once_with('r.y', 'od')
-        mfetch.assert_called_once_with(self.resources, ALL, 'url', True, None)
+        mfetch.assert_called_once_with(self.resources, ALL, 'url', True, None, 4)
         mexit.assert_called_once_with(1)
 
+    @mock.patch('jujuresources.cli.backend.PyPIResource.build_wheels')
+    @mock.patch('jujuresources.cli.os.path.isdir')
+    @mock.patch('jujuresources.cli.print')
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli.verify')
+    @mock.patch('jujuresources.cli._fetch')
+    @mock.patch('jujuresources.cli._load')
+    def test_fetch_wheels(self, mload, mfetch, mverify, mexit, mprint, misdir, mbuild_wheels):
+        mload.return_value = self.resources
+        mverify.return_value = 0
+        misdir.return_value = True
+        mbuild_wheels.return_value = ['lxml']
+        self.resources.save_manifest = mock.Mock()
+        jujuresources.cli.resources(['fetch', '-w', '-j', '4'])
+        mbuild_wheels.assert_called_once_with('resources', 4, None)
+        mprint.assert_called_with('Unable to build wheels for: lxml')
+        self.resources.save_manifest.assert_called_once_with()
+        mbuild_wheels.reset_mock()
+        jujuresources.cli.resources(['fetch'])
+        assert not mbuild_wheels.called
+
+    @mock.patch.object(jujuresources.cli.backend, 'PYPI_CACHE_TTL', 1)
+    @mock.patch.object(jujuresources.cli.backend, 'SEGMENT_THRESHOLD', 1)
+    @mock.patch.object(jujuresources.cli.backend, 'SEGMENTS', 1)
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli.verify')
+    @mock.patch('jujuresources.cli._fetch')
+    @mock.patch('jujuresources.cli._load')
+    def test_fetch_segments(self, mload, mfetch, mverify, mexit):
+        mload.return_value = self.resources
+        mverify.return_value = 0
+        jujuresources.cli.resources(['fetch', '-S', '8', '--segment-threshold', '1024', '--pypi-cache-ttl', '0'])
+        self.assertEqual(jujuresources.cli.backend.SEGMENTS, 8)
+        self.assertEqual(jujuresources.cli.backend.SEGMENT_THRESHOLD, 1024)
+        self.assertEqual(jujuresources.cli.backend.PYPI_CACHE_TTL, 0)
+
     @mock.patch('jujuresources.cli._exit')
     @mock.patch('jujuresources.cli.verify')
     @mock.patch('jujuresources.cli._fetch')
@@ -107,7 +154,7 @@ class TestCLI(unittest.TestCase):
         minvalid.return_value = ['invalid']
         jujuresources.cli.resources(['verify'])
         mload.assert_called_once_with('resources.yaml', None)
-        minvalid.assert_called_once_with(self.resources, [])
+        minvalid.assert_called_once_with(self.resources, [], False, 1, False)
         mprint.assert_called_once_with('Invalid or missing resources: invalid')
         mexit.assert_called_once_with(1)
 
@@ -119,9 +166,9 @@ class TestCLI(unittest.TestCase):
         mload.return_value = self.resources
         minvalid.return_value = ['invalid', 'opt-invalid']
         jujuresources.cli.resources(['verify', '-r', 'r.y', '-d', 'od',
-                                     '-a', '-q'])
+                                     '-a', '-q', '--deep', '-j', '4', '--processes'])
         mload.assert_called_once_with('r.y', 'od')
-        minvalid.assert_called_once_with(self.resources, ALL)
+        minvalid.assert_called_once_with(self.resources, ALL, True, 4, True)
         assert not mprint.called
         mexit.assert_called_once_with(1)
 
@@ -133,7 +180,7 @@ class TestCLI(unittest.TestCase):
         mload.return_value = self.resources
         minvalid.return_value = []
         jujuresources.cli.resources(['verify', 'foo', 'bar'])
-        minvalid.assert_called_once_with(self.resources, ['foo', 'bar'])
+        minvalid.assert_called_once_with(self.resources, ['foo', 'bar'], False, 1, False)
         mprint.assert_called_once_with('All resources successfully downloaded')
         mexit.assert_called_once_with(0)
 
@@ -159,27 +206,30 @@ class TestCLI(unittest.TestCase):
 
     @mock.patch('jujuresources.cli._exit')
     @mock.patch('jujuresources.cli.print')
-    @mock.patch('jujuresources.cli.HTTPServer')
+    @mock.patch('jujuresources.cli.ThreadingHTTPServer')
     @mock.patch('jujuresources.cli.backend')
     @mock.patch('jujuresources.cli.os')
     @mock.patch('jujuresources.cli._load')
     def test_serve(self, mload, mos, mbackend, mHTTPServer, mprint, mexit):
         mload.return_value = self.resources
+        self.resources.save_manifest = mock.Mock()
         mos.path.exists.return_value = True
         jujuresources.cli.resources(['serve', '-H', 'host', '-p', '9999'])
         mos.chdir.assert_called_once_with('resources')
         mbackend.PyPIResource.build_pypi_indexes.assert_called_with('resources')
+        self.resources.save_manifest.assert_called_once_with()
         self.assertIs(mHTTPServer.allow_reuse_address, True)
-        mHTTPServer.assert_called_once_with(('host', 9999), jujuresources.cli.SimpleHTTPRequestHandler)
+        mHTTPServer.assert_called_once_with(('host', 9999), jujuresources.cli.RangeRequestHandler)
 
     @mock.patch('jujuresources.cli._exit')
     @mock.patch('jujuresources.cli.print')
-    @mock.patch('jujuresources.cli.HTTPServer')
+    @mock.patch('jujuresources.cli.ThreadingHTTPServer')
     @mock.patch('jujuresources.cli.backend')
     @mock.patch('jujuresources.cli.os')
     @mock.patch('jujuresources.cli._load')
     def test_serve_dir(self, mload, mos, mbackend, mHTTPServer, mprint, mexit):
         mload.return_value = ResourceContainer('od')
+        mload.return_value.save_manifest = mock.Mock()
         mos.path.exists.return_value = True
         jujuresources.cli.resources(['serve', '-d', 'od'])
         mload.assert_called_once_with('resources.yaml', 'od')
@@ -187,7 +237,7 @@ class TestCLI(unittest.TestCase):
         mbackend.PyPIResource.build_pypi_indexes.assert_called_with('od')
         mos.chdir.assert_called_once_with('od')
         self.assertIs(mHTTPServer.allow_reuse_address, True)
-        mHTTPServer.assert_called_once_with(('', 8080), jujuresources.cli.SimpleHTTPRequestHandler)
+        mHTTPServer.assert_called_once_with(('', 8080), jujuresources.cli.RangeRequestHandler)
 
     @mock.patch('jujuresources.cli._exit')
     @mock.patch('jujuresources.cli.sys')
@@ -209,7 +259,7 @@ class TestCLI(unittest.TestCase):
         minstall.return_value = True
         jujuresources.cli.resources(['install'])
         mload.assert_called_once_with('resources.yaml', None)
-        minstall.assert_called_once_with(self.resources, [], None, None, False)
+        minstall.assert_called_once_with(self.resources, [], None, None, False, 1, None, None)
         mprint.assert_called_with('All resources successfully installed')
         mexit.assert_called_with(0)
 
@@ -224,7 +274,7 @@ class TestCLI(unittest.TestCase):
         minvalid.return_value = ['foo', 'bar']
         jujuresources.cli.resources(['install'])
         mload.assert_called_once_with('resources.yaml', None)
-        minstall.assert_called_once_with(self.resources, [], None, None, False)
+        minstall.assert_called_once_with(self.resources, [], None, None, False, 1, None, None)
         mprint.assert_called_with('Unable to install some resources: foo, bar')
         mexit.assert_called_with(1)
 
@@ -236,12 +286,88 @@ class TestCLI(unittest.TestCase):
         mload.return_value = self.resources
         minstall.return_value = False
         jujuresources.cli.resources(['install', '-r', 'r.y', '-d', 'od', '-u', 'url',
-                                     '-D', 'dst', '-s', '-q', '-a'])
+                                     '-D', 'dst', '-s', '-q', '-a', '-j', '4', '--install-mode', 'link',
+                                     '--cache-dir', 'cache'])
         mload.assert_called_once_with('r.y', 'od')
-        minstall.assert_called_once_with(self.resources, ALL, 'url', 'dst', True)
+        minstall.assert_called_once_with(self.resources, ALL, 'url', 'dst', True, 4, 'link', 'cache')
         assert not mprint.called
         mexit.assert_called_with(1)
 
+    @mock.patch('jujuresources.cli._exit')
+    @mock.patch('jujuresources.cli.print')
+    @mock.patch('jujuresources.cli._fetch_and_install')
+    @mock.patch('jujuresources.cli._load')
+    def test_fetch_and_install(self, mload, mfetch_and_install, mprint, mexit):
+        mload.return_value = self.resources
+        mfetch_and_install.return_value = True
+        jujuresources.cli.resources(['fetch_and_install', '-u', 'url', '-D', 'dst', '-s', '-k'])
+        mload.assert_called_once_with('resources.yaml', None)
+        mfetch_and_install.assert_called_once_with(self.resources, [], 'url', 'dst', True, True)
+        mprint.assert_called_with('All resources successfully installed')
+        mexit.assert_called_with(0)
+        mfetch_and_install.return_value = False
+        jujuresources.cli.resources(['fetch_and_install', '-D', 'dst', '-a'])
+        mfetch_and_install.assert_called_with(self.resources, ALL, None, 'dst', False, False)
+        mprint.assert_called_with('Unable to install some resources')
+        mexit.assert_called_with(1)
+
+
+class TestRangeRequestHandler(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = mkdtemp()
+        with open(os.path.join(self.tmpdir, 'fn'), 'wb') as fp:
+            fp.write(b'0123456789')
+        os.chdir(self.tmpdir)
+        self._plog = mock.patch.object(jujuresources.cli.RangeRequestHandler, 'log_message')
+        self._plog.start()
+        self.httpd = jujuresources.cli.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                           jujuresources.cli.RangeRequestHandler)
+        self.url = 'http://127.0.0.1:{}/fn'.format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+        self._plog.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _get(self, headers):
+        resp = urlopen(Request(self.url, headers=headers))
+        try:
+            return resp.getcode(), resp.info(), resp.read()
+        finally:
+            resp.close()
+
+    def test_full(self):
+        code, info, body = self._get({})
+        self.assertEqual(code, 200)
+        self.assertEqual(info.get('Accept-Ranges'), 'bytes')
+        self.assertEqual(body, b'0123456789')
+
+    def test_range(self):
+        code, info, body = self._get({'Range': 'bytes=3-'})
+        self.assertEqual(code, 206)
+        self.assertEqual(info.get('Content-Range'), 'bytes 3-9/10')
+        self.assertEqual(body, b'3456789')
+        self.assertEqual(self._get({'Range': 'bytes=2-4'})[2], b'234')
+        self.assertEqual(self._get({'Range': 'bytes=-2'})[2], b'89')
+
+    def test_if_range(self):
+        last_modified = self._get({})[1].get('Last-Modified')
+        self.assertEqual(self._get({'Range': 'bytes=3-', 'If-Range': last_modified})[0], 206)
+        code, info, body = self._get({'Range': 'bytes=3-', 'If-Range': 'stale'})
+        self.assertEqual(code, 200)
+        self.assertEqual(body, b'0123456789')
+
+    def test_unsatisfiable(self):
+        with self.assertRaises(HTTPError) as cm:
+            self._get({'Range': 'bytes=10-'})
+        self.assertEqual(cm.exception.code, 416)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+import csv
+import mock
+import os
+import shutil
+import sys
+import unittest
+import zipfile
+from tempfile import mkdtemp
+
+from jujuresources import wheels
+
+if not hasattr(unittest.TestCase, 'assertItemsEqual'):
+    # for Python 3.  assertCountEqual is a stupid name
+    unittest.TestCase.assertItemsEqual = unittest.TestCase.assertCountEqual
+
+
+class TestWheels(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.paths = dict((scheme, os.path.join(self.tmpdir, 'env', scheme))
+                          for scheme in ('purelib', 'platlib', 'scripts', 'data', 'headers'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _wheel(self, name, version, requires=(), files=None, entry_points=None, tag='py2.py3-none-any'):
+        filename = os.path.join(self.tmpdir, '{}-{}-{}.whl'.format(name, version, tag))
+        dist_info = '{}-{}.dist-info'.format(name, version)
+        with zipfile.ZipFile(filename, 'w') as zf:
+            zf.writestr('{}/__init__.py'.format(name), 'VERSION = {!r}\n'.format(version))
+            for path, data in (files or {}).items():
+                zf.writestr(path, data)
+            metadata = ['Metadata-Version: 2.1', 'Name: ' + name, 'Version: ' + version]
+            metadata.extend('Requires-Dist: ' + req for req in requires)
+            zf.writestr(dist_info + '/METADATA', '\n'.join(metadata) + '\n')
+            zf.writestr(dist_info + '/WHEEL', 'Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: {}\n'.format(tag))
+            if entry_points:
+                zf.writestr(dist_info + '/entry_points.txt', entry_points)
+            zf.writestr(dist_info + '/RECORD', 'bogus\n')
+        return filename
+
+    def test_parse_wheel_filename(self):
+        self.assertEqual(wheels.parse_wheel_filename('od/lxml-3.4.4-1-cp27-cp27mu-linux_x86_64.whl'), {
+            'name': 'lxml',
+            'version': '3.4.4',
+            'build': '1',
+            'pyver': 'cp27',
+            'abi': 'cp27mu',
+            'plat': 'linux_x86_64',
+        })
+        self.assertIsNone(wheels.parse_wheel_filename('lxml-3.4.4.tar.gz'))
+        self.assertTrue(wheels.compatible('foo-1.0-py2.py3-none-any.whl'))
+        self.assertFalse(wheels.compatible('foo-1.0-py1-none-any.whl'))
+        self.assertFalse(wheels.compatible('foo-1.0-cp27-cp27mu-win32.whl'))
+
+    def test_resolve(self):
+        foo = self._wheel('foo', '1.0', ['bar>=1.0', 'qux; python_version < "2"', 'baz; extra == "extra"'])
+        bar = self._wheel('bar', '1.1')
+        baz = self._wheel('baz', '1.0')
+        old_bar = self._wheel('bar', '0.9', tag='py3-none-any')
+        local = {'bar': bar, 'baz': baz}
+        working_set = wheels.pkg_resources.WorkingSet([])
+        self.assertIsNone(wheels.resolve([foo], working_set=working_set))
+        self.assertEqual(wheels.resolve([foo], local.get, working_set), [bar, foo])
+        self.assertEqual(wheels.resolve([foo], local.get, working_set, {foo: ('extra',)}), [baz, bar, foo])
+        self.assertIsNone(wheels.resolve([foo], {'bar': old_bar}.get, working_set))
+        self.assertIsNone(wheels.resolve([foo, old_bar], local.get, working_set))
+
+    def test_sdist_requirements(self):
+        sdist = os.path.join(self.tmpdir, 'foo-1.0.zip')
+        with zipfile.ZipFile(sdist, 'w') as zf:
+            zf.writestr('foo-1.0/PKG-INFO', 'Metadata-Version: 1.1\nName: foo\n')
+            zf.writestr('foo-1.0/foo.egg-info/requires.txt', '\n'.join([
+                'bar>=1.0',
+                '[extra]',
+                'baz',
+                '[:python_version < "2"]',
+                'qux',
+            ]))
+        self.assertEqual([str(req) for req in wheels.requirements(sdist)], ['bar>=1.0'])
+        self.assertEqual([str(req) for req in wheels.requirements(sdist, ('extra',))], ['bar>=1.0', 'baz'])
+        with zipfile.ZipFile(sdist, 'w') as zf:
+            zf.writestr('foo-1.0/setup.py', '')
+        self.assertIsNone(wheels.requirements(sdist))
+        # without an egg-info, or static metadata, only setup.py knows
+        with zipfile.ZipFile(sdist, 'w') as zf:
+            zf.writestr('foo-1.0/PKG-INFO', 'Metadata-Version: 1.1\nName: foo\n')
+        self.assertIsNone(wheels.requirements(sdist))
+        with zipfile.ZipFile(sdist, 'w') as zf:
+            zf.writestr('foo-1.0/PKG-INFO', 'Metadata-Version: 2.2\nName: foo\n')
+        self.assertEqual(wheels.requirements(sdist), [])
+        with zipfile.ZipFile(sdist, 'w') as zf:
+            zf.writestr('foo-1.0/PKG-INFO', 'Metadata-Version: 2.2\nName: foo\nDynamic: Requires-Dist\n')
+        self.assertIsNone(wheels.requirements(sdist))
+        with zipfile.ZipFile(sdist, 'w') as zf:
+            zf.writestr('foo-1.0/PKG-INFO', 'Metadata-Version: 1.1\nName: foo\n')
+            zf.writestr('foo-1.0/foo.egg-info/PKG-INFO', 'Metadata-Version: 1.1\nName: foo\n')
+        self.assertEqual(wheels.requirements(sdist), [])
+
+    def test_install_wheels(self):
+        foo = self._wheel('foo', '1.0', ['bar'], files={
+            'foo-1.0.data/scripts/foo-tool': '#!python\nprint("tool")\n',
+            'foo-1.0.data/data/share/foo.txt': 'data',
+        }, entry_points='[console_scripts]\nfoo = foo.cli:main\n')
+        bar = self._wheel('bar', '2.0')
+        assert not wheels.install_wheels([foo], paths=self.paths)
+        self.assertFalse(os.path.exists(self.paths['purelib']))
+
+        assert wheels.install_wheels([foo], {'bar': bar}.get, paths=self.paths, max_workers=2)
+        purelib = self.paths['purelib']
+        self.assertItemsEqual(os.listdir(purelib), ['foo', 'foo-1.0.dist-info', 'bar', 'bar-2.0.dist-info'])
+        with open(os.path.join(self.paths['scripts'], 'foo-tool')) as fp:
+            self.assertEqual(fp.readline(), '#!{}\n'.format(sys.executable))
+        with open(os.path.join(self.paths['scripts'], 'foo')) as fp:
+            script = fp.read()
+        self.assertIn('from foo.cli import main', script)
+        self.assertTrue(os.access(os.path.join(self.paths['scripts'], 'foo'), os.X_OK))
+        with open(os.path.join(self.paths['data'], 'share', 'foo.txt')) as fp:
+            self.assertEqual(fp.read(), 'data')
+        with open(os.path.join(purelib, 'foo-1.0.dist-info', 'INSTALLER')) as fp:
+            self.assertEqual(fp.read(), 'jujuresources\n')
+
+        with open(os.path.join(purelib, 'foo-1.0.dist-info', 'RECORD')) as fp:
+            record = dict((row[0], row[1:]) for row in csv.reader(fp))
+        self.assertEqual(record['foo-1.0.dist-info/RECORD'], ['', ''])
+        self.assertTrue(record['foo/__init__.py'][0].startswith('sha256='))
+        self.assertEqual(record['foo/__init__.py'][1], str(len("VERSION = '1.0'\n")))
+        self.assertIn(os.path.relpath(os.path.join(self.paths['scripts'], 'foo'), purelib), record)
+        pycs = [path for path in record if path.endswith('.pyc')]
+        self.assertEqual(len(pycs), 1)
+        self.assertTrue(os.path.exists(os.path.join(purelib, pycs[0])))
+
+        # already installed, so nothing to do
+        with mock.patch.object(wheels, '_unpack') as munpack:
+            assert wheels.install_wheels([foo], paths=self.paths)
+            assert not munpack.called
+        # upgrades are left to pip
+        assert not wheels.install_wheels([self._wheel('foo', '1.1')], paths=self.paths)
+
+    def test_install_wheels_unsafe(self):
+        evil = self._wheel('evil', '1.0', files={'../escaped.py': ''})
+        self.assertRaises(ValueError, wheels.install_wheels, [evil], paths=self.paths)
+        self.assertFalse(os.path.exists(self.paths['purelib']))
+
+        # the dependency, installed first, is fine, but nothing is installed
+        foo = self._wheel('foo', '1.0', ['bar'], files={'foo-1.0.data/unknown/foo.txt': ''})
+        bar = self._wheel('bar', '1.0')
+        self.assertRaises(ValueError, wheels.install_wheels, [foo], {'bar': bar}.get, paths=self.paths)
+        self.assertFalse(os.path.exists(self.paths['purelib']))
+
+    def test_install_wheels_rollback(self):
+        foo = self._wheel('foo', '1.0', ['bar'])
+        bar = self._wheel('bar', '1.0')
+        os.makedirs(self.paths['purelib'])
+        with mock.patch.object(wheels._Unpacked, 'write_record', side_effect=IOError('disk full')):
+            self.assertRaises(IOError, wheels.install_wheels, [foo], {'bar': bar}.get, paths=self.paths)
+        self.assertEqual(os.listdir(self.paths['purelib']), [])
+
+    def test_externally_managed(self):
+        paths = dict(self.paths, stdlib=os.path.join(self.tmpdir, 'stdlib'))
+        os.makedirs(paths['stdlib'])
+        foo = self._wheel('foo', '1.0')
+        with mock.patch.object(wheels.sysconfig, 'get_paths', return_value=paths), \
+                mock.patch.object(sys, 'prefix', getattr(sys, 'base_prefix', sys.prefix)):
+            assert not wheels.externally_managed()
+            with open(os.path.join(paths['stdlib'], 'EXTERNALLY-MANAGED'), 'w') as fp:
+                fp.write('[externally-managed]\n')
+            assert wheels.externally_managed()
+            with mock.patch.object(wheels, '_unpack') as munpack:
+                assert not wheels.install_wheels([foo])
+                assert not munpack.called
+            with mock.patch.object(sys, 'prefix', os.path.join(self.tmpdir, 'venv')):
+                assert not wheels.externally_managed()
+
+    def test_compile_files(self):
+        good = os.path.join(self.tmpdir, 'good.py')
+        bad = os.path.join(self.tmpdir, 'bad.py')
+        with open(good, 'w') as fp:
+            fp.write('x = 1\n')
+        with open(bad, 'w') as fp:
+            fp.write('x = \n')
+        compiled = wheels.compile_files([good, bad], max_workers=2)
+        self.assertEqual(list(compiled), [good])
+        self.assertTrue(os.path.exists(compiled[good]))
+
+
+if __name__ == '__main__':
+    unittest.main()